@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from api import images, media, search
+        images.connect_signals()
+        media.connect_signals()
+        search.connect_signals()
@@ -0,0 +1,172 @@
+"""
+Typeahead over the names of cities and of attractions, restaurants and hotels.
+
+Each worker keeps the names in memory as a sorted list of (key, kind, id) tuples, with a key for every word
+of a name ("bell tower" and "tower" for "Bell Tower"), so the names starting with a prefix are a contiguous
+slice found with two bisections. Within the slice, names are ranked by popularity: how many day trips
+visit the site, or sites of the city.
+
+The index is loaded on the first lookup of a worker. The worker handling a change applies it at once, and
+every worker reloads its index once it is older than `AUTOCOMPLETE_MAX_AGE` seconds, to pick up changes
+made by the others and new popularity counts. A reload reads the tables without holding the index lock,
+so lookups keep using the previous index until the new one replaces it.
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from api.models import City, Site
+
+CITY = 'city'
+SITE = 'site'
+# Slices longer than this are ranked once per prefix and cached
+CACHED_SLICE_SIZE = 500
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char)).strip()
+
+
+def name_keys(name):
+    """
+    Returns the normalized name from the start of each of its words
+    """
+    name = normalize(name)
+    return sorted(set(name[match.start():] for match in re.finditer(r'\w+', name)))
+
+
+class AutocompleteIndex(object):
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        # Held by the thread reloading the index, while the others keep using the current one
+        self._load_lock = threading.Lock()
+        self._keys = []
+        self._items = {}
+        self._cache = {}
+        self._loaded_at = None
+        # Changes applied while a load reads the tables, applied again to the loaded index
+        self._changes = None
+
+    def _add(self, kind, pk, name, weight):
+        self._items[(kind, pk)] = (name, weight)
+        for key in name_keys(name):
+            bisect.insort(self._keys, (key, kind, pk))
+
+    def _remove(self, kind, pk):
+        item = self._items.pop((kind, pk), None)
+        if item is None:
+            return
+        for key in name_keys(item[0]):
+            index = bisect.bisect_left(self._keys, (key, kind, pk))
+            if index < len(self._keys) and self._keys[index] == (key, kind, pk):
+                del self._keys[index]
+
+    def _apply(self, kind, pk, name):
+        # A name of None removes the item
+        weight = self._items.get((kind, pk), (None, 0))[1]
+        self._remove(kind, pk)
+        if name is not None:
+            self._add(kind, pk, name, weight)
+        self._cache = {}
+
+    def load(self):
+        with self._lock:
+            self._changes = []
+        try:
+            items = [(CITY, pk, name, weight) for pk, name, weight in
+                     City.objects.annotate(weight=Count('site__site_to_day_trip'))
+                     .values_list('id', 'city_name', 'weight')]
+            items += [(SITE, pk, name, weight) for pk, name, weight in
+                      Site.objects.filter(Q(attraction__isnull=False) | Q(restaurant__isnull=False) |
+                                          Q(hotel__isnull=False))
+                      .annotate(weight=Count('site_to_day_trip')).values_list('id', 'name', 'weight')]
+            keys = sorted((key, kind, pk) for kind, pk, name, weight in items for key in name_keys(name))
+        except BaseException:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            self._keys = keys
+            self._items = {(kind, pk): (name, weight) for kind, pk, name, weight in items}
+            self._cache = {}
+            # The tables may have been read before these changes were committed
+            for change in self._changes:
+                self._apply(*change)
+            self._changes = None
+            self._loaded_at = time.monotonic()
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+
+    def _ensure_loaded(self):
+        """
+        Reloads a stale index in a single thread, without blocking lookups on the current index. Only
+        the first load is waited for, as there is no index to use meanwhile.
+        """
+        if not self._is_stale():
+            return
+        if not self._load_lock.acquire(blocking=self._loaded_at is None):
+            # Being reloaded by another thread
+            return
+        try:
+            if self._is_stale():
+                self.load()
+        finally:
+            self._load_lock.release()
+
+    def update(self, kind, pk, name):
+        """
+        Adds or renames a city or a site, keeping its popularity
+        """
+        self._change(kind, pk, name)
+
+    def remove(self, kind, pk):
+        self._change(kind, pk, None)
+
+    def _change(self, kind, pk, name):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((kind, pk, name))
+            if self._loaded_at is None:
+                return
+            self._apply(kind, pk, name)
+
+    def _rank(self, kind, pk):
+        name, weight = self._items[(kind, pk)]
+        return -weight, len(name), name
+
+    def lookup(self, prefix, kind=None, limit=8):
+        """
+        Returns the (kind, id, name) of the most popular cities and sites with a word starting with `prefix`
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self._ensure_loaded()
+        with self._lock:
+            cache_key = (prefix, kind, limit)
+            if cache_key in self._cache:
+                return self._cache[cache_key]
+
+            start = bisect.bisect_left(self._keys, (prefix,))
+            end = bisect.bisect_left(self._keys, (prefix + '\U0010ffff',), start)
+            # Names matching on several words appear once
+            matches = set((item_kind, pk) for _, item_kind, pk in self._keys[start:end]
+                          if kind is None or item_kind == kind)
+            best = heapq.nsmallest(limit, matches, key=lambda item: self._rank(*item))
+            results = [(item_kind, pk, self._items[(item_kind, pk)][0]) for item_kind, pk in best]
+            if end - start > CACHED_SLICE_SIZE:
+                self._cache[cache_key] = results
+            return results
+
+
+autocomplete_index = AutocompleteIndex(max_age=getattr(settings, 'AUTOCOMPLETE_MAX_AGE', 300))
@@ -0,0 +1,167 @@
+import atexit
+import logging
+import os
+import random
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction, DatabaseError, IntegrityError
+from django.db.models import F, Q, Count, Sum, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from api.models import Itinerary, Like, LikeCounterShard
+
+logger = logging.getLogger(__name__)
+
+
+class CounterBuffer(object):
+    """
+    Aggregates counter increments in memory and writes them behind as `F(field) + n` updates.
+
+    Increments are flushed every `flush_interval` seconds by a background thread, as soon as
+    `max_pending` rows are buffered, and when the worker exits. A `flush_interval` of 0 disables
+    buffering and writes every increment through.
+    """
+
+    def __init__(self, model, field, flush_interval=10, max_pending=1000):
+        self.model = model
+        self.field = field
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._pid = None
+
+    def increment(self, pk, amount=1):
+        """
+        Buffers an increment and returns the amount not yet written for this row
+        """
+        if self.flush_interval <= 0:
+            self.model.objects.filter(pk=pk).update(**{self.field: F(self.field) + amount})
+            return 0
+
+        with self._lock:
+            self._start()
+            pending = self._pending[pk] = self._pending.get(pk, 0) + amount
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+        return pending
+
+    def flush(self):
+        """
+        Writes the buffered increments, with one UPDATE per distinct increment amount
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        rows_by_amount = defaultdict(list)
+        for pk, amount in pending.items():
+            rows_by_amount[amount].append(pk)
+        for amount, pks in rows_by_amount.items():
+            try:
+                self.model.objects.filter(pk__in=pks).update(**{self.field: F(self.field) + amount})
+            except DatabaseError:
+                logger.exception('Failed to flush %s.%s counters', self.model.__name__, self.field)
+                with self._lock:
+                    for pk in pks:
+                        self._pending[pk] = self._pending.get(pk, 0) + amount
+
+    def _start(self):
+        # Started lazily, and again in every forked worker, since threads do not survive a fork
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = {}
+        thread = threading.Thread(target=self._run, name='counter-flush-' + self.field, daemon=True)
+        thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+            close_old_connections()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+
+view_counter = CounterBuffer(
+    Itinerary,
+    'view',
+    flush_interval=getattr(settings, 'VIEW_COUNTER_FLUSH_INTERVAL', 10),
+    max_pending=getattr(settings, 'VIEW_COUNTER_MAX_PENDING', 1000),
+)
+
+
+class LikeCounter(object):
+    """
+    Keeps `Itinerary.like` in step with `Like` rows. Must be called in the transaction that inserts or
+    deletes the likes.
+
+    When `shards` is positive, itineraries with at least `hot_threshold` likes count into one of `shards`
+    LikeCounterShard rows picked at random instead of the itinerary row, and `reconcile` periodically
+    folds them back by recounting the `Like` rows. Until then, readers add `pending` to `Itinerary.like`.
+    """
+
+    def __init__(self, shards=0, hot_threshold=1000):
+        self.shards = shards
+        self.hot_threshold = hot_threshold
+
+    def is_hot(self, itinerary_id):
+        if self.shards <= 0:
+            return False
+        return Itinerary.objects.filter(pk=itinerary_id) \
+            .filter(Q(like__gte=self.hot_threshold) | Q(like_shards__isnull=False)).exists()
+
+    def pending(self, itinerary_ids):
+        """
+        Returns the like count changes of the given itineraries not folded into `Itinerary.like` yet
+        """
+        if self.shards <= 0:
+            return {}
+        return dict(LikeCounterShard.objects.filter(itinerary_id__in=itinerary_ids).order_by()
+                    .values('itinerary_id').annotate(total=Sum('count')).values_list('itinerary_id', 'total'))
+
+    def add(self, itinerary_id, amount):
+        if not self.is_hot(itinerary_id):
+            Itinerary.objects.filter(pk=itinerary_id).update(like=F('like') + amount)
+            return
+
+        shard = random.randrange(self.shards)
+        shards = LikeCounterShard.objects.filter(itinerary_id=itinerary_id, shard=shard)
+        if shards.update(count=F('count') + amount) == 0:
+            try:
+                with transaction.atomic():
+                    LikeCounterShard.objects.create(itinerary_id=itinerary_id, shard=shard, count=amount)
+            except IntegrityError:
+                shards.update(count=F('count') + amount)
+
+    def reconcile(self, itinerary_ids=None):
+        """
+        Recounts the likes of the given itineraries, or of every sharded one, and drops their shards.
+        Returns the number of itineraries updated.
+        """
+        with transaction.atomic():
+            shards = LikeCounterShard.objects.select_for_update()
+            if itinerary_ids is not None:
+                shards = shards.filter(itinerary_id__in=itinerary_ids)
+            shard_ids = dict(shards.values_list('id', 'itinerary_id'))
+            if itinerary_ids is None:
+                itinerary_ids = set(shard_ids.values())
+
+            like_count = Like.objects.filter(itinerary=OuterRef('pk')).order_by() \
+                .values('itinerary').annotate(count=Count('id')).values('count')
+            updated = Itinerary.objects.filter(pk__in=itinerary_ids) \
+                .update(like=Coalesce(Subquery(like_count), 0))
+            LikeCounterShard.objects.filter(pk__in=shard_ids).delete()
+        return updated
+
+
+like_counter = LikeCounter(
+    shards=getattr(settings, 'LIKE_COUNTER_SHARDS', 0),
+    hot_threshold=getattr(settings, 'LIKE_COUNTER_HOT_THRESHOLD', 1000),
+)
@@ -0,0 +1,181 @@
+"""
+Per-city matrices of the distances between points of interest.
+
+The distances in km between the located attractions, restaurants and hotels of a city are kept in a float32
+matrix saved as a `.npy` file under `DISTANCE_CACHE_DIR`, which workers memory-map instead of loading, so
+the pages are shared between processes. Next to it, `city-<id>.json` lists the sites of the matrix rows with
+their coordinates and names the matrix file of the current version.
+
+A new version is written to a new matrix file before the index is atomically replaced to point to it,
+so readers never see a partial matrix. Updates for a single site only compute its row, and are serialized
+per city with a file lock. Whole matrices are only built by the `build_distance_cache` command: until a
+city has a cache, routing computes the distances between the sites it needs directly.
+"""
+import fcntl
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from api.geo import haversine_matrix
+from api.models import Site
+
+
+class CityDistances(object):
+    def __init__(self, version, sites, matrix):
+        self.version = version
+        self.ids = [site[0] for site in sites]
+        self.coordinates = [(site[1], site[2]) for site in sites]
+        self.matrix = matrix
+        self.rows = {pk: row for row, pk in enumerate(self.ids)}
+
+
+class DistanceCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._loaded = {}
+
+    def _path(self, city_id, suffix):
+        return os.path.join(self.directory, 'city-{}{}'.format(city_id, suffix))
+
+    @contextmanager
+    def _lock(self, city_id):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(city_id, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load(self, city_id):
+        """
+        Returns the cached distances of a city, or None if it has none
+        """
+        try:
+            stat = os.stat(self._path(city_id, '.json'))
+        except FileNotFoundError:
+            self._loaded.pop(city_id, None)
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns)
+        loaded = self._loaded.get(city_id, None)
+        if loaded is not None and loaded[0] == key:
+            return loaded[1]
+
+        try:
+            with open(self._path(city_id, '.json')) as index:
+                data = json.load(index)
+            matrix = np.load(self._path(city_id, '.{}.npy'.format(data['version'])), mmap_mode='r')
+        except FileNotFoundError:
+            # Replaced by a newer version in the meantime
+            return self.load(city_id) if os.path.exists(self._path(city_id, '.json')) else None
+        distances = CityDistances(data['version'], data['sites'], matrix)
+        self._loaded[city_id] = (key, distances)
+        return distances
+
+    def submatrix(self, city_id, site_ids):
+        """
+        Returns the float64 matrix of the distances between sites of a city, or None if one is not cached
+        """
+        distances = self.load(city_id)
+        if distances is None or any(pk not in distances.rows for pk in site_ids):
+            return None
+        rows = [distances.rows[pk] for pk in site_ids]
+        return np.asarray(distances.matrix[np.ix_(rows, rows)], dtype=np.float64)
+
+    def _write(self, city_id, sites, matrix, previous=None):
+        version = uuid.uuid4().hex
+        np.save(self._path(city_id, '.{}.npy'.format(version)), matrix.astype(np.float32, copy=False))
+        temporary = self._path(city_id, '.json.' + version)
+        with open(temporary, 'w') as index:
+            json.dump({'version': version, 'sites': sites}, index)
+        os.replace(temporary, self._path(city_id, '.json'))
+        if previous is not None:
+            # Workers still mapping the previous file keep reading it until they notice the new index
+            try:
+                os.remove(self._path(city_id, '.{}.npy'.format(previous.version)))
+            except FileNotFoundError:
+                pass
+
+    def rebuild(self, city_id):
+        """
+        Computes the whole matrix of a city from the database
+        """
+        with self._lock(city_id):
+            sites = Site.objects.filter(city_id=city_id, latitude__isnull=False, longitude__isnull=False) \
+                .filter(Q(attraction__isnull=False) | Q(restaurant__isnull=False) | Q(hotel__isnull=False)) \
+                .order_by('id').values_list('id', 'latitude', 'longitude')
+            sites = [[pk, float(lat), float(lng)] for pk, lat, lng in sites]
+            previous = self.load(city_id)
+            self._write(city_id, sites, haversine_matrix([site[1:] for site in sites]), previous)
+
+    def update_site(self, site, previous_city_id=None):
+        """
+        Adds or moves the row of a created or updated site, and drops it from the city it left
+        """
+        if previous_city_id is not None and previous_city_id != site.city_id:
+            self.remove_site(site.pk, previous_city_id)
+        if site.city_id is None:
+            return
+        if site.latitude is None or site.longitude is None:
+            self.remove_site(site.pk, site.city_id)
+            return
+
+        with self._lock(site.city_id):
+            distances = self.load(site.city_id)
+            if distances is None:
+                return
+            sites = [[pk, lat, lng] for pk, (lat, lng) in zip(distances.ids, distances.coordinates)]
+            point = [site.pk, float(site.latitude), float(site.longitude)]
+            row = distances.rows.get(site.pk, None)
+            if row is None:
+                count = len(sites)
+                sites.append(point)
+                matrix = np.zeros((count + 1, count + 1), dtype=np.float32)
+                matrix[:count, :count] = distances.matrix
+                row = count
+            else:
+                sites[row] = point
+                matrix = np.array(distances.matrix)
+            distances_from_site = haversine_matrix([point[1:]], [site[1:] for site in sites])[0]
+            distances_from_site[row] = 0
+            matrix[row, :] = distances_from_site
+            matrix[:, row] = distances_from_site
+            self._write(site.city_id, sites, matrix, distances)
+
+    def remove_site(self, site_id, city_id):
+        """
+        Drops the row of a deleted site
+        """
+        if city_id is None:
+            return
+        with self._lock(city_id):
+            distances = self.load(city_id)
+            if distances is None or site_id not in distances.rows:
+                return
+            row = distances.rows[site_id]
+            sites = [[pk, lat, lng] for pk, (lat, lng) in zip(distances.ids, distances.coordinates) if pk != site_id]
+            matrix = np.delete(np.delete(distances.matrix, row, axis=0), row, axis=1)
+            self._write(city_id, sites, matrix, distances)
+
+    def clear(self, city_id):
+        """
+        Drops the cache of a city, until it is built again
+        """
+        with self._lock(city_id):
+            distances = self.load(city_id)
+            if distances is None:
+                return
+            os.remove(self._path(city_id, '.json'))
+            os.remove(self._path(city_id, '.{}.npy'.format(distances.version)))
+            self._loaded.pop(city_id, None)
+
+
+distance_cache = DistanceCache(
+    getattr(settings, 'DISTANCE_CACHE_DIR', os.path.join(settings.BASE_DIR, 'distance_cache')),
+)
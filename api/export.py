@@ -0,0 +1,161 @@
+"""
+Streaming exports of the attractions, restaurants and hotels, and of the public itineraries.
+
+Rows are read in chunks of `EXPORT_CHUNK_SIZE` by id (`WHERE id > last id ORDER BY id LIMIT n`, as
+api.pagination does) rather than with `QuerySet.iterator()`, since the MySQL driver loads whole result
+sets in memory, and written out one line at a time, so exporting never holds more than a chunk in memory.
+Sites are exported with the fields read by api.importer, so an export can be imported elsewhere.
+Itineraries are exported as trees of their days and the sites visited each day in order, or in CSV as a
+row per visit.
+"""
+import csv
+import json
+from itertools import groupby
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from api.models import Site, Itinerary, DayTripSite
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = (NDJSON, CSV)
+CONTENT_TYPES = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv; charset=utf-8',
+}
+
+SITE_FIELDS = ('id', 'name', 'site_category', 'category', 'url', 'city_id', 'city', 'country', 'latitude',
+               'longitude', 'address', 'description', 'open_at', 'star_rate')
+ITINERARY_FIELDS = ('id', 'title', 'description', 'owner', 'posted_on', 'view', 'like')
+ITINERARY_VISIT_FIELDS = ITINERARY_FIELDS + ('day', 'position', 'site_id', 'site_name')
+
+
+def get_chunk_size():
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+def keyset_chunks(queryset):
+    """
+    Yields the rows of a values() queryset including `id`, a chunk at a time in the order of their ids
+    """
+    queryset = queryset.order_by('id')
+    last_id = None
+    while True:
+        chunk = list((queryset if last_id is None else queryset.filter(id__gt=last_id))[:get_chunk_size()])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]['id']
+
+
+def site_rows(city=None, category=None):
+    """
+    Yields the attractions, restaurants and hotels, optionally of a city or of a site category
+    """
+    sites = Site.objects.filter(Q(attraction__isnull=False) | Q(restaurant__isnull=False) | Q(hotel__isnull=False))
+    if city is not None:
+        sites = sites.filter(city_id=city)
+    if category is not None:
+        sites = sites.filter(site_category=category)
+    sites = sites.values(
+        'id', 'name', 'site_category', 'url', 'city_id', 'latitude', 'longitude', 'address', 'description',
+        'city__city_name', 'city__country_name', 'attraction__category', 'restaurant__category',
+        'restaurant__open_at', 'hotel__category', 'hotel__star_rate',
+    )
+    for site in (site for chunk in keyset_chunks(sites) for site in chunk):
+        yield {
+            'id': site['id'],
+            'name': site['name'],
+            'site_category': site['site_category'],
+            'category': site['attraction__category'] or site['restaurant__category'] or site['hotel__category'],
+            'url': site['url'],
+            'city_id': site['city_id'],
+            'city': site['city__city_name'],
+            'country': site['city__country_name'],
+            'latitude': site['latitude'],
+            'longitude': site['longitude'],
+            'address': site['address'],
+            'description': site['description'],
+            'open_at': site['restaurant__open_at'],
+            'star_rate': site['hotel__star_rate'],
+        }
+
+
+def itinerary_rows():
+    """
+    Yields the public itineraries, with in `days` their sites visited each day in order
+    """
+    itineraries = Itinerary.objects.filter(is_public=True) \
+        .values('id', 'title', 'description', 'owner__username', 'posted_on', 'view', 'like')
+    for chunk in keyset_chunks(itineraries):
+        # The visits of a chunk of itineraries at once
+        visits = DayTripSite.objects.filter(day_trip__itinerary_id__in=[itinerary['id'] for itinerary in chunk]) \
+            .order_by('day_trip__itinerary_id', 'day_trip__day', 'order') \
+            .values_list('day_trip__itinerary_id', 'day_trip__day', 'site_id', 'site__name')
+        days = {}
+        for itinerary_id, itinerary_visits in groupby(visits, key=lambda visit: visit[0]):
+            days[itinerary_id] = [
+                {'day': day, 'sites': [{'id': site_id, 'name': name} for _, _, site_id, name in day_visits]}
+                for day, day_visits in groupby(itinerary_visits, key=lambda visit: visit[1])
+            ]
+        for itinerary in chunk:
+            yield {
+                'id': itinerary['id'],
+                'title': itinerary['title'],
+                'description': itinerary['description'],
+                'owner': itinerary['owner__username'],
+                'posted_on': itinerary['posted_on'],
+                'view': itinerary['view'],
+                'like': itinerary['like'],
+                'days': days.get(itinerary['id'], []),
+            }
+
+
+def itinerary_visit_rows(itineraries):
+    """
+    Flattens itinerary trees to a row per visited site, or a single row without visit for an empty itinerary
+    """
+    for itinerary in itineraries:
+        fields = {name: itinerary[name] for name in ITINERARY_FIELDS}
+        visits = [(day['day'], position, site) for day in itinerary['days']
+                  for position, site in enumerate(day['sites'])]
+        if not visits:
+            yield fields
+        for day, position, site in visits:
+            yield dict(fields, day=day, position=position, site_id=site['id'], site_name=site['name'])
+
+
+class Echo(object):
+    """
+    A file whose writes return what is written, for csv.writer to format a line at a time
+    """
+
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def csv_lines(rows, fields):
+    writer = csv.DictWriter(Echo(), fields)
+    yield writer.writerow(dict(zip(fields, fields)))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def export_lines(kind, file_format, **filters):
+    """
+    Yields the lines of an export of `site` or `itinerary` rows, in NDJSON or CSV
+    """
+    if kind == 'site':
+        rows, fields = site_rows(**filters), SITE_FIELDS
+    else:
+        rows, fields = itinerary_rows(), ITINERARY_VISIT_FIELDS
+        if file_format == CSV:
+            rows = itinerary_visit_rows(rows)
+    return ndjson_lines(rows) if file_format == NDJSON else csv_lines(rows, fields)
@@ -0,0 +1,121 @@
+"""
+Geographic helpers: geohash encoding of site coordinates and great-circle distances.
+
+A geohash interleaves longitude and latitude bits into a base 32 string, so that sites sharing a prefix lie in
+the same grid cell and a cell is found with an indexed `LIKE 'prefix%'` lookup.
+"""
+import math
+
+import numpy as np
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+EARTH_RADIUS_KM = 6371.0088
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        value, value_range = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            value_range[0] = middle
+        else:
+            bits = bits << 1
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def geohash_cell_size(precision):
+    """
+    Returns the (height, width) in degrees of the geohash cells of a precision
+    """
+    lat_bits = 5 * precision // 2
+    lng_bits = 5 * precision - lat_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def geohash_precision_for_zoom(zoom, cell_pixels=64):
+    """
+    Returns the finest geohash precision whose cells are at least `cell_pixels` wide on a web map
+    (256 px tiles) at a zoom level
+    """
+    min_width = 360.0 * cell_pixels / (256 * 2 ** zoom)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        if geohash_cell_size(precision)[1] >= min_width:
+            return precision
+    return 1
+
+
+def geohash_cell_count(min_lat, min_lng, max_lat, max_lng, precision):
+    """
+    Returns an upper bound of the number of geohash cells of a precision overlapping a bounding box
+    """
+    height, width = geohash_cell_size(precision)
+    return (int((max_lat - min_lat) // height) + 2) * (int((max_lng - min_lng) // width) + 2)
+
+
+def geohash_cover(min_lat, min_lng, max_lat, max_lng, max_cells=16):
+    """
+    Returns the geohash prefixes of the cells covering a bounding box, at the finest precision
+    needing at most `max_cells` cells
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        if geohash_cell_count(min_lat, min_lng, max_lat, max_lng, precision) <= max_cells or precision == 1:
+            break
+    height, width = geohash_cell_size(precision)
+    rows = int((max_lat - min_lat) // height) + 2
+    columns = int((max_lng - min_lng) // width) + 2
+
+    cells = set()
+    for row in range(rows):
+        latitude = min(min_lat + row * height, max_lat)
+        for column in range(columns):
+            longitude = min(min_lng + column * width, max_lng)
+            cells.add(geohash_encode(latitude, longitude, precision))
+    return sorted(cells)
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Returns the (min_lat, min_lng, max_lat, max_lng) box enclosing a circle
+    """
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = math.cos(math.radians(latitude))
+    lng_delta = 180.0 if cos_lat < 1e-6 else min(180.0, lat_delta / cos_lat)
+    return (max(-90.0, latitude - lat_delta), max(-180.0, longitude - lng_delta),
+            min(90.0, latitude + lat_delta), min(180.0, longitude + lng_delta))
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance in km
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def haversine_matrix(coordinates, others=None):
+    """
+    Returns the matrix of the great-circle distances in km between the (latitude, longitude) pairs of
+    `coordinates` and those of `others`, or of `coordinates` with themselves
+    """
+    rows = np.radians(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2))
+    columns = rows if others is None else np.radians(np.asarray(others, dtype=np.float64).reshape(-1, 2))
+    lat1, lng1 = rows[:, 0, None], rows[:, 1, None]
+    lat2, lng2 = columns[None, :, 0], columns[None, :, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
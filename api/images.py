@@ -0,0 +1,233 @@
+"""
+Responsive variants of uploaded images.
+
+Uploads are stored as they are, and a pool of background threads then writes smaller copies of each:
+`thumb` for lists, `card` for cards and `full` for detail pages, in WebP and in JPEG. Variant files are
+named after the original (`itinerary/a.jpg` gives `variants/itinerary/a.thumb.webp`), so no database
+state is needed to find them, and copies sharing an original file, like forked itineraries, share them.
+
+Until the variants of an image are written, its variant map points to the original. An image seen without
+variants, uploaded while no worker was running for example, is processed on first sight, and the
+`process_images` command processes every image at once.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, FileSystemStorage
+from django.db.models.signals import post_save
+from PIL import Image, ImageOps
+from rest_framework import serializers
+
+from api.models import City, Site, Itinerary, Highlight, User
+
+logger = logging.getLogger(__name__)
+
+# Largest width and height of each variant, images are never enlarged
+VARIANTS = (
+    ('thumb', (320, 320)),
+    ('card', (800, 600)),
+    ('full', (1920, 1920)),
+)
+FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+IMAGE_FIELDS = (
+    (City, 'photo'),
+    (Site, 'photo'),
+    (Itinerary, 'image'),
+    (Highlight, 'photo'),
+    (User, 'profile_pic'),
+)
+# Names of the images known to have variants, kept per process
+KNOWN_PROCESSED_LIMIT = 10000
+# Seconds an image is trusted to have variants before checking again, as another process may have deleted
+# them with the image
+PROCESSED_TTL = 60
+# Seconds an image is known to have no variants before checking again
+MISSING_TTL = 10
+# Seconds before processing an image again after a first failure, doubled after each failure up to the max
+RETRY_DELAY = 30
+RETRY_MAX_DELAY = 3600
+
+
+def variant_name(name, variant, extension):
+    return 'variants/{}.{}.{}'.format(os.path.splitext(name)[0], variant, extension)
+
+
+def variant_names(name):
+    return [(variant, extension, variant_name(name, variant, extension))
+            for variant, _ in VARIANTS for extension, _, _ in FORMATS]
+
+
+def render_variants(image):
+    """
+    Yields the (variant, extension, bytes) of the variants of a PIL image
+    """
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    for variant, size in VARIANTS:
+        resized = image.copy()
+        resized.thumbnail(size, Image.LANCZOS)
+        for extension, pil_format, options in FORMATS:
+            output = BytesIO()
+            if pil_format == 'JPEG' and resized.mode == 'RGBA':
+                # JPEG has no alpha, flatten on white
+                flattened = Image.new('RGB', resized.size, (255, 255, 255))
+                flattened.paste(resized, mask=resized.split()[3])
+                flattened.save(output, pil_format, **options)
+            else:
+                resized.save(output, pil_format, **options)
+            yield variant, extension, output.getvalue()
+
+
+class ImageProcessor(object):
+
+    def __init__(self, storage, variant_storage, workers=2):
+        self.storage = storage
+        # Variants are saved under their own names, even when originals are content-addressed
+        self.variant_storage = variant_storage
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+        # Names and (time to retry at, failures)
+        self._failed = {}
+        # Names and when they were last seen without variants
+        self._missing = {}
+        # Names and when their variants were last seen
+        self._processed = {}
+
+    def _remember_processed(self, name):
+        if len(self._processed) >= KNOWN_PROCESSED_LIMIT:
+            self._processed.clear()
+        self._processed[name] = time.monotonic()
+        self._missing.pop(name, None)
+
+    def is_processed(self, name):
+        now = time.monotonic()
+        checked = self._processed.get(name, None)
+        if checked is not None and now - checked < PROCESSED_TTL:
+            return True
+        checked = self._missing.get(name, None)
+        if checked is not None and now - checked < MISSING_TTL:
+            return False
+        # The last variant is written last
+        if self.variant_storage.exists(variant_names(name)[-1][2]):
+            self._remember_processed(name)
+            return True
+        self._processed.pop(name, None)
+        if len(self._missing) >= KNOWN_PROCESSED_LIMIT:
+            self._missing.clear()
+        self._missing[name] = now
+        return False
+
+    def process(self, name):
+        """
+        Writes the variants of a stored image, unless they exist
+        """
+        if self.is_processed(name):
+            return
+        with self.storage.open(name, 'rb') as original:
+            image = Image.open(original)
+            image.load()
+        for variant, extension, content in render_variants(image):
+            path = variant_name(name, variant, extension)
+            if self.variant_storage.exists(path):
+                self.variant_storage.delete(path)
+            self.variant_storage.save(path, ContentFile(content))
+        self._remember_processed(name)
+
+    def delete_variants(self, name):
+        self._processed.pop(name, None)
+        for _, _, path in variant_names(name):
+            self.variant_storage.delete(path)
+
+    def _fail(self, name):
+        with self._lock:
+            failures = self._failed.get(name, (None, 0))[1] + 1
+            delay = min(RETRY_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)
+            self._failed[name] = (time.monotonic() + delay, failures)
+
+    def _run(self, name):
+        try:
+            self.process(name)
+            with self._lock:
+                self._failed.pop(name, None)
+        except FileNotFoundError:
+            logger.warning('Could not write the variants of %s, the file is missing', name)
+            self._fail(name)
+        except Exception:
+            logger.exception('Could not write the variants of %s', name)
+            self._fail(name)
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def schedule(self, name):
+        """
+        Queues an image to be processed by the worker pool, once, or again after a delay if it failed
+        """
+        if not name:
+            return None
+        with self._lock:
+            if name in self._pending or time.monotonic() < self._failed.get(name, (0, 0))[0]:
+                return None
+            self._pending.add(name)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='images')
+            return self._executor.submit(self._run, name)
+
+    def urls(self, name):
+        """
+        Returns the relative url of the original image and of each variant, all the original until processed
+        """
+        original = self.storage.url(name)
+        processed = self.is_processed(name)
+        if not processed:
+            self.schedule(name)
+        urls = {'original': original}
+        for variant, extension, path in variant_names(name):
+            urls.setdefault(variant, {})[extension] = self.variant_storage.url(path) if processed else original
+        return urls
+
+
+image_processor = ImageProcessor(default_storage, FileSystemStorage(), workers=getattr(settings, 'IMAGE_WORKERS', 2))
+
+
+class ImageVariantsField(serializers.ImageField):
+    """
+    Image upload, read as a map of the urls of its variants:
+    {"original": url, "thumb": {"webp": url, "jpeg": url}, "card": {...}, "full": {...}}
+    """
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        urls = image_processor.urls(value.name)
+        request = self.context.get('request', None)
+        if request is None:
+            return urls
+        return {variant: request.build_absolute_uri(url) if isinstance(url, str) else
+                {extension: request.build_absolute_uri(path) for extension, path in url.items()}
+                for variant, url in urls.items()}
+
+
+def process_saved_image(sender, instance, **kwargs):
+    for model, field in IMAGE_FIELDS:
+        if sender is model:
+            image = getattr(instance, field)
+            if image:
+                image_processor.schedule(image.name)
+
+
+def connect_signals():
+    for model, _ in IMAGE_FIELDS:
+        post_save.connect(process_saved_image, sender=model, dispatch_uid='process_image_{}'.format(model.__name__))
@@ -0,0 +1,222 @@
+"""
+Bulk import of attractions, restaurants and hotels from NDJSON or CSV files.
+
+Each record describes a site and its subtype, with the city and country by name:
+
+    {"name": "Bell Tower", "site_category": "Attraction", "url": "https://www.yelp.com/biz/...",
+     "city": "Xi'an", "country": "China", "latitude": 34.2612, "longitude": 108.9423,
+     "address": "...", "description": "...", "category": "landmark"}
+
+restaurants also have `open_at` and hotels `star_rate`. The url identifies the site: a record whose url is
+already known updates that site, and its subtype row, instead of adding one.
+
+Files are read one record at a time and written in batches of `bulk_create`/`bulk_update` queries, each
+transaction committing a few batches, so memory stays flat whatever the size of the file and an
+interrupted import can simply be run again. Cities are looked up in memory and created on first sight.
+The names of the sites written are applied to the autocomplete index of the process once committed, other
+workers pick them up when they reload theirs.
+"""
+import csv
+import json
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Max
+
+from api.autocomplete import autocomplete_index, SITE
+from api.models import City, Site, Attraction, Restaurant, Hotel
+from api.search import index_sites
+
+SUBTYPES = {
+    'Attraction': (Attraction, ('category',)),
+    'Restaurant': (Restaurant, ('category', 'open_at')),
+    'Hotel': (Hotel, ('category', 'star_rate')),
+}
+SITE_FIELDS = ('name', 'latitude', 'longitude', 'geohash', 'site_category', 'city', 'address', 'description')
+
+
+class RecordError(ValueError):
+    pass
+
+
+def read_ndjson(stream):
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, RecordError('Invalid JSON: {}'.format(e))
+
+
+def read_csv(stream):
+    # Line 1 is the header
+    for line_number, row in enumerate(csv.DictReader(stream), 2):
+        yield line_number, {key: value for key, value in row.items() if value != ''}
+
+
+def to_decimal(value, name, low, high):
+    try:
+        value = Decimal(str(value))
+    except InvalidOperation:
+        raise RecordError('Invalid {}: {}'.format(name, value))
+    if not value.is_finite():
+        raise RecordError('Invalid {}: {}'.format(name, value))
+    if not low <= value <= high:
+        raise RecordError('{} out of range: {}'.format(name, value))
+    return value
+
+
+def parse_record(record, default_country=None):
+    """
+    Returns the site, subtype and city fields of a record, raises RecordError if it is invalid
+    """
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise RecordError('A record must be an object')
+
+    site_category = record.get('site_category')
+    if site_category not in SUBTYPES:
+        raise RecordError('Invalid site_category: {}'.format(site_category))
+    for name in ('name', 'url', 'city'):
+        if not record.get(name):
+            raise RecordError('Missing {}'.format(name))
+    country = record.get('country', default_country)
+    if not country:
+        raise RecordError('Missing country')
+
+    site = {
+        'name': str(record['name'])[:100],
+        'url': str(record['url']),
+        'site_category': site_category,
+        'address': str(record.get('address', ''))[:100],
+        'description': str(record.get('description', '')),
+        'latitude': None,
+        'longitude': None,
+    }
+    if len(site['url']) > 100:
+        raise RecordError('url longer than 100 characters')
+    if record.get('latitude') is not None and record.get('longitude') is not None:
+        site['latitude'] = to_decimal(record['latitude'], 'latitude', -90, 90).quantize(Decimal('0.000001'))
+        site['longitude'] = to_decimal(record['longitude'], 'longitude', -180, 180).quantize(Decimal('0.000001'))
+
+    subtype = {'category': str(record.get('category', ''))[:30]}
+    if site_category == 'Restaurant':
+        try:
+            subtype['open_at'] = int(record.get('open_at', 0))
+        except (TypeError, ValueError):
+            raise RecordError('Invalid open_at: {}'.format(record.get('open_at')))
+    elif site_category == 'Hotel':
+        subtype['star_rate'] = to_decimal(record.get('star_rate', 0), 'star_rate', 0, 5).quantize(Decimal('0.1'))
+
+    return site, subtype, (str(country)[:30], str(record['city'])[:30])
+
+
+class SiteImporter(object):
+    """
+    Writes parsed records in batches, counting the sites `created` and `updated`. `cities` caches the ids
+    of cities by (country, city) name
+    """
+
+    def __init__(self):
+        self.created = self.updated = 0
+        self.errors = []
+        self.cities = {(country, name): pk for pk, country, name in
+                       City.objects.values_list('id', 'country_name', 'city_name')}
+        self.created_cities = 0
+        self.city_ids = set()
+
+    def get_city_id(self, key):
+        if key not in self.cities:
+            self.cities[key] = City.objects.create(country_name=key[0], city_name=key[1]).pk
+            self.created_cities += 1
+        return self.cities[key]
+
+    def write_batch(self, records):
+        """
+        Creates or updates the sites of a batch of parsed records, returns the number of (created, updated)
+        """
+        # The last record of a url wins
+        records = {site['url']: (site, subtype, city) for site, subtype, city in records}
+        existing = {}
+        for pk, url in Site.objects.filter(url__in=list(records)).order_by('-id').values_list('id', 'url'):
+            existing[url] = pk
+
+        sites = []
+        for url, (fields, _, city) in records.items():
+            site = Site(id=existing.get(url), city_id=self.get_city_id(city), **fields)
+            # bulk_create and bulk_update do not call save()
+            site.update_geohash()
+            sites.append(site)
+            self.city_ids.add(site.city_id)
+        new_sites = [site for site in sites if site.pk is None]
+        updated_sites = [site for site in sites if site.pk is not None]
+
+        Site.objects.bulk_update(updated_sites, SITE_FIELDS)
+        last_id = Site.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        Site.objects.bulk_create(new_sites)
+        if new_sites and new_sites[0].pk is None:
+            # Only some databases return the ids of created rows. The urls of a batch are distinct, and this
+            # transaction does not see rows created by others, so each url has a single row above last_id,
+            # even when older sites share it.
+            created = dict(Site.objects.filter(url__in=[site.url for site in new_sites], id__gt=last_id)
+                           .values_list('url', 'id'))
+            for site in new_sites:
+                site.pk = created[site.url]
+
+        site_ids = [site.pk for site in sites]
+        for site_category, (model, fields) in SUBTYPES.items():
+            # A site changing category loses its previous subtype row
+            moved = [site.pk for site in updated_sites if site.site_category != site_category]
+            model.objects.filter(site_id__in=moved).delete()
+            rows = [model(site_id=site.pk, **records[site.url][1])
+                    for site in sites if site.site_category == site_category]
+            present = set(model.objects.filter(site_id__in=site_ids).values_list('site_id', flat=True))
+            model.objects.bulk_update([row for row in rows if row.site_id in present], fields)
+            model.objects.bulk_create([row for row in rows if row.site_id not in present])
+
+        index_sites(sites)
+        names = [(site.pk, site.name) for site in sites]
+        transaction.on_commit(lambda: self.update_autocomplete(names))
+        return len(new_sites), len(updated_sites)
+
+    def update_autocomplete(self, names):
+        for pk, name in names:
+            autocomplete_index.update(SITE, pk, name)
+
+
+def import_sites(records, batch_size=500, batches_per_transaction=10, default_country=None, report=None):
+    """
+    Imports (line number, record) pairs. Returns the importer, with the (line number, message) of the
+    invalid records in `errors`. `report` is called after every transaction
+    with the importer and the elapsed seconds.
+    """
+    importer = SiteImporter()
+    started = time.monotonic()
+    records = iter(records)
+    done = False
+    while not done:
+        with transaction.atomic():
+            for _ in range(batches_per_transaction):
+                batch = []
+                for line_number, record in records:
+                    try:
+                        batch.append(parse_record(record, default_country))
+                    except RecordError as e:
+                        importer.errors.append((line_number, str(e)))
+                    if len(batch) == batch_size:
+                        break
+                else:
+                    done = True
+                if batch:
+                    created, updated = importer.write_batch(batch)
+                    importer.created += created
+                    importer.updated += updated
+                if done:
+                    break
+        if report is not None:
+            report(importer, time.monotonic() - started)
+    return importer
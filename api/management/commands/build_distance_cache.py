@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.distance_cache import distance_cache
+from api.models import City
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the cached distance matrices between the points of interest of cities.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--city', type=int, action='append', dest='cities',
+                            help='Only rebuild this city, can be repeated')
+
+    def handle(self, *args, **options):
+        city_ids = options['cities'] or City.objects.order_by('id').values_list('id', flat=True)
+        for city_id in city_ids:
+            distance_cache.rebuild(city_id)
+            distances = distance_cache.load(city_id)
+            self.stdout.write('City %d: %d sites' % (city_id, len(distances.ids)))
+        self.stdout.write(self.style.SUCCESS('Rebuilt distances of %d cities' % len(city_ids)))
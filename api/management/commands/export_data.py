@@ -0,0 +1,35 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from api.export import export_lines, FORMATS, NDJSON
+from api.models import Site
+
+
+class Command(BaseCommand):
+    help = 'Writes every attraction, restaurant and hotel, or every public itinerary, as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['site', 'itinerary'])
+        parser.add_argument('--format', choices=FORMATS, default=NDJSON, dest='file_format')
+        parser.add_argument('--output', help='File to write, the standard output by default')
+        parser.add_argument('--city', type=int, help='Only export the sites of this city')
+        parser.add_argument('--category', choices=[choice for choice, _ in Site.CATEGORY_CHOICES],
+                            help='Only export the sites of this category')
+
+    def handle(self, *args, **options):
+        filters = {}
+        if options['kind'] == 'site':
+            filters = {'city': options['city'], 'category': options['category']}
+        lines = export_lines(options['kind'], options['file_format'], **filters)
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        count = 0
+        try:
+            for line in lines:
+                output.write(line)
+                count += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS('Wrote %d lines to %s' % (count, options['output'])))
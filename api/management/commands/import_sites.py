@@ -0,0 +1,63 @@
+import io
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.distance_cache import distance_cache
+from api.importer import import_sites, read_csv, read_ndjson
+
+READERS = {'ndjson': read_ndjson, 'csv': read_csv}
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates attractions, restaurants and hotels from NDJSON or CSV files, see api.importer. ' \
+           'Running servers pick up the new names for autocomplete within AUTOCOMPLETE_MAX_AGE seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Files to import, - for the standard input')
+        parser.add_argument('--format', choices=sorted(READERS),
+                            help='Format of the files, guessed from their extension by default')
+        parser.add_argument('--batch-size', type=int, default=500, help='Records written per query')
+        parser.add_argument('--transaction-batches', type=int, default=10, help='Batches committed together')
+        parser.add_argument('--country', help='Country of the records without one')
+
+    def get_reader(self, path, file_format):
+        if file_format is None:
+            file_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+        return READERS[file_format]
+
+    def report(self, importer, elapsed):
+        rows = importer.created + importer.updated
+        self.stdout.write('%d rows, %d invalid, %.0f rows/sec' %
+                          (rows, len(importer.errors), rows / max(elapsed, 1e-6)))
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['transaction_batches'] < 1:
+            raise CommandError('The batch size and the number of batches per transaction must be positive')
+        city_ids = set()
+        for path in options['files']:
+            if path != '-' and not os.path.exists(path):
+                raise CommandError('No such file: %s' % path)
+            reader = self.get_reader(path, options['format'])
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='') if path == '-' else \
+                open(path, encoding='utf-8', newline='')
+            with stream:
+                importer = import_sites(reader(stream), options['batch_size'], options['transaction_batches'],
+                                        options['country'], self.report)
+            for line_number, message in importer.errors:
+                self.stderr.write('%s:%d: %s' % (path, line_number, message))
+            self.stdout.write(self.style.SUCCESS('%s: created %d sites, updated %d, skipped %d invalid records, '
+                                                 'created %d cities' % (path, importer.created, importer.updated,
+                                                                        len(importer.errors),
+                                                                        importer.created_cities)))
+            city_ids |= importer.city_ids
+
+        # Cities without a matrix keep computing distances directly until build_distance_cache is run
+        rebuilt = 0
+        for city_id in sorted(city_ids):
+            if distance_cache.load(city_id) is not None:
+                distance_cache.rebuild(city_id)
+                rebuilt += 1
+        if rebuilt:
+            self.stdout.write('Rebuilt the distances of %d cities' % rebuilt)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from api.images import IMAGE_FIELDS, image_processor
+
+
+class Command(BaseCommand):
+    help = 'Writes the missing variants of every city, site, itinerary, highlight and profile image.'
+
+    def handle(self, *args, **options):
+        names = set()
+        for model, field in IMAGE_FIELDS:
+            names.update(model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True})
+                         .values_list(field, flat=True).distinct().iterator())
+        processed = failed = 0
+        for name in sorted(names):
+            if image_processor.is_processed(name):
+                continue
+            try:
+                image_processor.process(name)
+                processed += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write('%s: %s' % (name, e))
+        self.stdout.write(self.style.SUCCESS('Processed %d images, %d failed, out of %d' %
+                                             (processed, failed, len(names))))
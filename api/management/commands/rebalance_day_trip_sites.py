@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from api.models import DayTrip
+from api.ordering import rebalance, slot_rank
+
+
+class Command(BaseCommand):
+    help = 'Respaces the site orders of day trips to DAY_TRIP_SITE_ORDER_GAP. Meant to run in the background, ' \
+           'or once after changing the gap.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-gap', type=int, default=None,
+                            help='Only rebalance day trips with two consecutive sites closer than this, '
+                                 'by default every day trip whose orders are not evenly spaced')
+
+    def handle(self, *args, **options):
+        min_gap = options['min_gap']
+        rebalanced = 0
+        for day_trip in DayTrip.objects.order_by('id').iterator():
+            orders = list(day_trip.daytripsite_set.order_by('order').values_list('order', flat=True))
+            if min_gap is not None:
+                needed = any(after - before < min_gap for before, after in zip(orders, orders[1:]))
+            else:
+                needed = orders != [slot_rank(index) for index in range(len(orders))]
+            if needed:
+                rebalance(day_trip.pk)
+                rebalanced += 1
+        self.stdout.write(self.style.SUCCESS('Rebalanced %d day trips' % rebalanced))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api.counters import like_counter
+from api.models import Itinerary
+
+
+class Command(BaseCommand):
+    help = 'Folds sharded like counters back into itineraries by recounting their likes. Meant to run periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Recount the likes of every itinerary, not only the sharded ones')
+
+    def handle(self, *args, **options):
+        itinerary_ids = Itinerary.objects.values_list('id', flat=True) if options['all'] else None
+        updated = like_counter.reconcile(itinerary_ids)
+        self.stdout.write(self.style.SUCCESS('Reconciled likes of %d itineraries' % updated))
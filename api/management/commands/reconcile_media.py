@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from api.media import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recounts the references to the stored media blobs and deletes the unreferenced ones. ' \
+           'Meant to run periodically.'
+
+    def handle(self, *args, **options):
+        referenced, deleted = reconcile()
+        self.stdout.write(self.style.SUCCESS('%d blobs referenced, deleted %d' % (referenced, deleted)))
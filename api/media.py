@@ -0,0 +1,154 @@
+"""
+Reference counts of the files of the content-addressed storage (see api.storage).
+
+Each blob has a MediaBlob row counting the image fields of cities, sites, itineraries, highlights and
+users referring to it, kept up to date by model signals: a saved instance takes a reference to its new
+file and releases its previous one, a deleted instance releases its file. The file, and its variants, are
+deleted once the transaction dropping the last reference commits, unless the file was uploaded again in
+the last `RECENT_FILE_AGE` seconds: the upload stored it under the same name, and the instance about to
+refer to it may not be saved yet.
+
+Updates through querysets skip signals. `reconcile` counts the references again from the tables and
+deletes the blobs no longer referenced.
+"""
+import logging
+import os
+import time
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
+
+from api.images import IMAGE_FIELDS, image_processor
+from api.models import MediaBlob
+from api.storage import is_blob, BLOB_DIRECTORY
+
+logger = logging.getLogger(__name__)
+
+# Seconds during which a blob file without a row is left alone, as it may belong to an upload whose
+# instance is not saved yet. reconcile deletes it afterwards.
+RECENT_FILE_AGE = 600
+
+
+def acquire(name):
+    if not is_blob(name):
+        return
+    with transaction.atomic():
+        if MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + 1):
+            return
+        try:
+            size = default_storage.size(name)
+        except OSError:
+            logger.warning('Referring to the missing blob %s', name)
+            size = 0
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(name=name, size=size, refcount=1)
+        except IntegrityError:
+            # Created concurrently
+            MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+
+
+def is_recent(name):
+    try:
+        return os.path.getmtime(default_storage.path(name)) > time.time() - RECENT_FILE_AGE
+    except OSError:
+        return False
+
+
+def delete_blob(name):
+    if MediaBlob.objects.filter(name=name).exists() or is_recent(name):
+        # Referred to again in the meantime, or uploaded again and about to be
+        return False
+    try:
+        default_storage.delete_blob(name)
+        image_processor.delete_variants(name)
+    except OSError:
+        logger.exception('Could not delete %s', name)
+        return False
+    return True
+
+
+def release(name):
+    if not is_blob(name):
+        return
+    with transaction.atomic():
+        MediaBlob.objects.filter(name=name).update(refcount=F('refcount') - 1)
+        deleted, _ = MediaBlob.objects.filter(name=name, refcount__lte=0).delete()
+    if deleted:
+        transaction.on_commit(lambda: delete_blob(name))
+
+
+def get_field(sender):
+    for model, field in IMAGE_FIELDS:
+        if sender is model:
+            return field
+    return None
+
+
+def remember_name(sender, instance, **kwargs):
+    field = get_field(sender)
+    # Reading a deferred field would query it
+    if field is not None and field not in instance.get_deferred_fields():
+        instance._media_name = getattr(instance, field).name or None
+
+
+def update_references(sender, instance, created=False, update_fields=None, **kwargs):
+    field = get_field(sender)
+    if (update_fields is not None and field not in update_fields) or \
+            (not created and not hasattr(instance, '_media_name')):
+        # Not saved, or loaded without the field so that the previous name is unknown, left to reconcile
+        return
+    name = getattr(instance, field).name or None
+    previous = None if created else instance._media_name
+    if name != previous:
+        acquire(name)
+        release(previous)
+    instance._media_name = name
+
+
+def release_references(sender, instance, **kwargs):
+    field = get_field(sender)
+    release(getattr(instance, field).name or None)
+
+
+def connect_signals():
+    for model, _ in IMAGE_FIELDS:
+        uid = 'media_{}'.format(model.__name__)
+        post_init.connect(remember_name, sender=model, dispatch_uid=uid)
+        post_save.connect(update_references, sender=model, dispatch_uid=uid)
+        post_delete.connect(release_references, sender=model, dispatch_uid=uid)
+
+
+def reconcile():
+    """
+    Sets the reference counts from the image fields, and deletes the unreferenced blobs and blob files.
+    Returns the numbers of referenced and deleted blobs.
+    """
+    with transaction.atomic():
+        # Counted once the rows are locked, so that no reference taken meanwhile is overwritten
+        blobs = dict(MediaBlob.objects.select_for_update().values_list('name', 'refcount'))
+        counts = {}
+        for model, field in IMAGE_FIELDS:
+            for name in model.objects.filter(**{field + '__startswith': BLOB_DIRECTORY + '/'}) \
+                    .values_list(field, flat=True).iterator():
+                counts[name] = counts.get(name, 0) + 1
+        for name, count in counts.items():
+            if name not in blobs:
+                size = default_storage.size(name) if default_storage.exists(name) else 0
+                MediaBlob.objects.create(name=name, size=size, refcount=count)
+            elif blobs[name] != count:
+                MediaBlob.objects.filter(name=name).update(refcount=count)
+        unreferenced = [name for name in blobs if name not in counts]
+        MediaBlob.objects.filter(name__in=unreferenced).delete()
+
+    # Files without a row, left by a crash or by updates skipping signals
+    for directory, _, files in os.walk(default_storage.path(BLOB_DIRECTORY)):
+        for file_name in files:
+            path = os.path.join(directory, file_name)
+            name = os.path.relpath(path, default_storage.location).replace(os.sep, '/')
+            if name not in counts and not file_name.startswith('.upload-'):
+                unreferenced.append(name)
+    deleted = [name for name in set(unreferenced) if delete_blob(name)]
+    return len(counts), len(deleted)
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.9 on 2026-10-17 17:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LikeCounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.SmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('itinerary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='like_shards', to='api.Itinerary')),
+            ],
+            options={
+                'db_table': 'like_counter_shard',
+                'unique_together': {('itinerary', 'shard')},
+            },
+        ),
+    ]
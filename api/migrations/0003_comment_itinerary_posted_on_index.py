@@ -0,0 +1,17 @@
+# Generated by Django 3.0.9 on 2026-10-17 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_like_counter_shard'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['itinerary', 'posted_on'], name='comment_itinera_d6e36f_idx'),
+        ),
+    ]
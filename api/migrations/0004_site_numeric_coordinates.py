@@ -0,0 +1,96 @@
+# Generated by Django 3.0.9 on 2026-10-17 17:58
+
+from decimal import Decimal, InvalidOperation
+
+from django.db import migrations, models
+
+from api.geo import geohash_encode
+
+
+def parse_coordinate(value, limit):
+    try:
+        coordinate = Decimal(value.strip()).quantize(Decimal('0.000001'))
+    except (AttributeError, InvalidOperation):
+        return None
+    return coordinate if -limit <= coordinate <= limit else None
+
+
+def coordinates_to_numbers(apps, schema_editor):
+    Site = apps.get_model('api', 'Site')
+    sites = []
+    for site in Site.objects.only('latitude', 'longitude').iterator():
+        site.latitude_number = parse_coordinate(site.latitude, 90)
+        site.longitude_number = parse_coordinate(site.longitude, 180)
+        if site.latitude_number is not None and site.longitude_number is not None:
+            site.geohash = geohash_encode(float(site.latitude_number), float(site.longitude_number))
+        sites.append(site)
+    Site.objects.bulk_update(sites, ['latitude_number', 'longitude_number', 'geohash'], batch_size=1000)
+
+
+def coordinates_to_strings(apps, schema_editor):
+    Site = apps.get_model('api', 'Site')
+    sites = []
+    for site in Site.objects.only('latitude_number', 'longitude_number').iterator():
+        site.latitude = '' if site.latitude_number is None else str(site.latitude_number)
+        site.longitude = '' if site.longitude_number is None else str(site.longitude_number)
+        sites.append(site)
+    Site.objects.bulk_update(sites, ['latitude', 'longitude'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_comment_itinerary_posted_on_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='latitude_number',
+            field=models.DecimalField(decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='longitude_number',
+            field=models.DecimalField(decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.RunPython(coordinates_to_numbers, coordinates_to_strings),
+        # A default lets the string columns be added back when migrating backwards
+        migrations.AlterField(
+            model_name='site',
+            name='latitude',
+            field=models.CharField(default='', max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='site',
+            name='longitude',
+            field=models.CharField(default='', max_length=15),
+        ),
+        migrations.RemoveField(
+            model_name='site',
+            name='latitude',
+        ),
+        migrations.RemoveField(
+            model_name='site',
+            name='longitude',
+        ),
+        migrations.RenameField(
+            model_name='site',
+            old_name='latitude_number',
+            new_name='latitude',
+        ),
+        migrations.RenameField(
+            model_name='site',
+            old_name='longitude_number',
+            new_name='longitude',
+        ),
+        migrations.AddIndex(
+            model_name='site',
+            index=models.Index(fields=['latitude', 'longitude'], name='site_latitud_3b298f_idx'),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 3.0.9 on 2026-10-17 18:11
+
+from django.db import migrations, models
+from django.db.models import Q
+import django.db.models.deletion
+
+FTS5_SQL = [
+    "CREATE VIRTUAL TABLE search_document_fts USING fts5(title, body, content='search_document', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER search_document_fts_insert AFTER INSERT ON search_document BEGIN "
+    "INSERT INTO search_document_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+    "CREATE TRIGGER search_document_fts_delete AFTER DELETE ON search_document BEGIN "
+    "INSERT INTO search_document_fts(search_document_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); END",
+    "CREATE TRIGGER search_document_fts_update AFTER UPDATE ON search_document BEGIN "
+    "INSERT INTO search_document_fts(search_document_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO search_document_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+]
+
+
+def create_full_text_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE search_document ADD FULLTEXT INDEX search_document_text (title, body)')
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                # Searches fall back to matching in Python
+                return
+        for sql in FTS5_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_full_text_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE search_document DROP INDEX search_document_text')
+    elif connection.vendor == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            schema_editor.execute('DROP TRIGGER IF EXISTS search_document_fts_' + trigger)
+        schema_editor.execute('DROP TABLE IF EXISTS search_document_fts')
+
+
+def index_documents(apps, schema_editor):
+    Site = apps.get_model('api', 'Site')
+    Itinerary = apps.get_model('api', 'Itinerary')
+    SearchDocument = apps.get_model('api', 'SearchDocument')
+    sites = Site.objects.filter(Q(attraction__isnull=False) | Q(restaurant__isnull=False) | Q(hotel__isnull=False))
+    SearchDocument.objects.bulk_create([
+        SearchDocument(kind='site', object_id=site.id, title=site.name,
+                       body='\n'.join((site.description, site.address)),
+                       category=site.site_category, city_id=site.city_id)
+        for site in sites.iterator()
+    ], batch_size=500)
+    SearchDocument.objects.bulk_create([
+        SearchDocument(kind='itinerary', object_id=itinerary.id, title=itinerary.title,
+                       body=itinerary.description, is_public=itinerary.is_public)
+        for itinerary in Itinerary.objects.iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_site_numeric_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('site', 'Site'), ('itinerary', 'Itinerary')], max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('title', models.CharField(max_length=100)),
+                ('body', models.TextField(blank=True)),
+                ('category', models.CharField(blank=True, max_length=30)),
+                ('is_public', models.BooleanField(default=True)),
+                ('city', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.City')),
+            ],
+            options={
+                'db_table': 'search_document',
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+        migrations.RunPython(create_full_text_index, drop_full_text_index),
+        migrations.RunPython(index_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.9 on 2026-10-17 18:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_search_document'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attraction',
+            index=models.Index(fields=['category'], name='attraction_categor_eecd6f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hotel',
+            index=models.Index(fields=['category'], name='hotel_categor_ab4bd3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hotel',
+            index=models.Index(fields=['star_rate'], name='hotel_star_ra_cf0f0c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurant',
+            index=models.Index(fields=['category'], name='restaurant_categor_ecaf14_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurant',
+            index=models.Index(fields=['open_at'], name='restaurant_open_at_bf2555_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='site',
+            index=models.Index(fields=['city', 'site_category'], name='site_city_id_d95b11_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.9 on 2026-10-17 18:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_poi_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='site',
+            name='url',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.9 on 2026-10-17 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_site_url_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='itinerary',
+            name='image',
+            field=models.ImageField(blank=True, default='default.jpeg', null=True, upload_to='itinerary'),
+        ),
+    ]
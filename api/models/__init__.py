@@ -1,3 +1,5 @@
 from .poi import *
 from .itinerary import *
 from .user import *
+from .search import *
+from .media import *
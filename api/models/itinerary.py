@@ -1,6 +1,7 @@
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.urls import reverse
-from imagekit.models.fields import ProcessedImageField
 
 from api.models.poi import Site
 from api.models.user import User
@@ -18,10 +19,9 @@ class Itinerary(models.Model):
         related_name='itineraries',  # author.posts: get all posts belong to this user
     )
     title = models.CharField(max_length=100)
-    image = ProcessedImageField(
+    # Stored as uploaded, resized variants are written in the background (see api.images)
+    image = models.ImageField(
         upload_to='itinerary',
-        format='JPEG',
-        options={'quality': 100},
         blank=True,
         null=True,
         default="default.jpeg"
@@ -77,6 +77,17 @@ class DayTrip(models.Model):
         unique_together = ('itinerary', 'day')
 
 
+class DayTripSiteQuerySet(models.QuerySet):
+    def with_position(self):
+        """
+        Annotates `position`: the dense 0..n-1 index of each site in its day trip,
+        since the stored `order` may be gapped (see api.ordering)
+        """
+        preceding = DayTripSite.objects.filter(day_trip=OuterRef('day_trip'), order__lt=OuterRef('order')) \
+            .order_by().values('day_trip').annotate(count=Count('id')).values('count')
+        return self.annotate(position=Coalesce(Subquery(preceding), 0))
+
+
 class DayTripSite(models.Model):
     """
     Trip: stores single trip on daily basis
@@ -93,6 +104,8 @@ class DayTripSite(models.Model):
     site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name='site_to_day_trip')
     order = models.IntegerField()
 
+    objects = DayTripSiteQuerySet.as_manager()
+
     class Meta:
         db_table = 'day_trip_site'
         unique_together = ('day_trip', 'order')
@@ -132,6 +145,7 @@ class Comment(models.Model):
 
     class Meta:
         db_table = 'comment'
+        indexes = [models.Index(fields=['itinerary', 'posted_on'])]
 
 
 class Like(models.Model):
@@ -147,6 +161,25 @@ class Like(models.Model):
         return 'Like: ' + self.owner.username + ' ' + self.itinerary.title
 
 
+class LikeCounterShard(models.Model):
+    """
+    LikeCounterShard: like count changes of a hot itinerary, spread over several rows
+    so that concurrent likes do not contend on the itinerary row. Folded back into `Itinerary.like`
+    when reconciled.
+    """
+    itinerary = models.ForeignKey(
+        Itinerary, on_delete=models.CASCADE, related_name='like_shards', )
+    shard = models.SmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'like_counter_shard'
+        unique_together = ("itinerary", "shard")
+
+    def __str__(self):
+        return 'Like shard: ' + str(self.itinerary_id) + ' ' + str(self.shard)
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(
         User, null=False, blank=False, on_delete=models.CASCADE, related_name='favorites')
@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class MediaBlob(models.Model):
+    """
+    MediaBlob: a file of the content-addressed storage and how many image fields refer to it, see api.storage
+    """
+    name = models.CharField(max_length=100, unique=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        db_table = 'media_blob'
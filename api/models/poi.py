@@ -1,5 +1,7 @@
 from django.db import models
 
+from api.geo import geohash_encode
+
 
 class City(models.Model):
     country_name = models.CharField(max_length=30)
@@ -23,10 +25,13 @@ class Site(models.Model):
         ('Hotel', 'Hotel'),
     ]
     name = models.CharField(max_length=100)
-    latitude = models.CharField(max_length=15)
-    longitude = models.CharField(max_length=15)
+    latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True)
+    # Kept in step with the coordinates on save, see api.geo
+    geohash = models.CharField(max_length=12, blank=True, default='', editable=False, db_index=True)
     site_category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
-    url = models.CharField(max_length=100)
+    # Identifies the site in the source data, see api.importer
+    url = models.CharField(max_length=100, db_index=True)
     city = models.ForeignKey(City, null=True, on_delete=models.SET_NULL)
     address = models.CharField(max_length=100)
     description = models.TextField()
@@ -35,8 +40,22 @@ class Site(models.Model):
     def __str__(self):
         return self.name
 
+    def update_geohash(self):
+        if self.latitude is None or self.longitude is None:
+            self.geohash = ''
+        else:
+            self.geohash = geohash_encode(float(self.latitude), float(self.longitude))
+
+    def save(self, *args, **kwargs):
+        self.update_geohash()
+        super(Site, self).save(*args, **kwargs)
+
     class Meta:
         db_table = 'site'
+        indexes = [
+            models.Index(fields=['latitude', 'longitude']),
+            models.Index(fields=['city', 'site_category']),
+        ]
 
 
 class Attraction(models.Model):
@@ -48,6 +67,7 @@ class Attraction(models.Model):
 
     class Meta:
         db_table = 'attraction'
+        indexes = [models.Index(fields=['category'])]
 
 
 class Restaurant(models.Model):
@@ -60,6 +80,7 @@ class Restaurant(models.Model):
 
     class Meta:
         db_table = 'restaurant'
+        indexes = [models.Index(fields=['category']), models.Index(fields=['open_at'])]
 
 
 class Hotel(models.Model):
@@ -72,3 +93,4 @@ class Hotel(models.Model):
 
     class Meta:
         db_table = 'hotel'
+        indexes = [models.Index(fields=['category']), models.Index(fields=['star_rate'])]
@@ -0,0 +1,31 @@
+from django.db import models
+
+from api.models.poi import City
+
+
+class SearchDocument(models.Model):
+    """
+    SearchDocument: the searchable text of a site or an itinerary, see api.search
+    """
+    SITE = 'site'
+    ITINERARY = 'itinerary'
+    KIND_CHOICES = [
+        (SITE, 'Site'),
+        (ITINERARY, 'Itinerary'),
+    ]
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    title = models.CharField(max_length=100)
+    body = models.TextField(blank=True)
+    # Sites only
+    category = models.CharField(max_length=30, blank=True)
+    city = models.ForeignKey(City, null=True, on_delete=models.SET_NULL)
+    # Itineraries only, private itineraries are not returned
+    is_public = models.BooleanField(default=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.kind, self.object_id)
+
+    class Meta:
+        db_table = 'search_document'
+        unique_together = ('kind', 'object_id')
@@ -0,0 +1,206 @@
+"""
+Ordering of the sites of a day trip.
+
+`DayTripSite.order` is unique per day trip, and databases check that constraint row by row during an
+UPDATE, so a range of rows cannot simply be shifted by one in place. Rows are instead moved in two
+set-based statements: the affected rows are parked at distinct negative orders, then flipped back.
+
+With `DAY_TRIP_SITE_ORDER_GAP` above 1, orders are gapped ranks instead of dense indexes: a site moved
+or inserted between two others takes a rank in the gap between them, so it is the only row written.
+Clients still see dense indexes (`DayTripSite.objects.with_position()`). When a gap runs out, the
+day trip is rebalanced to evenly spaced ranks. Ranks are never negative.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Case, When, Value, IntegerField
+
+from api.models import DayTrip, DayTripSite
+
+
+def get_gap():
+    return getattr(settings, 'DAY_TRIP_SITE_ORDER_GAP', 1)
+
+
+def _park(sites, orders=None, delta=0):
+    """
+    Parks `sites` at the negative image of their new order: `orders[id]` when given, else `order + delta`
+    """
+    parked = -(F('order') + delta) - 1
+    if orders:
+        parked = Case(*[When(pk=pk, then=Value(-order - 1)) for pk, order in orders.items()],
+                      default=parked, output_field=IntegerField())
+    sites.update(order=parked)
+
+
+def _unpark(day_trip_id):
+    DayTripSite.objects.filter(day_trip_id=day_trip_id, order__lt=0).update(order=-F('order') - 1)
+
+
+def _lock(day_trip_id):
+    # Serializes gapped writes of a day trip, which pick a rank from the ranks they read
+    list(DayTrip.objects.select_for_update().filter(pk=day_trip_id).values_list('id'))
+
+
+def _ranks_between(before, after, count):
+    """
+    Returns `count` distinct ranks strictly between `before` and `after` (None for no bound), or None
+    """
+    if before is None:
+        before = -1
+    if after is None:
+        return [before + get_gap() * (i + 1) for i in range(count)]
+    step = (after - before) // (count + 1)
+    if step < 1:
+        return None
+    return [before + step * (i + 1) for i in range(count)]
+
+
+def slot_rank(slot):
+    """
+    Returns the order of the site at index `slot` of an evenly spaced day trip
+    """
+    gap = get_gap()
+    # Gapped ranks start one gap above 0, leaving room before the first site
+    return (slot + 1) * gap if gap > 1 else slot
+
+
+def _spread(day_trip_id, ids):
+    """
+    Rewrites the orders of a day trip to evenly spaced ranks following `ids`, in which None marks
+    a free slot. Returns the ranks of the free slots.
+    """
+    orders = {pk: slot_rank(slot) for slot, pk in enumerate(ids) if pk is not None}
+    if orders:
+        _park(DayTripSite.objects.filter(day_trip_id=day_trip_id), orders)
+        _unpark(day_trip_id)
+    return [slot_rank(slot) for slot, pk in enumerate(ids) if pk is None]
+
+
+def _neighbours(day_trip_id, index, exclude=None):
+    """
+    Returns the ordered (id, order) rows of a day trip, the clamped index and the ranks around it
+    """
+    sites = DayTripSite.objects.filter(day_trip_id=day_trip_id)
+    if exclude is not None:
+        sites = sites.exclude(pk=exclude)
+    rows = list(sites.order_by('order').values_list('id', 'order'))
+    index = max(0, min(index, len(rows)))
+    before = rows[index - 1][1] if index > 0 else None
+    after = rows[index][1] if index < len(rows) else None
+    return rows, index, before, after
+
+
+def rebalance(day_trip_id):
+    """
+    Rewrites the orders of a day trip to evenly spaced ranks, or dense indexes when the gap is 1
+    """
+    with transaction.atomic():
+        _lock(day_trip_id)
+        ids = DayTripSite.objects.filter(day_trip_id=day_trip_id).order_by('order').values_list('id', flat=True)
+        _spread(day_trip_id, list(ids))
+
+
+def insert_orders(day_trip_id, index, count=1):
+    """
+    Makes room for `count` sites at dense index `index` and returns the orders to create them with
+    """
+    with transaction.atomic():
+        if get_gap() <= 1:
+            sites = DayTripSite.objects.filter(day_trip_id=day_trip_id)
+            index = max(0, min(index, sites.count()))
+            shifted = sites.filter(order__gte=index)
+            if shifted.exists():
+                _park(shifted, delta=count)
+                _unpark(day_trip_id)
+            return list(range(index, index + count))
+
+        _lock(day_trip_id)
+        rows, index, before, after = _neighbours(day_trip_id, index)
+        orders = _ranks_between(before, after, count)
+        if orders is None:
+            ids = [pk for pk, order in rows]
+            orders = _spread(day_trip_id, ids[:index] + [None] * count + ids[index:])
+        return orders
+
+
+def move_site(day_trip_site, new_index):
+    """
+    Moves a site to dense index `new_index`
+    """
+    with transaction.atomic():
+        if get_gap() > 1:
+            _move_ranked(day_trip_site, new_index)
+            return
+
+        sites = DayTripSite.objects.filter(day_trip_id=day_trip_site.day_trip_id)
+        new_index = max(0, min(new_index, sites.count() - 1))
+        original_index = day_trip_site.order
+        if new_index == original_index:
+            return
+
+        if new_index > original_index:
+            shifted, delta = sites.filter(order__gt=original_index, order__lte=new_index), -1
+        else:
+            shifted, delta = sites.filter(order__gte=new_index, order__lt=original_index), 1
+        _park(shifted | sites.filter(pk=day_trip_site.pk), {day_trip_site.pk: new_index}, delta)
+        _unpark(day_trip_site.day_trip_id)
+        day_trip_site.order = new_index
+
+
+def _move_ranked(day_trip_site, new_index):
+    _lock(day_trip_site.day_trip_id)
+    rows, new_index, before, after = _neighbours(day_trip_site.day_trip_id, new_index, exclude=day_trip_site.pk)
+    if (before is None or before < day_trip_site.order) and (after is None or day_trip_site.order < after):
+        return
+
+    orders = _ranks_between(before, after, 1)
+    if orders is None:
+        ids = [pk for pk, order in rows]
+        ids.insert(new_index, day_trip_site.pk)
+        _spread(day_trip_site.day_trip_id, ids)
+        day_trip_site.order = slot_rank(new_index)
+        return
+    DayTripSite.objects.filter(pk=day_trip_site.pk).update(order=orders[0])
+    day_trip_site.order = orders[0]
+
+
+def _close_gap(day_trip_id, order):
+    # Gapped ranks need no rewrite when a site leaves
+    if get_gap() <= 1:
+        _park(DayTripSite.objects.filter(day_trip_id=day_trip_id, order__gt=order), delta=-1)
+        _unpark(day_trip_id)
+
+
+def remove_site(day_trip_site):
+    """
+    Deletes a site, closing the gap it leaves when orders are dense
+    """
+    with transaction.atomic():
+        day_trip_site.delete()
+        _close_gap(day_trip_site.day_trip_id, day_trip_site.order)
+
+
+def move_to_day_trip(day_trip_site, day_trip_id, new_index):
+    """
+    Moves a site to dense index `new_index` of another day trip, closing the gap it leaves in its own
+    """
+    with transaction.atomic():
+        previous_day_trip_id, previous_order = day_trip_site.day_trip_id, day_trip_site.order
+        order, = insert_orders(day_trip_id, new_index)
+        DayTripSite.objects.filter(pk=day_trip_site.pk).update(day_trip_id=day_trip_id, order=order)
+        day_trip_site.day_trip_id, day_trip_site.order = day_trip_id, order
+        _close_gap(previous_day_trip_id, previous_order)
+
+
+def reorder_sites(day_trip, day_trip_site_ids):
+    """
+    Applies a full new order, given as the list of all the day trip site ids of the day trip.
+    Raises ValueError if the ids are not exactly those of the day trip.
+    """
+    with transaction.atomic():
+        sites = DayTripSite.objects.filter(day_trip=day_trip)
+        current_ids = set(sites.select_for_update().values_list('id', flat=True))
+        if len(day_trip_site_ids) != len(current_ids) or set(day_trip_site_ids) != current_ids:
+            raise ValueError('The new order must list every site of the day trip exactly once')
+
+        _spread(day_trip.pk, day_trip_site_ids)
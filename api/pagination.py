@@ -0,0 +1,112 @@
+import base64
+import datetime
+import json
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    Keeps the full microsecond precision of datetimes, which DjangoJSONEncoder truncates
+    """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+class KeysetPagination(object):
+    """
+    Keyset (cursor) pagination: pages are fetched with `WHERE key > last key` instead of OFFSET,
+    so fetching a page costs the same regardless of its depth.
+
+    The ordering must end with a unique field (usually `id`) so that the key is stable.
+    The cursor of the next page is opaque to clients and returned in the `X-Next-Cursor` and `Link` headers.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+
+    def __init__(self, ordering, default_limit=20, max_limit=100):
+        self.ordering = tuple(ordering)
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+        self.request = None
+        self.next_cursor = None
+
+    @property
+    def fields(self):
+        return [field.lstrip('-') for field in self.ordering]
+
+    def get_limit(self):
+        limit = self.request.query_params.get(self.limit_query_param, self.default_limit)
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise ValidationError({self.limit_query_param: 'A valid integer is required.'})
+        if limit < 1:
+            raise ValidationError({self.limit_query_param: 'Ensure this value is greater than or equal to 1.'})
+        if self.max_limit is not None:
+            limit = min(limit, self.max_limit)
+        return limit
+
+    def encode_cursor(self, instance):
+        values = [getattr(instance, field) for field in self.fields]
+        cursor = json.dumps({'k': self.fields, 'v': values}, cls=CursorEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, queryset, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            if data['k'] != self.fields or len(data['v']) != len(self.fields):
+                raise ValueError
+            return [queryset.model._meta.get_field(field).to_python(value)
+                    for field, value in zip(self.fields, data['v'])]
+        except (TypeError, ValueError, KeyError, UnicodeError, DjangoValidationError):
+            raise ValidationError({self.cursor_query_param: 'Invalid cursor.'})
+
+    def get_after_filter(self, values):
+        """
+        Builds `(a > x) OR (a = x AND b > y) OR ...` following the direction of each ordering field
+        """
+        condition = Q()
+        equal = Q()
+        for ordering, field, value in zip(self.ordering, self.fields, values):
+            lookup = '__lt' if ordering.startswith('-') else '__gt'
+            condition |= equal & Q(**{field + lookup: value})
+            equal &= Q(**{field: value})
+        return condition
+
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        limit = self.get_limit()
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param, None)
+        if cursor:
+            queryset = queryset.filter(self.get_after_filter(self.decode_cursor(queryset, cursor)))
+
+        page = list(queryset[:limit + 1])
+        if len(page) > limit:
+            page = page[:limit]
+            self.next_cursor = self.encode_cursor(page[-1])
+        else:
+            self.next_cursor = None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        headers = {}
+        if self.next_cursor is not None:
+            headers['X-Next-Cursor'] = self.next_cursor
+            headers['Link'] = '<{}>; rel="next"'.format(self.get_next_link())
+        return Response(data, headers=headers)
@@ -0,0 +1,161 @@
+"""
+Full-text search over sites and itineraries.
+
+Every attraction, restaurant, hotel and itinerary has a SearchDocument holding its searchable text, kept
+in sync by the serializers that write them, and removed by post_delete receivers, so that deletes through
+the admin or cascading from a user remove it as well. The documents are indexed by the database: an FTS5 table
+maintained by triggers on SQLite, a FULLTEXT index on MySQL (see the 0005 migration). Other databases, or
+SQLite builds without FTS5, fall back to substring matching and ranking in Python, which scans the
+documents and is only meant for development and tests.
+
+Every word of the query must appear in the title or the body, as a word prefix. Matches in the title
+weigh more than matches in the body.
+"""
+import re
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.db.models.expressions import RawSQL
+
+from api.models import SearchDocument, DayTripSite, Site, Itinerary, Attraction, Restaurant, Hotel
+
+FTS5_TABLE = 'search_document_fts'
+TITLE_WEIGHT = 10.0
+MAX_TERMS = 10
+
+_fts5_tables = {}
+
+
+def tokenize(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def get_backend():
+    if connection.vendor == 'mysql':
+        return 'mysql'
+    if connection.vendor == 'sqlite':
+        if connection.alias not in _fts5_tables:
+            _fts5_tables[connection.alias] = FTS5_TABLE in connection.introspection.table_names()
+        if _fts5_tables[connection.alias]:
+            return 'fts5'
+    return 'python'
+
+
+def site_fields(site):
+    return dict(title=site.name, body='\n'.join((site.description, site.address)),
+                category=site.site_category, city_id=site.city_id)
+
+
+def itinerary_fields(itinerary):
+    return dict(title=itinerary.title, body=itinerary.description, is_public=itinerary.is_public)
+
+
+def index_site(site):
+    SearchDocument.objects.update_or_create(kind=SearchDocument.SITE, object_id=site.pk, defaults=site_fields(site))
+
+
+def index_itinerary(itinerary):
+    SearchDocument.objects.update_or_create(kind=SearchDocument.ITINERARY, object_id=itinerary.pk,
+                                            defaults=itinerary_fields(itinerary))
+
+
+def index_sites(sites):
+    """
+    Indexes many sites at once, replacing their documents
+    """
+    SearchDocument.objects.filter(kind=SearchDocument.SITE, object_id__in=[site.pk for site in sites]).delete()
+    SearchDocument.objects.bulk_create([
+        SearchDocument(kind=SearchDocument.SITE, object_id=site.pk, **site_fields(site)) for site in sites
+    ], batch_size=500)
+
+
+def remove_document(kind, object_id):
+    SearchDocument.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def remove_deleted_document(sender, instance, **kwargs):
+    # Attractions, restaurants and hotels have the id of their site
+    remove_document(SearchDocument.ITINERARY if sender is Itinerary else SearchDocument.SITE, instance.pk)
+
+
+def connect_signals():
+    for model in (Site, Attraction, Restaurant, Hotel, Itinerary):
+        post_delete.connect(remove_deleted_document, sender=model,
+                            dispatch_uid='search_{}'.format(model.__name__))
+
+
+def rebuild_index():
+    """
+    Indexes every attraction, restaurant, hotel and itinerary again, dropping the documents of deleted ones.
+    Returns the number of documents.
+    """
+    sites = Site.objects.filter(Q(attraction__isnull=False) | Q(restaurant__isnull=False) | Q(hotel__isnull=False))
+    with transaction.atomic():
+        SearchDocument.objects.all().delete()
+        SearchDocument.objects.bulk_create([
+            SearchDocument(kind=SearchDocument.SITE, object_id=site.pk, **site_fields(site))
+            for site in sites.iterator()
+        ], batch_size=500)
+        SearchDocument.objects.bulk_create([
+            SearchDocument(kind=SearchDocument.ITINERARY, object_id=itinerary.pk, **itinerary_fields(itinerary))
+            for itinerary in Itinerary.objects.iterator()
+        ], batch_size=500)
+    return SearchDocument.objects.count()
+
+
+def get_documents(kind=None, category=None, city=None):
+    """
+    Returns the searchable documents, of a kind, of sites of a category, of sites in a city or itineraries
+    visiting it
+    """
+    documents = SearchDocument.objects.filter(Q(kind=SearchDocument.SITE) | Q(is_public=True))
+    if kind is not None:
+        documents = documents.filter(kind=kind)
+    if category is not None:
+        documents = documents.filter(kind=SearchDocument.SITE, category=category)
+    if city is not None:
+        visiting = DayTripSite.objects.filter(site__city_id=city).values('day_trip__itinerary_id')
+        documents = documents.filter(Q(kind=SearchDocument.SITE, city_id=city) |
+                                     Q(kind=SearchDocument.ITINERARY, object_id__in=visiting))
+    return documents
+
+
+def search(query, kind=None, category=None, city=None, limit=20, offset=0):
+    """
+    Returns the documents matching a query, best first, with their relevance in `score`
+    """
+    terms = tokenize(query)
+    if not terms:
+        return []
+    documents = get_documents(kind, category, city)
+    backend = get_backend()
+
+    if backend == 'fts5':
+        match = ' '.join('"{}"*'.format(term) for term in terms)
+        documents = documents.extra(
+            tables=[FTS5_TABLE],
+            where=['{0}.rowid = search_document.id'.format(FTS5_TABLE), '{0} MATCH %s'.format(FTS5_TABLE)],
+            params=[match],
+            select={'score': '-bm25({0}, %s, 1.0)'.format(FTS5_TABLE)},
+            select_params=[TITLE_WEIGHT],
+        )
+        return list(documents.order_by('-score', 'id')[offset:offset + limit])
+
+    if backend == 'mysql':
+        match = ' '.join('+{}*'.format(term) for term in terms)
+        documents = documents.annotate(
+            score=RawSQL('MATCH (search_document.title, search_document.body) AGAINST (%s IN BOOLEAN MODE)',
+                         [match]),
+        ).filter(score__gt=0)
+        return list(documents.order_by('-score', 'id')[offset:offset + limit])
+
+    for term in terms:
+        documents = documents.filter(Q(title__icontains=term) | Q(body__icontains=term))
+    results = list(documents)
+    for document in results:
+        title, body = document.title.lower(), document.body.lower()
+        document.score = sum(TITLE_WEIGHT * title.count(term) + body.count(term) for term in terms) / \
+            (1 + len(body) / 1000.0)
+    results.sort(key=lambda document: (-document.score, document.id))
+    return results[offset:offset + limit]
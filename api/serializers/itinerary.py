@@ -1,11 +1,29 @@
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Count, Min
+from django.urls import reverse
 from rest_framework import serializers
 
+from api.counters import like_counter
+from api.images import ImageVariantsField
 from api.models import DayTripSite, DayTrip, Comment, Like, Itinerary, Highlight, Featured, Site
+from api.pagination import KeysetPagination
+from api.search import index_itinerary
 from api.serializers.poi import SiteReadSerializer
+from api.serializers.sparse import SparseFieldsetsMixin
+
+# Comments are listed newest first
+COMMENT_ORDERING = ('-posted_on', '-id')
 
 
-class DayTripSiteReadSerializer(serializers.ModelSerializer):
+class DayTripSiteReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     site = SiteReadSerializer(read_only=True)
+    order = serializers.SerializerMethodField()
+
+    def get_order(self, instance):
+        # Stored orders may be gapped ranks, clients always see the dense index in the day trip
+        return getattr(instance, 'position', instance.order)
 
     class Meta:
         model = DayTripSite
@@ -19,14 +37,31 @@ class DayTripSiteWriteSerializer(serializers.ModelSerializer):
         model = DayTripSite
         fields = '__all__'
         read_only_fields = ('owner',)
+        # `order` is the index to insert or move the site at, not the stored order (see api.ordering)
+        validators = []
 
 
-class DayTripSerializer(serializers.ModelSerializer):
-    sites = serializers.SerializerMethodField()
+class DayTripSiteBulkSerializer(serializers.Serializer):
+    """
+    Several sites to add to a day trip, at index `order` or at the end
+    """
+    day_trip = serializers.PrimaryKeyRelatedField(queryset=DayTrip.objects.all())
+    sites = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    order = serializers.IntegerField(required=False, min_value=0)
 
-    def get_sites(self, instance):
-        sites = DayTripSite.objects.filter(day_trip=instance).order_by('order')
-        return DayTripSiteReadSerializer(sites, many=True).data
+    def validate_sites(self, value):
+        found = set(Site.objects.filter(pk__in=value).values_list('id', flat=True))
+        missing = [site_id for site_id in value if site_id not in found]
+        if missing:
+            raise serializers.ValidationError('Invalid pk "{}" - object does not exist.'.format(missing[0]))
+        return value
+
+
+class DayTripSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    """
+    Day trip with its sites, read from the ordered `daytripsite_set` prefetched by the viewset
+    """
+    sites = DayTripSiteReadSerializer(source='daytripsite_set', many=True, read_only=True)
 
     class Meta:
         model = DayTrip
@@ -34,44 +69,170 @@ class DayTripSerializer(serializers.ModelSerializer):
         read_only_fields = ('owner',)
 
 
-class ItinerarySerializer(serializers.ModelSerializer):
-    image = serializers.ImageField(required=False)
+def get_itinerary_locations(itinerary_ids):
+    """
+    Rank the cities visited by each itinerary with a single grouped query.
+    Cities are ordered by number of sites, ties keep the order they are first visited in.
+    """
+    locations = {itinerary_id: dict() for itinerary_id in itinerary_ids}
+    rows = DayTripSite.objects.filter(day_trip__itinerary_id__in=itinerary_ids, site__city__isnull=False) \
+        .values('day_trip__itinerary_id', 'day_trip_id', 'site__city__city_name') \
+        .annotate(count=Count('id'), first=Min('id')) \
+        .order_by('day_trip_id', 'first')
+    for row in rows:
+        city_counts = locations[row['day_trip__itinerary_id']]
+        city = row['site__city__city_name']
+        city_counts[city] = city_counts.get(city, 0) + row['count']
+    return {itinerary_id: sorted(city_counts, key=city_counts.get, reverse=True)
+            for itinerary_id, city_counts in locations.items()}
+
+
+def get_liked_itineraries(itinerary_ids, request):
+    """
+    Return the subset of itinerary ids liked by the requesting user with a single query
+    """
+    if request is None or request.user.is_anonymous:
+        return set()
+    return set(Like.objects.filter(itinerary_id__in=itinerary_ids, owner=request.user)
+               .values_list('itinerary_id', flat=True))
+
+
+def get_itinerary_context(itineraries, request, fields=('locations', 'is_liked', 'like')):
+    """
+    Precompute `locations`, `is_liked` and the pending likes for a page of itineraries, to be merged into the
+    serializer context. Only the given fields are computed.
+    """
+    itinerary_ids = [itinerary.id for itinerary in itineraries]
+    context = dict()
+    if 'locations' in fields:
+        context['itinerary_locations'] = get_itinerary_locations(itinerary_ids)
+    if 'is_liked' in fields:
+        context['liked_itineraries'] = get_liked_itineraries(itinerary_ids, request)
+    if 'like' in fields:
+        context['itinerary_pending_likes'] = like_counter.pending(itinerary_ids)
+    return context
+
+
+class PendingLikesMixin(object):
+    """
+    Adds the likes of hot itineraries still counted in shards (see api.counters) to `like`
+    """
+
+    def to_representation(self, instance):
+        data = super(PendingLikesMixin, self).to_representation(instance)
+        if 'like' in data:
+            pending = self.context['itinerary_pending_likes'] if 'itinerary_pending_likes' in self.context \
+                else like_counter.pending([instance.id])
+            data['like'] += pending.get(instance.id, 0)
+        return data
+
+
+class ItineraryListSerializer(serializers.ListSerializer):
+    """
+    Serializes a page of itineraries with a fixed number of queries, regardless of the page size
+    """
+
+    def get_itineraries(self, instances):
+        return instances
+
+    def get_itinerary_serializer(self):
+        return self.child
+
+    def to_representation(self, data):
+        instances = list(data.all() if hasattr(data, 'all') else data)
+        serializer = self.get_itinerary_serializer()
+        if serializer is not None:
+            self.context.update(get_itinerary_context(
+                self.get_itineraries(instances), self.context.get('request'), serializer.fields))
+        return super(ItineraryListSerializer, self).to_representation(instances)
+
+
+class ItinerarySerializer(PendingLikesMixin, SparseFieldsetsMixin, serializers.ModelSerializer):
+    image = ImageVariantsField(required=False)
     is_liked = serializers.SerializerMethodField()
     locations = serializers.SerializerMethodField()
 
     def get_is_liked(self, obj):
-        if 'request' not in self.context:
-            return False
-        user = self.context['request'].user
-        if user.is_anonymous:
-            return False
-        else:
-            likes = Like.objects.filter(itinerary=obj, owner=user)
-            return len(likes) > 0
+        if 'liked_itineraries' in self.context:
+            return obj.id in self.context['liked_itineraries']
+        return obj.id in get_liked_itineraries([obj.id], self.context.get('request'))
 
     def get_locations(self, obj):
-        locations = dict()
-        day_trips = DayTrip.objects.filter(itinerary_id=obj.id)
-        for day_trip in day_trips:
-            for site in day_trip.sites.all():
-                city = site.city.city_name
-                locations[city] = locations.get(city, 0) + 1
-        sorted_locations = sorted(locations, key=locations.get, reverse=True)
-        return sorted_locations
+        if 'itinerary_locations' in self.context:
+            return self.context['itinerary_locations'].get(obj.id, [])
+        return get_itinerary_locations([obj.id])[obj.id]
+
+    def create(self, validated_data):
+        itinerary = super(ItinerarySerializer, self).create(validated_data)
+        index_itinerary(itinerary)
+        return itinerary
+
+    def update(self, instance, validated_data):
+        itinerary = super(ItinerarySerializer, self).update(instance, validated_data)
+        index_itinerary(itinerary)
+        return itinerary
 
     class Meta:
         model = Itinerary
         fields = '__all__'
         read_only_fields = ('view', 'owner', 'like', 'is_liked')
+        list_serializer_class = ItineraryListSerializer
 
 
 class ItineraryDetailSerializer(ItinerarySerializer):
+    """
+    Itinerary with its newest comments, and in `comments_next` the link to the following ones
+    """
     comments = serializers.SerializerMethodField()
+    comments_next = serializers.SerializerMethodField()
+
+    def __init__(self, *args, **kwargs):
+        super(ItineraryDetailSerializer, self).__init__(*args, **kwargs)
+        self._comment_pages = {}
+
+    def get_comment_page(self, obj):
+        pages = self._comment_pages
+        if obj.id not in pages:
+            # A page needs a last comment to point the cursor after
+            limit = max(getattr(settings, 'ITINERARY_DETAIL_COMMENTS', 10), 1)
+            comments = list(Comment.objects.filter(itinerary=obj).order_by(*COMMENT_ORDERING)[:limit + 1])
+            next_cursor = KeysetPagination(COMMENT_ORDERING).encode_cursor(comments[limit - 1]) \
+                if len(comments) > limit else None
+            pages[obj.id] = (comments[:limit], next_cursor)
+        return pages[obj.id]
 
     def get_comments(self, obj):
-        queryset = Comment.objects.filter(itinerary=obj)
-        serializer = CommentSerializer(queryset, many=True)
-        return serializer.data
+        comments, next_cursor = self.get_comment_page(obj)
+        return CommentSerializer(comments, many=True).data
+
+    def get_comments_next(self, obj):
+        comments, next_cursor = self.get_comment_page(obj)
+        if next_cursor is None:
+            return None
+        url = reverse('comment-list') + '?' + urlencode({'itinerary': obj.id, 'cursor': next_cursor})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
+    class Meta:
+        model = Itinerary
+        fields = '__all__'
+        read_only_fields = ('view', 'owner', 'like', 'is_liked')
+
+
+class DayTripFullSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    """
+    Day trip with its sites, read from the ordered `daytripsite_set` prefetched by the caller
+    """
+    sites = DayTripSiteReadSerializer(source='daytripsite_set', many=True, read_only=True)
+
+    class Meta:
+        model = DayTrip
+        fields = '__all__'
+        read_only_fields = ('owner',)
+
+
+class ItineraryFullSerializer(ItineraryDetailSerializer):
+    day_trips = DayTripFullSerializer(source='daytrip_set', many=True, read_only=True)
 
     class Meta:
         model = Itinerary
@@ -79,8 +240,8 @@ class ItineraryDetailSerializer(ItinerarySerializer):
         read_only_fields = ('view', 'owner', 'like', 'is_liked')
 
 
-class HighlightSerializer(serializers.ModelSerializer):
-    photo = serializers.ImageField(required=False)
+class HighlightSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    photo = ImageVariantsField(required=False)
 
     class Meta:
         model = Highlight
@@ -93,31 +254,86 @@ class FeaturedSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class FeaturedReadSerializer(serializers.ModelSerializer):
+class RelatedItineraryListSerializer(ItineraryListSerializer):
+    """
+    Batches the itineraries of a page of objects related to one itinerary, such as featured or likes
+    """
+
+    def get_itineraries(self, instances):
+        return [instance.itinerary for instance in instances]
+
+    def get_itinerary_serializer(self):
+        return self.child.fields.get('itinerary', None)
+
+
+class FeaturedReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     itinerary = ItinerarySerializer()
 
     class Meta:
         model = Featured
         fields = '__all__'
+        list_serializer_class = RelatedItineraryListSerializer
 
 
-class LikeSerializer(serializers.ModelSerializer):
+class LikeSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = '__all__'
         read_only_fields = ('owner',)
 
 
-class LikeDetailSerializer(serializers.ModelSerializer):
+class LikeDetailSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     itinerary = ItineraryDetailSerializer()
 
     class Meta:
         model = Like
         fields = '__all__'
         read_only_fields = ('owner',)
+        list_serializer_class = RelatedItineraryListSerializer
+
+
+class ItineraryCardSerializer(PendingLikesMixin, SparseFieldsetsMixin, serializers.ModelSerializer):
+    """
+    Compact itinerary for listings: counts and top cities instead of the detail tree.
+    Expects `comment_count` to be annotated.
+    """
+    image = ImageVariantsField(read_only=True)
+    comment_count = serializers.IntegerField(read_only=True)
+    locations = serializers.SerializerMethodField()
+
+    def get_locations(self, obj):
+        if 'itinerary_locations' in self.context:
+            return self.context['itinerary_locations'].get(obj.id, [])
+        return get_itinerary_locations([obj.id])[obj.id]
+
+    class Meta:
+        model = Itinerary
+        fields = ('id', 'title', 'image', 'view', 'like', 'comment_count', 'locations')
+
+
+class LikeCardListSerializer(RelatedItineraryListSerializer):
+    def get_itineraries(self, instances):
+        itineraries = super(LikeCardListSerializer, self).get_itineraries(instances)
+        for like, itinerary in zip(instances, itineraries):
+            itinerary.comment_count = like.itinerary_comment_count
+        return itineraries
+
+
+class LikeCardSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    """
+    Like with a compact itinerary card. Expects the itinerary to be selected with the like and
+    `itinerary_comment_count` to be annotated.
+    """
+    itinerary = ItineraryCardSerializer(read_only=True)
+
+    class Meta:
+        model = Like
+        fields = '__all__'
+        read_only_fields = ('owner',)
+        list_serializer_class = LikeCardListSerializer
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = '__all__'
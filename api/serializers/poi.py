@@ -1,25 +1,49 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.core.exceptions import ObjectDoesNotExist
 from rest_framework import serializers
 from rest_framework.utils import model_meta
 
+from api.images import ImageVariantsField
 from api.models import City, Site, Attraction, Restaurant, Hotel
+from api.search import index_site
+from api.serializers.sparse import SparseFieldsetsMixin
 
 
-class CitySerializer(serializers.ModelSerializer):
-    photo = serializers.ImageField(required=False)
+class CitySerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    photo = ImageVariantsField(required=False)
 
     class Meta:
         model = City
         fields = '__all__'
 
 
+class CoordinateField(serializers.DecimalField):
+    """
+    Latitude or longitude in degrees, rounded to the 6 decimal places stored rather than rejected
+    """
+
+    def __init__(self, bound, **kwargs):
+        super(CoordinateField, self).__init__(max_digits=9, decimal_places=6, min_value=-bound, max_value=bound,
+                                              rounding=ROUND_HALF_UP, **kwargs)
+
+    def validate_precision(self, value):
+        return super(CoordinateField, self).validate_precision(
+            value.quantize(Decimal('0.000001'), rounding=ROUND_HALF_UP))
+
+
 class SiteWriteSerializer(serializers.ModelSerializer):
+    latitude = CoordinateField(90, required=False, allow_null=True)
+    longitude = CoordinateField(180, required=False, allow_null=True)
+
     class Meta:
         model = Site
         fields = '__all__'
 
 
-class SiteReadSerializer(serializers.ModelSerializer):
+class SiteReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     city = CitySerializer(read_only=True)
+    photo = ImageVariantsField(read_only=True)
 
     class Meta:
         model = Site
@@ -33,6 +57,7 @@ class AttractionSerializer(serializers.ModelSerializer):
         site_data = validated_data.pop('site')
         site_obj = Site.objects.create(**site_data)
         attraction = Attraction.objects.create(site=site_obj, **validated_data)
+        index_site(site_obj)
         return attraction
 
     def update(self, instance, validated_data):
@@ -43,6 +68,7 @@ class AttractionSerializer(serializers.ModelSerializer):
         attraction_info = model_meta.get_field_info(instance.site)
 
         update_attributes(site_data, instance.site, site_info)
+        index_site(instance.site)
         update_attributes(validated_data, instance, attraction_info)
 
         return instance
@@ -53,7 +79,7 @@ class AttractionSerializer(serializers.ModelSerializer):
         read_only_fields = ('site',)
 
 
-class AttractionReadSerializer(serializers.ModelSerializer):
+class AttractionReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     site = SiteReadSerializer()
 
     class Meta:
@@ -69,6 +95,7 @@ class RestaurantSerializer(serializers.ModelSerializer):
         site_data = validated_data.pop('site')
         site_obj = Site.objects.create(**site_data)
         restaurant = Restaurant.objects.create(site=site_obj, **validated_data)
+        index_site(site_obj)
         return restaurant
 
     def update(self, instance, validated_data):
@@ -79,6 +106,7 @@ class RestaurantSerializer(serializers.ModelSerializer):
         restaurant_info = model_meta.get_field_info(instance.site)
 
         update_attributes(site_data, instance.site, site_info)
+        index_site(instance.site)
         update_attributes(validated_data, instance, restaurant_info)
 
         return instance
@@ -89,7 +117,7 @@ class RestaurantSerializer(serializers.ModelSerializer):
         read_only_fields = ('site',)
 
 
-class RestaurantReadSerializer(serializers.ModelSerializer):
+class RestaurantReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     site = SiteReadSerializer()
 
     class Meta:
@@ -105,6 +133,7 @@ class HotelSerializer(serializers.ModelSerializer):
         site_data = validated_data.pop('site')
         site_obj = Site.objects.create(**site_data)
         hotel = Hotel.objects.create(site=site_obj, **validated_data)
+        index_site(site_obj)
         return hotel
 
     def update(self, instance, validated_data):
@@ -115,6 +144,7 @@ class HotelSerializer(serializers.ModelSerializer):
         hotel_info = model_meta.get_field_info(instance.site)
 
         update_attributes(site_data, instance.site, site_info)
+        index_site(instance.site)
         update_attributes(validated_data, instance, hotel_info)
 
         return instance
@@ -125,7 +155,7 @@ class HotelSerializer(serializers.ModelSerializer):
         read_only_fields = ('site',)
 
 
-class HotelReadSerializer(serializers.ModelSerializer):
+class HotelReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     site = SiteReadSerializer()
 
     class Meta:
@@ -134,6 +164,50 @@ class HotelReadSerializer(serializers.ModelSerializer):
         read_only_fields = ('site',)
 
 
+class AttractionDetailsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Attraction
+        exclude = ('site',)
+
+
+class RestaurantDetailsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Restaurant
+        exclude = ('site',)
+
+
+class HotelDetailsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Hotel
+        exclude = ('site',)
+
+
+class SiteDetailReadSerializer(SiteReadSerializer):
+    """
+    Site with the fields of its attraction, restaurant or hotel in `details`. The subtypes should be
+    selected with the site (`select_related('attraction', 'restaurant', 'hotel')`).
+    """
+    details = serializers.SerializerMethodField()
+
+    subtype_serializers = (
+        ('attraction', AttractionDetailsSerializer),
+        ('restaurant', RestaurantDetailsSerializer),
+        ('hotel', HotelDetailsSerializer),
+    )
+
+    def get_details(self, obj):
+        for name, serializer_class in self.subtype_serializers:
+            try:
+                return serializer_class(getattr(obj, name)).data
+            except ObjectDoesNotExist:
+                continue
+        return None
+
+    class Meta:
+        model = Site
+        fields = '__all__'
+
+
 def update_attributes(data, instance, info):
     for attr, value in data.items():
         if attr in info.relations and info.relations[attr].to_many:
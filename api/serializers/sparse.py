@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def parse_field_paths(value):
+    """
+    'id,site.name,site.city' -> {'id': {}, 'site': {'name': {}, 'city': {}}}, an empty dict selecting a whole field
+    """
+    tree = dict()
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, dict())
+    return tree
+
+
+class SparseFieldsetsMixin(object):
+    """
+    Lets read requests pick fields with `?fields=` and drop them with `?omit=`, comma separated, with dots
+    for nested serializers (e.g. `fields=id,site.name`). Unselected fields are removed before serializing,
+    so their method fields and nested serializers are not computed or queried either.
+
+    The query parameters are read from the `query_params` context entry, or from the request of a safe
+    request in the `request` entry. Nested serializers get their selection from their parent.
+    """
+
+    def get_field_selection(self):
+        if hasattr(self, '_field_selection'):
+            return self._field_selection
+
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        if parent is not None:
+            return None, None
+
+        query_params = self.context.get('query_params', None)
+        request = self.context.get('request', None)
+        if query_params is None and request is not None and request.method in SAFE_METHODS:
+            query_params = request.query_params
+        if query_params is None:
+            return None, None
+        include = query_params.get('fields', None)
+        exclude = query_params.get('omit', None)
+        return parse_field_paths(include) if include else None, parse_field_paths(exclude) if exclude else None
+
+    def get_fields(self):
+        fields = super(SparseFieldsetsMixin, self).get_fields()
+        include, exclude = self.get_field_selection()
+        if include is None and exclude is None:
+            return fields
+
+        selected = OrderedDict()
+        for name, field in fields.items():
+            if include is not None and name not in include:
+                continue
+            if exclude is not None and name in exclude and not exclude[name]:
+                continue
+            nested = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(nested, SparseFieldsetsMixin):
+                nested._field_selection = (include.get(name) or None if include is not None else None,
+                                           exclude.get(name) or None if exclude is not None else None)
+            selected[name] = field
+        return selected
@@ -4,11 +4,13 @@ from django.utils import timezone
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
+from api.images import ImageVariantsField
 from api.models import User
+from api.serializers.sparse import SparseFieldsetsMixin
 
 
-class UserSerializer(serializers.ModelSerializer):
-    profile_pic = serializers.ImageField(required=False)
+class UserSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    profile_pic = ImageVariantsField(required=False)
     username = serializers.CharField(
         required=True,
     )
@@ -41,7 +43,7 @@ class UserUpdateSerializer(serializers.ModelSerializer):
         help_text='Leave empty if no change needed',
         style={'input_type': 'password', 'placeholder': 'Password'}
     )
-    profile_pic = serializers.ImageField(required=False)
+    profile_pic = ImageVariantsField(required=False)
 
     def update(self, instance, validated_data):
         if validated_data.get('password') is not None:
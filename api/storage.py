@@ -0,0 +1,76 @@
+"""
+Content-addressed file storage.
+
+An upload is hashed while it is streamed to a temporary file, then moved to a name made of its SHA-256:
+`blobs/3a/7f/3a7f...e1.jpg`. The same content uploaded twice, for an itinerary and its fork or as the same
+profile picture, is stored once, and since the content of a name never changes, it can be cached forever.
+
+Files are shared, so deleting one is left to api.media, which counts the image fields referring to each.
+Names outside `blobs/`, files uploaded before this storage or the default images, are stored and deleted
+as by FileSystemStorage.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+BLOB_DIRECTORY = 'blobs'
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_DIRECTORY + '/')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # The name is replaced by the hash of the content in _save
+        return name
+
+    def blob_name(self, digest, name):
+        extension = os.path.splitext(name)[1].lower()
+        return '/'.join((BLOB_DIRECTORY, digest[:2], digest[2:4], digest + extension))
+
+    def _save(self, name, content):
+        directory = os.path.join(self.location, BLOB_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        # In the same file system as the blobs, to be moved atomically
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.upload-', delete=False) as temporary:
+            try:
+                if hasattr(content, 'seek') and content.seekable():
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    temporary.write(chunk)
+            except BaseException:
+                os.remove(temporary.name)
+                raise
+
+        name = self.blob_name(digest.hexdigest(), name)
+        path = self.path(name)
+        if os.path.exists(path):
+            os.remove(temporary.name)
+            # Marks the blob as in use, so that api.media does not delete it before the instance taking a
+            # reference to it is saved
+            os.utime(path)
+            return name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(temporary.name, self.file_permissions_mode)
+        os.replace(temporary.name, path)
+        return name
+
+    def delete(self, name):
+        if is_blob(name):
+            # Deleted by api.media once no field refers to it
+            return
+        super(ContentAddressedStorage, self).delete(name)
+
+    def delete_blob(self, name):
+        super(ContentAddressedStorage, self).delete(name)
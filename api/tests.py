@@ -1,3 +1,1574 @@
-from django.test import TestCase
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO, StringIO
+from itertools import permutations
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
+from PIL import Image
+from rest_framework.test import APIClient
+
+from api.autocomplete import AutocompleteIndex, CITY, SITE
+from api.counters import CounterBuffer, LikeCounter, view_counter, like_counter
+from api.distance_cache import DistanceCache, distance_cache
+from api.geo import geohash_encode, geohash_cover, geohash_cell_size, haversine_matrix
+from api import media
+from api.images import ImageProcessor, image_processor, render_variants, variant_name
+from api.importer import parse_record
+from api.models import User, City, Site, Attraction, Restaurant, Hotel, Itinerary, DayTrip, DayTripSite, Comment, \
+    Like, LikeCounterShard, MediaBlob, SearchDocument
+from api.ordering import insert_orders, move_site, move_to_day_trip, rebalance, remove_site, reorder_sites
+from api.routing import path_length, two_opt, optimize_path
+from api.search import index_site, index_itinerary
+from api.serializers.poi import SiteReadSerializer
+from api.storage import ContentAddressedStorage
+from api.views.media import get_range, is_not_modified
+
+
+def create_user(username, **fields):
+    """
+    Creates a user without sending post_save: its receiver creates an auth token, whose model only exists
+    with rest_framework.authtoken installed
+    """
+    user = User(username=username, email=username + '@example.com', **fields)
+    user.set_unusable_password()
+    User.objects.bulk_create([user])
+    return user
+
+
+def create_site(name, category='Attraction', city=None, latitude=None, longitude=None, **fields):
+    site = Site.objects.create(name=name, site_category=category, url='https://example.com/' + name, city=city,
+                               latitude=latitude, longitude=longitude, address=fields.pop('address', ''),
+                               description=fields.pop('description', ''), **fields)
+    if category == 'Attraction':
+        Attraction.objects.create(site=site, category='museum')
+    elif category == 'Restaurant':
+        Restaurant.objects.create(site=site, category='noodles', open_at=0)
+    else:
+        Hotel.objects.create(site=site, category='inn', star_rate='4.0')
+    return site
+
+
+def create_itinerary(owner, sites_by_day=(), **fields):
+    """
+    Creates an itinerary visiting the sites of each day of `sites_by_day` in order
+    """
+    itinerary = Itinerary.objects.create(owner=owner, title=fields.pop('title', 'Trip'),
+                                         description=fields.pop('description', ''),
+                                         is_public=fields.pop('is_public', True), **fields)
+    for day, sites in enumerate(sites_by_day):
+        day_trip = DayTrip.objects.create(owner=owner, itinerary=itinerary, day=day)
+        for order, site in enumerate(sites):
+            DayTripSite.objects.create(owner=owner, day_trip=day_trip, site=site, order=order)
+    return itinerary
+
+
+class ApiTestCase(TestCase):
+
+    def setUp(self):
+        self.user = create_user('owner')
+        self.client = APIClient()
+        # Views are written through, leaving none to flush once the test database is gone
+        patcher = mock.patch.object(view_counter, 'flush_interval', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def count_queries(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = method(*args, **kwargs)
+        self.assertLess(response.status_code, 300, getattr(response, 'data', None))
+        return response, len(queries)
+
+
+class ItineraryListTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ItineraryListTestCase, self).setUp()
+        self.xian = City.objects.create(country_name='China', city_name="Xi'an")
+        self.beijing = City.objects.create(country_name='China', city_name='Beijing')
+        self.sites = [create_site('site%d' % i, city=self.xian if i < 3 else self.beijing) for i in range(5)]
+
+    def test_locations_ranked_by_sites(self):
+        itinerary = create_itinerary(self.user, [self.sites[3:4], self.sites[:3]])
+        create_itinerary(self.user)
+        response = self.client.get('/api/itinerary/')
+        locations = {row['id']: row['locations'] for row in response.data}
+        self.assertEqual(locations[itinerary.pk], ["Xi'an", 'Beijing'])
+        self.assertEqual(len(locations), 2)
+
+    def test_is_liked_by_requesting_user(self):
+        liked, other = create_itinerary(self.user), create_itinerary(self.user)
+        Like.objects.create(owner=self.user, itinerary=liked)
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/itinerary/')
+        self.assertEqual({row['id']: row['is_liked'] for row in response.data}, {liked.pk: True, other.pk: False})
+        self.client.force_authenticate(None)
+        response = self.client.get('/api/itinerary/')
+        self.assertFalse(any(row['is_liked'] for row in response.data))
+
+    def test_queries_do_not_grow_with_page_size(self):
+        self.client.force_authenticate(self.user)
+        for _ in range(2):
+            create_itinerary(self.user, [self.sites[:2], self.sites[2:]])
+        _, small_page = self.count_queries(self.client.get, '/api/itinerary/')
+        for _ in range(6):
+            create_itinerary(self.user, [self.sites[:2], self.sites[2:]])
+        response, large_page = self.count_queries(self.client.get, '/api/itinerary/')
+        self.assertEqual(len(response.data), 8)
+        self.assertEqual(large_page, small_page)
+
+
+class KeysetPaginationTestCase(ApiTestCase):
+
+    def list_all(self, **params):
+        ids, cursor = [], None
+        while True:
+            if cursor is not None:
+                params['cursor'] = cursor
+            response = self.client.get('/api/itinerary/', params)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.data]
+            cursor = response.get('X-Next-Cursor')
+            if cursor is None:
+                return ids
+
+    def test_pages_by_id(self):
+        itineraries = [create_itinerary(self.user) for _ in range(5)]
+        response = self.client.get('/api/itinerary/', {'limit': 2})
+        self.assertEqual([row['id'] for row in response.data], [itinerary.pk for itinerary in itineraries[:2]])
+        self.assertIn('rel="next"', response['Link'])
+        self.assertEqual(self.list_all(limit=2), [itinerary.pk for itinerary in itineraries])
+
+    def test_pages_by_sort_key_with_ties(self):
+        views = [3, 1, 3, 0, 3, 2]
+        itineraries = [create_itinerary(self.user, view=view) for view in views]
+        expected = [itinerary.pk for itinerary in sorted(itineraries, key=lambda i: (-i.view, -i.pk))]
+        self.assertEqual(self.list_all(sortBy='view', limit=2), expected)
+
+    def test_invalid_parameters(self):
+        create_itinerary(self.user)
+        self.assertEqual(self.client.get('/api/itinerary/', {'sortBy': 'title'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/itinerary/', {'cursor': 'garbage'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/itinerary/', {'limit': 0}).status_code, 400)
+        # A cursor of another sort order is rejected
+        create_itinerary(self.user)
+        cursor = self.client.get('/api/itinerary/', {'limit': 1, 'sortBy': 'view'})['X-Next-Cursor']
+        self.assertEqual(self.client.get('/api/itinerary/', {'cursor': cursor}).status_code, 400)
+
+
+class ViewCounterTestCase(ApiTestCase):
+
+    def views(self, itinerary):
+        return Itinerary.objects.values_list('view', flat=True).get(pk=itinerary.pk)
+
+    def create_counter(self, **kwargs):
+        counter = CounterBuffer(Itinerary, 'view', **kwargs)
+        # Flushed within the test rather than when the process exits
+        self.addCleanup(counter.stop)
+        return counter
+
+    def test_buffers_until_flushed(self):
+        first, second, third = [create_itinerary(self.user) for _ in range(3)]
+        counter = self.create_counter(flush_interval=3600)
+        self.assertEqual(counter.increment(first.pk), 1)
+        self.assertEqual(counter.increment(first.pk), 2)
+        counter.increment(second.pk)
+        self.assertEqual(self.views(first), 0)
+        with CaptureQueriesContext(connection) as queries:
+            counter.flush()
+        # One update per distinct amount
+        self.assertEqual(len(queries), 2)
+        self.assertEqual((self.views(first), self.views(second), self.views(third)), (2, 1, 0))
+        self.assertEqual(counter.increment(first.pk), 1)
+
+    def test_flushes_when_full(self):
+        itineraries = [create_itinerary(self.user) for _ in range(3)]
+        counter = self.create_counter(flush_interval=3600, max_pending=2)
+        counter.increment(itineraries[0].pk)
+        self.assertEqual(self.views(itineraries[0]), 0)
+        counter.increment(itineraries[1].pk)
+        self.assertEqual((self.views(itineraries[0]), self.views(itineraries[1])), (1, 1))
+
+    def test_writes_through_without_interval(self):
+        itinerary = create_itinerary(self.user)
+        counter = self.create_counter(flush_interval=0)
+        self.assertEqual(counter.increment(itinerary.pk), 0)
+        self.assertEqual(self.views(itinerary), 1)
+
+    def test_retrieve_counts_views_of_others(self):
+        itinerary = create_itinerary(self.user)
+        self.client.get('/api/itinerary/%d/' % itinerary.pk)
+        self.assertEqual(self.views(itinerary), 1)
+        # Views of the owner are not counted
+        self.client.force_authenticate(self.user)
+        self.client.get('/api/itinerary/%d/' % itinerary.pk)
+        self.assertEqual(self.views(itinerary), 1)
+
+
+class LikeCounterTestCase(ApiTestCase):
+
+    def likes(self, itinerary):
+        return Itinerary.objects.values_list('like', flat=True).get(pk=itinerary.pk)
+
+    def test_like_and_unlike(self):
+        itinerary = create_itinerary(self.user)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.post('/api/like/', {'itinerary': itinerary.pk}).status_code, 201)
+        self.assertEqual(self.likes(itinerary), 1)
+        self.assertEqual(self.client.post('/api/like/', {'itinerary': itinerary.pk}).status_code, 400)
+        self.assertEqual(self.likes(itinerary), 1)
+        self.assertEqual(self.client.delete('/api/like/%d/' % itinerary.pk).status_code, 204)
+        self.assertEqual(self.likes(itinerary), 0)
+        # Unliking again changes nothing
+        self.client.delete('/api/like/%d/' % itinerary.pk)
+        self.assertEqual(self.likes(itinerary), 0)
+
+    def test_hot_itineraries_count_into_shards(self):
+        counter = LikeCounter(shards=4, hot_threshold=2)
+        itinerary = create_itinerary(self.user)
+        users = [create_user('user%d' % i) for i in range(5)]
+        for user in users:
+            Like.objects.create(owner=user, itinerary=itinerary)
+            counter.add(itinerary.pk, 1)
+        # Counted on the row until hot
+        self.assertEqual(self.likes(itinerary), 2)
+        self.assertEqual(counter.pending([itinerary.pk]), {itinerary.pk: 3})
+        self.assertTrue(counter.is_hot(itinerary.pk))
+
+        self.assertEqual(counter.reconcile(), 1)
+        self.assertEqual(self.likes(itinerary), 5)
+        self.assertFalse(LikeCounterShard.objects.exists())
+        self.assertEqual(counter.pending([itinerary.pk]), {})
+
+    def test_unsharded_counter_has_nothing_pending(self):
+        itinerary = create_itinerary(self.user)
+        counter = LikeCounter(shards=0, hot_threshold=0)
+        counter.add(itinerary.pk, 1)
+        self.assertFalse(counter.is_hot(itinerary.pk))
+        self.assertEqual(self.likes(itinerary), 1)
+        self.assertEqual(counter.pending([itinerary.pk]), {})
+
+    def test_served_counts_include_shards(self):
+        itinerary = create_itinerary(self.user, like=10)
+        LikeCounterShard.objects.create(itinerary=itinerary, shard=0, count=2)
+        LikeCounterShard.objects.create(itinerary=itinerary, shard=1, count=1)
+        with mock.patch.object(like_counter, 'shards', 4):
+            self.assertEqual(self.client.get('/api/itinerary/%d/' % itinerary.pk).data['like'], 13)
+            self.assertEqual(self.client.get('/api/itinerary/').data[0]['like'], 13)
+
+
+class ItineraryFullTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ItineraryFullTestCase, self).setUp()
+        city = City.objects.create(country_name='China', city_name="Xi'an")
+        self.sites = [create_site('site%d' % i, city=city) for i in range(6)]
+
+    def test_tree_in_order(self):
+        itinerary = create_itinerary(self.user, [self.sites[:3], self.sites[3:]])
+        # Stored orders may be gapped, positions are dense
+        DayTripSite.objects.filter(day_trip__day=1, site=self.sites[5]).update(order=40)
+        response = self.client.get('/api/itinerary/%d/full/' % itinerary.pk)
+        days = response.data['day_trips']
+        self.assertEqual([day['day'] for day in days], [0, 1])
+        self.assertEqual([site['site']['id'] for site in days[0]['sites']], [site.pk for site in self.sites[:3]])
+        self.assertEqual([site['order'] for site in days[1]['sites']], [0, 1, 2])
+        self.assertEqual(days[1]['sites'][2]['site']['city']['city_name'], "Xi'an")
+
+    def test_queries_do_not_grow_with_tree(self):
+        small = create_itinerary(self.user, [self.sites[:1]])
+        large = create_itinerary(self.user, [self.sites[:3], self.sites[3:], self.sites])
+        _, small_tree = self.count_queries(self.client.get, '/api/itinerary/%d/full/' % small.pk)
+        _, large_tree = self.count_queries(self.client.get, '/api/itinerary/%d/full/' % large.pk)
+        self.assertEqual(large_tree, small_tree)
+
+    def test_private_itinerary(self):
+        itinerary = create_itinerary(self.user, is_public=False)
+        self.assertEqual(self.client.get('/api/itinerary/%d/full/' % itinerary.pk).status_code, 404)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/itinerary/%d/full/' % itinerary.pk).status_code, 200)
+
+
+class OrderingTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(OrderingTestCase, self).setUp()
+        itinerary = create_itinerary(self.user)
+        self.day_trip = DayTrip.objects.create(owner=self.user, itinerary=itinerary, day=0)
+        self.other_day_trip = DayTrip.objects.create(owner=self.user, itinerary=itinerary, day=1)
+        self.sites = [create_site('site%d' % i) for i in range(5)]
+
+    def add_sites(self, day_trip, count, gap=1):
+        return [DayTripSite.objects.create(owner=self.user, day_trip=day_trip, site=self.sites[i], order=i * gap)
+                for i in range(count)]
+
+    def ids(self, day_trip):
+        return list(DayTripSite.objects.filter(day_trip=day_trip).order_by('order').values_list('id', flat=True))
+
+    def orders(self, day_trip):
+        return list(DayTripSite.objects.filter(day_trip=day_trip).order_by('order').values_list('order', flat=True))
+
+    def test_move_dense(self):
+        a, b, c, d = self.add_sites(self.day_trip, 4)
+        move_site(a, 2)
+        self.assertEqual(self.ids(self.day_trip), [b.pk, c.pk, a.pk, d.pk])
+        self.assertEqual(self.orders(self.day_trip), [0, 1, 2, 3])
+        move_site(DayTripSite.objects.get(pk=d.pk), 0)
+        self.assertEqual(self.ids(self.day_trip), [d.pk, b.pk, c.pk, a.pk])
+        self.assertEqual(self.orders(self.day_trip), [0, 1, 2, 3])
+
+    def test_insert_and_remove_dense(self):
+        a, b, c = self.add_sites(self.day_trip, 3)
+        self.assertEqual(insert_orders(self.day_trip.pk, 1, 2), [1, 2])
+        self.assertEqual(self.orders(self.day_trip), [0, 3, 4])
+        d = DayTripSite.objects.create(owner=self.user, day_trip=self.day_trip, site=self.sites[3], order=1)
+        remove_site(DayTripSite.objects.get(pk=b.pk))
+        self.assertEqual(self.ids(self.day_trip), [a.pk, d.pk, c.pk])
+        self.assertEqual(self.orders(self.day_trip), [0, 1, 3])
+
+    def test_reorder(self):
+        a, b, c = self.add_sites(self.day_trip, 3)
+        reorder_sites(self.day_trip, [c.pk, a.pk, b.pk])
+        self.assertEqual(self.ids(self.day_trip), [c.pk, a.pk, b.pk])
+        self.assertEqual(self.orders(self.day_trip), [0, 1, 2])
+        with self.assertRaises(ValueError):
+            reorder_sites(self.day_trip, [c.pk, a.pk])
+        with self.assertRaises(ValueError):
+            reorder_sites(self.day_trip, [c.pk, a.pk, a.pk])
+
+    def test_reorder_endpoint(self):
+        a, b, c = self.add_sites(self.day_trip, 3)
+        url = '/api/day-trip/%d/reorder/' % self.day_trip.pk
+        self.assertEqual(self.client.post(url, {'sites': [c.pk, b.pk, a.pk]}, format='json').status_code, 401)
+        self.client.force_authenticate(self.user)
+        response = self.client.post(url, {'sites': [c.pk, b.pk, a.pk]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([site['id'] for site in response.data], [c.pk, b.pk, a.pk])
+        self.assertEqual([site['order'] for site in response.data], [0, 1, 2])
+        self.assertEqual(self.client.post(url, {'sites': [c.pk]}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(url, {'sites': 'all'}, format='json').status_code, 400)
+
+    def test_move_and_delete_endpoints(self):
+        a, b, c = self.add_sites(self.day_trip, 3)
+        self.client.force_authenticate(self.user)
+        response = self.client.patch('/api/day-trip-site/%d/?new_order=2' % a.pk)
+        self.assertEqual([site['id'] for site in response.data], [b.pk, c.pk, a.pk])
+        self.assertEqual(self.client.patch('/api/day-trip-site/%d/?new_order=x' % a.pk).status_code, 400)
+        self.assertEqual(self.client.delete('/api/day-trip-site/%d/' % c.pk).status_code, 204)
+        self.assertEqual(self.ids(self.day_trip), [b.pk, a.pk])
+        self.assertEqual(self.orders(self.day_trip), [0, 1])
+
+    def test_move_to_day_trip_dense(self):
+        a, b, c = self.add_sites(self.day_trip, 3)
+        x, y = self.add_sites(self.other_day_trip, 2)
+        move_to_day_trip(DayTripSite.objects.get(pk=b.pk), self.other_day_trip.pk, 1)
+        self.assertEqual(self.ids(self.day_trip), [a.pk, c.pk])
+        self.assertEqual(self.orders(self.day_trip), [0, 1])
+        self.assertEqual(self.ids(self.other_day_trip), [x.pk, b.pk, y.pk])
+        self.assertEqual(self.orders(self.other_day_trip), [0, 1, 2])
+
+    @override_settings(DAY_TRIP_SITE_ORDER_GAP=4)
+    def test_gapped_ranks(self):
+        a, b, c = self.add_sites(self.day_trip, 3, gap=4)
+        rebalance(self.day_trip.pk)
+        # Room is left before the first site
+        self.assertEqual(self.orders(self.day_trip), [4, 8, 12])
+        order, = insert_orders(self.day_trip.pk, 0)
+        self.assertEqual(order, 1)
+        self.assertEqual(self.orders(self.day_trip), [4, 8, 12])
+
+        move_site(DayTripSite.objects.get(pk=c.pk), 1)
+        self.assertEqual(self.ids(self.day_trip), [a.pk, c.pk, b.pk])
+        self.assertEqual(self.orders(self.day_trip), [4, 6, 8])
+
+    @override_settings(DAY_TRIP_SITE_ORDER_GAP=4)
+    def test_gapped_rebalance_when_full(self):
+        a, b = self.add_sites(self.day_trip, 2, gap=4)
+        rebalance(self.day_trip.pk)
+        DayTripSite.objects.filter(pk=b.pk).update(order=5)
+        # No rank is left between 4 and 5
+        order, = insert_orders(self.day_trip.pk, 1)
+        self.assertEqual(order, 8)
+        self.assertEqual(self.orders(self.day_trip), [4, 12])
+        positions = DayTripSite.objects.filter(day_trip=self.day_trip).with_position() \
+            .order_by('order').values_list('position', flat=True)
+        self.assertEqual(list(positions), [0, 1])
+
+    def rebalance_command(self):
+        out = StringIO()
+        call_command('rebalance_day_trip_sites', stdout=out)
+        return out.getvalue()
+
+    def test_rebalance_command_dense(self):
+        self.add_sites(self.day_trip, 3)
+        self.assertIn('Rebalanced 0 day trips', self.rebalance_command())
+        DayTripSite.objects.filter(day_trip=self.day_trip, order=2).update(order=5)
+        self.assertIn('Rebalanced 1 day trips', self.rebalance_command())
+        self.assertEqual(self.orders(self.day_trip), [0, 1, 2])
+
+    @override_settings(DAY_TRIP_SITE_ORDER_GAP=4)
+    def test_rebalance_command_gapped(self):
+        self.add_sites(self.day_trip, 3, gap=4)
+        self.assertIn('Rebalanced 1 day trips', self.rebalance_command())
+        self.assertEqual(self.orders(self.day_trip), [4, 8, 12])
+        # Balanced day trips are left alone
+        self.assertIn('Rebalanced 0 day trips', self.rebalance_command())
+
+
+class DayTripSiteBulkTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(DayTripSiteBulkTestCase, self).setUp()
+        self.sites = [create_site('site%d' % i) for i in range(4)]
+        itinerary = create_itinerary(self.user, [self.sites[:2]])
+        self.day_trip = itinerary.daytrip_set.get()
+        self.client.force_authenticate(self.user)
+
+    def bulk(self, data):
+        return self.client.post('/api/day-trip-site/bulk/', dict(data, day_trip=self.day_trip.pk), format='json')
+
+    def test_appends_by_default(self):
+        response = self.bulk({'sites': [self.sites[2].pk, self.sites[3].pk]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([site['site']['id'] for site in response.data], [site.pk for site in self.sites])
+        self.assertEqual([site['order'] for site in response.data], [0, 1, 2, 3])
+
+    def test_inserts_at_order(self):
+        response = self.bulk({'sites': [self.sites[2].pk, self.sites[3].pk], 'order': 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([site['site']['id'] for site in response.data],
+                         [self.sites[0].pk, self.sites[2].pk, self.sites[3].pk, self.sites[1].pk])
+        self.assertEqual([site['order'] for site in response.data], [0, 1, 2, 3])
+
+    def test_query_count_independent_of_sites(self):
+        response, few = self.count_queries(self.bulk, {'sites': [self.sites[2].pk], 'order': 0})
+        more_sites = [create_site('more%d' % i).pk for i in range(5)]
+        response, many = self.count_queries(self.bulk, {'sites': more_sites, 'order': 0})
+        self.assertEqual(few, many)
+
+    def test_invalid_site_adds_nothing(self):
+        response = self.bulk({'sites': [self.sites[2].pk, 0]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(DayTripSite.objects.filter(day_trip=self.day_trip).count(), 2)
+
+    def test_only_owner(self):
+        self.client.force_authenticate(create_user('other'))
+        self.assertEqual(self.bulk({'sites': [self.sites[2].pk]}).status_code, 403)
+        self.assertEqual(DayTripSite.objects.filter(day_trip=self.day_trip).count(), 2)
+
+
+class ForkTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ForkTestCase, self).setUp()
+        self.sites = [create_site('site%d' % i) for i in range(3)]
+        self.source = create_itinerary(self.user, [self.sites[:2], self.sites[2:], []], title='Kyoto',
+                                       image='itinerary/kyoto.jpeg')
+        self.other = create_user('other')
+
+    def fork(self, itinerary):
+        return self.client.post('/api/itinerary/%d/fork/' % itinerary.pk)
+
+    def tree(self, itinerary):
+        return [list(day_trip.daytripsite_set.order_by('order').values_list('site_id', flat=True))
+                for day_trip in itinerary.daytrip_set.order_by('day')]
+
+    def test_copies_tree(self):
+        self.client.force_authenticate(self.other)
+        response = self.fork(self.source)
+        self.assertEqual(response.status_code, 201)
+        itinerary = Itinerary.objects.get(pk=response.data['id'])
+        self.assertNotEqual(itinerary.pk, self.source.pk)
+        self.assertEqual(itinerary.owner, self.other)
+        self.assertEqual(itinerary.title, 'Kyoto')
+        self.assertFalse(itinerary.is_public)
+        # The stored image is shared, not processed again
+        self.assertEqual(itinerary.image.name, 'itinerary/kyoto.jpeg')
+        self.assertEqual(self.tree(itinerary), self.tree(self.source))
+        self.assertEqual(self.tree(itinerary), [[self.sites[0].pk, self.sites[1].pk], [self.sites[2].pk], []])
+        self.assertFalse(DayTripSite.objects.filter(day_trip__itinerary=itinerary).exclude(owner=self.other).exists())
+
+    def test_query_count_independent_of_tree(self):
+        self.client.force_authenticate(self.other)
+        small = create_itinerary(self.user, [self.sites[:1]])
+        response, few = self.count_queries(self.fork, small)
+        response, many = self.count_queries(self.fork, self.source)
+        self.assertEqual(few, many)
+
+    def test_private_itinerary(self):
+        private = create_itinerary(self.user, [self.sites], is_public=False)
+        self.assertEqual(self.fork(private).status_code, 401)
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.fork(private).status_code, 404)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.fork(private).status_code, 201)
+
+
+class CommentPagingTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(CommentPagingTestCase, self).setUp()
+        self.itinerary = create_itinerary(self.user)
+        self.comments = [Comment.objects.create(itinerary=self.itinerary, owner=self.user, comment='c%d' % i)
+                         for i in range(5)]
+        Comment.objects.create(itinerary=create_itinerary(self.user), owner=self.user, comment='elsewhere')
+        self.newest_first = [comment.pk for comment in reversed(self.comments)]
+
+    @override_settings(ITINERARY_DETAIL_COMMENTS=2)
+    def test_detail_embeds_newest_comments(self):
+        response = self.client.get('/api/itinerary/%d/' % self.itinerary.pk)
+        self.assertEqual([comment['id'] for comment in response.data['comments']], self.newest_first[:2])
+        response = self.client.get(response.data['comments_next'])
+        self.assertEqual([comment['id'] for comment in response.data], self.newest_first[2:])
+        self.assertNotIn('X-Next-Cursor', response)
+
+    @override_settings(ITINERARY_DETAIL_COMMENTS=5)
+    def test_no_next_link_when_all_embedded(self):
+        response = self.client.get('/api/itinerary/%d/' % self.itinerary.pk)
+        self.assertEqual(len(response.data['comments']), 5)
+        self.assertIsNone(response.data['comments_next'])
+
+    @override_settings(ITINERARY_DETAIL_COMMENTS=0)
+    def test_detail_embeds_at_least_one_comment(self):
+        response = self.client.get('/api/itinerary/%d/' % self.itinerary.pk)
+        self.assertEqual([comment['id'] for comment in response.data['comments']], self.newest_first[:1])
+        self.assertIsNotNone(response.data['comments_next'])
+
+    def test_listing_filters_by_itinerary(self):
+        response = self.client.get('/api/comment/', {'itinerary': self.itinerary.pk})
+        self.assertEqual([comment['id'] for comment in response.data], self.newest_first)
+        self.assertEqual(Comment.objects.count(), 6)
+
+
+class LikeCardTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(LikeCardTestCase, self).setUp()
+        xian = City.objects.create(country_name='China', city_name="Xi'an")
+        beijing = City.objects.create(country_name='China', city_name='Beijing')
+        sites = [create_site('site%d' % i, city=city) for i, city in enumerate([beijing, xian, xian])]
+        self.itinerary = create_itinerary(self.user, [sites], title='Shaanxi')
+        Comment.objects.create(itinerary=self.itinerary, owner=self.user, comment='nice')
+        Comment.objects.create(itinerary=self.itinerary, owner=self.user, comment='again')
+        Like.objects.create(itinerary=self.itinerary, owner=self.user)
+
+    def list_likes(self, **params):
+        return self.client.get('/api/like/', dict(params, user=self.user.pk))
+
+    def test_cards(self):
+        response = self.list_likes()
+        self.assertEqual(response.status_code, 200)
+        card = response.data[0]['itinerary']
+        self.assertEqual(set(card), {'id', 'title', 'image', 'view', 'like', 'comment_count', 'locations'})
+        self.assertEqual(card['id'], self.itinerary.pk)
+        self.assertEqual(card['title'], 'Shaanxi')
+        self.assertEqual(card['comment_count'], 2)
+        self.assertEqual(card['locations'], ["Xi'an", 'Beijing'])
+
+    def test_query_count_independent_of_likes(self):
+        response, few = self.count_queries(self.list_likes)
+        for i in range(5):
+            itinerary = create_itinerary(self.user, [[create_site('more%d' % i)]])
+            Comment.objects.create(itinerary=itinerary, owner=self.user, comment='ok')
+            Like.objects.create(itinerary=itinerary, owner=self.user)
+        response, many = self.count_queries(self.list_likes)
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(few, many)
+
+    def test_detail_on_request(self):
+        response = self.list_likes(detail='true')
+        self.assertEqual([comment['comment'] for comment in response.data[0]['itinerary']['comments']],
+                         ['again', 'nice'])
+
+
+class DayTripListTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(DayTripListTestCase, self).setUp()
+        city = City.objects.create(country_name='China', city_name="Xi'an")
+        self.sites = [create_site('site%d' % i, city=city) for i in range(6)]
+
+    def list_day_trips(self, itinerary, **params):
+        return self.client.get('/api/day-trip/', dict(params, itinerary=itinerary.pk))
+
+    def test_sites_in_order(self):
+        itinerary = create_itinerary(self.user, [self.sites[:3], self.sites[3:]])
+        day_trip = itinerary.daytrip_set.get(day=0)
+        DayTripSite.objects.filter(day_trip=day_trip, site=self.sites[0]).update(order=10)
+        response = self.list_day_trips(itinerary)
+        sites = response.data[0]['sites']
+        self.assertEqual([site['site']['id'] for site in sites], [self.sites[1].pk, self.sites[2].pk, self.sites[0].pk])
+        self.assertEqual([site['order'] for site in sites], [0, 1, 2])
+        self.assertEqual(sites[0]['site']['city']['city_name'], "Xi'an")
+
+    def test_sparse_fields(self):
+        itinerary = create_itinerary(self.user, [self.sites[:2]])
+        response = self.list_day_trips(itinerary, fields='id,sites.id')
+        day_trip_site_ids = list(DayTripSite.objects.order_by('order').values_list('id', flat=True))
+        self.assertEqual(response.data, [{'id': itinerary.daytrip_set.get().pk,
+                                          'sites': [{'id': pk} for pk in day_trip_site_ids]}])
+
+    def test_query_count_independent_of_sites(self):
+        small = create_itinerary(self.user, [self.sites[:1]])
+        large = create_itinerary(self.user, [self.sites[:3], self.sites[3:], self.sites])
+        response, few = self.count_queries(self.list_day_trips, small)
+        response, many = self.count_queries(self.list_day_trips, large)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(few, many)
+        day_trip = large.daytrip_set.get(day=2)
+        response, queries = self.count_queries(self.client.get, '/api/day-trip/%d/' % day_trip.pk)
+        self.assertEqual(len(response.data['sites']), 6)
+        self.assertLessEqual(queries, few)
+
+
+class GeohashTestCase(SimpleTestCase):
+
+    def test_encode(self):
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash_encode(42.6, -5.6, 5), 'ezs42')
+        self.assertEqual(geohash_encode(-90, -180, 3), '000')
+        self.assertEqual(geohash_encode(90, 180, 3), 'zzz')
+
+    def test_prefix_of_finer_precision(self):
+        self.assertTrue(geohash_encode(34.2612, 108.9423).startswith(geohash_encode(34.2612, 108.9423, 6)))
+
+    def test_cover(self):
+        box = (34.20, 108.90, 34.30, 109.00)
+        cells = geohash_cover(*box, max_cells=16)
+        self.assertLessEqual(len(cells), 16)
+        self.assertEqual(len(set(len(cell) for cell in cells)), 1)
+        # Every point of the box falls in a cell of the cover
+        for latitude in np.linspace(box[0], box[2], 7):
+            for longitude in np.linspace(box[1], box[3], 7):
+                self.assertIn(geohash_encode(latitude, longitude, len(cells[0])), cells)
+
+    def test_cover_of_point(self):
+        cells = geohash_cover(34.2612, 108.9423, 34.2612, 108.9423, max_cells=4)
+        self.assertEqual(cells, [geohash_encode(34.2612, 108.9423, len(cells[0]))])
+        height, width = geohash_cell_size(len(cells[0]))
+        self.assertGreater(height, 0)
+        self.assertGreater(width, 0)
+
+
+class SiteLocationTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(SiteLocationTestCase, self).setUp()
+        # The Bell Tower of Xi'an, then sites about 1, 3 and 20 km away
+        self.center = create_site('center', latitude='34.261200', longitude='108.942300')
+        self.near = create_site('near', 'Restaurant', latitude='34.270200', longitude='108.942300')
+        self.middle = create_site('middle', 'Hotel', latitude='34.261200', longitude='108.975000')
+        self.far = create_site('far', latitude='34.441200', longitude='108.942300')
+        create_site('unlocated')
+
+    def nearby(self, **params):
+        return self.client.get('/api/site/nearby/', dict({'lat': 34.2612, 'lng': 108.9423}, **params))
+
+    def bbox(self, **params):
+        return self.client.get('/api/site/bbox/', dict(
+            {'min_lat': 34.2, 'min_lng': 108.9, 'max_lat': 34.3, 'max_lng': 109.0}, **params))
+
+    def test_nearby(self):
+        response = self.nearby()
+        self.assertEqual([site['id'] for site in response.data], [self.center.pk, self.near.pk, self.middle.pk])
+        self.assertEqual(response.data[0]['distance'], 0)
+        self.assertAlmostEqual(response.data[1]['distance'], 1.0, places=1)
+        response = self.nearby(radius=2, limit=1)
+        self.assertEqual([site['id'] for site in response.data], [self.center.pk])
+        response = self.nearby(radius=25, category='Attraction')
+        self.assertEqual([site['id'] for site in response.data], [self.center.pk, self.far.pk])
+
+    def test_bbox(self):
+        response = self.bbox()
+        self.assertEqual([site['id'] for site in response.data], [self.center.pk, self.near.pk, self.middle.pk])
+        response = self.bbox(limit=2)
+        self.assertEqual([site['id'] for site in response.data], [self.center.pk, self.near.pk])
+        self.assertIn('X-Next-Cursor', response)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/site/nearby/', {'lat': 34.2612}).status_code, 400)
+        self.assertEqual(self.nearby(radius=1000).status_code, 400)
+        self.assertEqual(self.nearby(lat='north').status_code, 400)
+        self.assertEqual(self.bbox(min_lat=35).status_code, 400)
+
+    def test_deleted_subtype_hides_site(self):
+        self.client.force_authenticate(create_user('admin', is_staff=True))
+        self.assertEqual(self.client.delete('/api/attraction/%d/' % self.center.pk).status_code, 204)
+        self.assertTrue(Site.objects.filter(pk=self.center.pk).exists())
+        self.assertEqual([site['id'] for site in self.nearby().data], [self.near.pk, self.middle.pk])
+        self.assertEqual([site['id'] for site in self.bbox().data], [self.near.pk, self.middle.pk])
+
+
+class SiteClustersTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(SiteClustersTestCase, self).setUp()
+        self.xian = [create_site('xian%d' % i, latitude='34.26%d000' % i, longitude='108.94%d000' % i)
+                     for i in range(3)]
+        self.beijing = create_site('beijing', 'Hotel', latitude='39.904200', longitude='116.407400')
+
+    def clusters(self, zoom, **params):
+        return self.client.get('/api/site/clusters/', dict(
+            {'min_lat': 30, 'min_lng': 100, 'max_lat': 45, 'max_lng': 120, 'zoom': zoom}, **params))
+
+    def test_clusters(self):
+        response = self.clusters(4)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(cluster['count'] for cluster in response.data), [1, 3])
+        cluster = next(cluster for cluster in response.data if cluster['count'] == 3)
+        self.assertEqual(cluster['sites'], [self.xian[0].pk, self.xian[2].pk])
+        self.assertAlmostEqual(cluster['latitude'], 34.261, places=3)
+        self.assertTrue(geohash_encode(34.261, 108.941).startswith(cluster['geohash']))
+        response = self.clusters(4, category='Hotel')
+        self.assertEqual([cluster['sites'] for cluster in response.data], [[self.beijing.pk]])
+
+    @override_settings(SITE_CLUSTERS_MAX=4)
+    def test_coarser_cells_for_large_boxes(self):
+        response = self.clusters(22)
+        self.assertEqual(sum(cluster['count'] for cluster in response.data), 4)
+        self.assertLessEqual(len(response.data), 4)
+        self.assertEqual(len(set(len(cluster['geohash']) for cluster in response.data)), 1)
+
+    def test_deleted_subtype_hides_site(self):
+        self.client.force_authenticate(create_user('admin', is_staff=True))
+        self.assertEqual(self.client.delete('/api/hotel/%d/' % self.beijing.pk).status_code, 204)
+        self.assertEqual([cluster['count'] for cluster in self.clusters(4).data], [3])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.clusters(23).status_code, 400)
+        self.assertEqual(self.clusters(4, min_lat=50).status_code, 400)
+
+
+def line_matrix(positions):
+    positions = np.asarray(positions, dtype=float)
+    return np.abs(positions[:, None] - positions[None, :])
+
+
+class TwoOptTestCase(SimpleTestCase):
+
+    def test_path_length(self):
+        matrix = line_matrix([0, 1, 3])
+        self.assertEqual(path_length(matrix, [0, 1, 2]), 3)
+        self.assertEqual(path_length(matrix, [1, 0, 2]), 4)
+        self.assertEqual(path_length(matrix, [2]), 0)
+
+    def test_uncrosses_path(self):
+        matrix = line_matrix([0, 1, 2, 3, 4])
+        path = two_opt(matrix, [0, 3, 2, 1, 4])
+        self.assertEqual(path, [0, 1, 2, 3, 4])
+        self.assertEqual(path_length(matrix, path), 4)
+
+    def test_reverses_ends(self):
+        # Reversing a segment at either end of an open path changes a single edge
+        matrix = line_matrix([0, 1, 2, 3])
+        self.assertEqual(path_length(matrix, two_opt(matrix, [1, 0, 2, 3])), 3)
+        self.assertEqual(path_length(matrix, two_opt(matrix, [0, 1, 3, 2])), 3)
+
+    def test_fixed_start(self):
+        matrix = line_matrix([2, 0, 1, 3])
+        path = two_opt(matrix, [0, 1, 2, 3], fixed_start=True)
+        self.assertEqual(path[0], 0)
+        self.assertEqual(sorted(path), [0, 1, 2, 3])
+
+    def test_close_to_optimal(self):
+        random = np.random.RandomState(0)
+        for _ in range(20):
+            points = random.rand(6, 2)
+            matrix = np.sqrt(((points[:, None] - points[None, :]) ** 2).sum(axis=2))
+            path = optimize_path(matrix)
+            self.assertEqual(sorted(path), list(range(6)))
+            best = min(path_length(matrix, list(p)) for p in permutations(range(6)))
+            self.assertLessEqual(path_length(matrix, path), best * 1.1 + 1e-9)
+            start_path = optimize_path(matrix, start=3)
+            self.assertEqual(start_path[0], 3)
+
+    def test_gain_matches_lengths(self):
+        random = np.random.RandomState(1)
+        points = random.rand(8, 2)
+        matrix = np.sqrt(((points[:, None] - points[None, :]) ** 2).sum(axis=2))
+        path = list(range(8))
+        improved = two_opt(matrix, path)
+        self.assertLessEqual(path_length(matrix, improved), path_length(matrix, path))
+        # No single reversal shortens the result
+        length = path_length(matrix, improved)
+        for i in range(8):
+            for j in range(i + 1, 8):
+                reversed_path = improved[:i] + improved[i:j + 1][::-1] + improved[j + 1:]
+                self.assertGreaterEqual(path_length(matrix, reversed_path), length - 1e-9)
+
+
+class OptimizeDayTripTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(OptimizeDayTripTestCase, self).setUp()
+        # Along a parallel, out of order, then a site without coordinates
+        sites = [create_site('site%d' % i, latitude='34.260000', longitude=longitude)
+                 for i, longitude in enumerate(['108.900000', '108.930000', '108.910000', '108.920000'])]
+        sites.append(create_site('unlocated'))
+        self.day_trip = create_itinerary(self.user, [sites]).daytrip_set.get()
+        self.ids = list(self.day_trip.daytripsite_set.order_by('order').values_list('id', flat=True))
+        self.client.force_authenticate(self.user)
+
+    def optimize(self, **data):
+        return self.client.post('/api/day-trip/%d/optimize/' % self.day_trip.pk, data, format='json')
+
+    def test_suggests_shorter_order(self):
+        response = self.optimize(start=self.ids[0])
+        self.assertEqual(response.status_code, 200)
+        expected = [self.ids[0], self.ids[2], self.ids[3], self.ids[1], self.ids[4]]
+        self.assertEqual(response.data['sites'], expected)
+        self.assertLess(response.data['distance'], response.data['current_distance'])
+        self.assertFalse(response.data['applied'])
+        self.assertEqual(list(self.day_trip.daytripsite_set.order_by('order').values_list('id', flat=True)),
+                         self.ids)
+
+    def test_apply(self):
+        response = self.optimize(start=self.ids[1], apply=True)
+        self.assertEqual(response.data['sites'][0], self.ids[1])
+        self.assertEqual(list(self.day_trip.daytripsite_set.order_by('order').values_list('id', flat=True)),
+                         response.data['sites'])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.optimize(start=self.ids[4]).status_code, 400)
+        self.assertEqual(self.optimize(start='first').status_code, 400)
+        self.assertEqual(self.optimize(apply='yes').status_code, 400)
+
+
+class DistanceCacheTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(DistanceCacheTestCase, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache = DistanceCache(directory)
+        self.city = City.objects.create(country_name='China', city_name="Xi'an")
+        self.sites = [create_site('site%d' % i, city=self.city, latitude='34.2%d0000' % i, longitude='108.9%d0000' % i)
+                      for i in range(3)]
+
+    def expected(self, sites):
+        return haversine_matrix([(float(site.latitude), float(site.longitude)) for site in sites])
+
+    def assertDistances(self, sites):
+        matrix = self.cache.submatrix(self.city.pk, [site.pk for site in sites])
+        np.testing.assert_allclose(matrix, self.expected(sites), rtol=1e-5, atol=1e-3)
+
+    def test_rebuild(self):
+        self.assertIsNone(self.cache.submatrix(self.city.pk, [self.sites[0].pk]))
+        create_site('unlocated', city=self.city)
+        self.cache.rebuild(self.city.pk)
+        self.assertEqual(self.cache.load(self.city.pk).ids, [site.pk for site in self.sites])
+        self.assertEqual(self.cache.load(self.city.pk).matrix.dtype, np.float32)
+        self.assertDistances(self.sites)
+        self.assertDistances(self.sites[::-1])
+
+    def test_updates_single_sites(self):
+        self.cache.rebuild(self.city.pk)
+        site = create_site('new', city=self.city, latitude='34.250000', longitude='108.950000')
+        self.cache.update_site(site)
+        self.assertDistances(self.sites + [site])
+        self.sites[1].latitude = '34.300000'
+        self.sites[1].save()
+        self.cache.update_site(self.sites[1])
+        self.assertDistances(self.sites + [site])
+        self.cache.remove_site(self.sites[0].pk, self.city.pk)
+        self.assertIsNone(self.cache.submatrix(self.city.pk, [self.sites[0].pk]))
+        self.assertDistances(self.sites[1:] + [site])
+        # A single version of the matrix is kept on disk
+        self.assertEqual(len([name for name in os.listdir(self.cache.directory) if name.endswith('.npy')]), 1)
+
+    def test_moves_between_cities(self):
+        self.cache.rebuild(self.city.pk)
+        other = City.objects.create(country_name='China', city_name='Beijing')
+        self.cache.rebuild(other.pk)
+        site = self.sites[2]
+        site.city = other
+        site.save()
+        self.cache.update_site(site, previous_city_id=self.city.pk)
+        self.assertEqual(self.cache.load(self.city.pk).ids, [self.sites[0].pk, self.sites[1].pk])
+        self.assertEqual(self.cache.load(other.pk).ids, [site.pk])
+
+    def test_no_update_without_cache(self):
+        self.cache.update_site(self.sites[0])
+        self.assertIsNone(self.cache.load(self.city.pk))
+        self.cache.rebuild(self.city.pk)
+        self.cache.clear(self.city.pk)
+        self.assertIsNone(self.cache.load(self.city.pk))
+
+    def test_delete_endpoint_drops_row(self):
+        self.cache.rebuild(self.city.pk)
+        self.client.force_authenticate(create_user('admin', is_staff=True))
+        with mock.patch.object(distance_cache, 'directory', self.cache.directory):
+            self.assertEqual(self.client.delete('/api/attraction/%d/' % self.sites[0].pk).status_code, 204)
+        self.assertEqual(self.cache.load(self.city.pk).ids, [self.sites[1].pk, self.sites[2].pk])
+
+    def test_build_command(self):
+        out = StringIO()
+        with mock.patch.object(distance_cache, 'directory', self.cache.directory):
+            call_command('build_distance_cache', city=[self.city.pk], stdout=out)
+        self.assertIn('3 sites', out.getvalue())
+        self.assertDistances(self.sites)
+
+
+class SearchTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(SearchTestCase, self).setUp()
+        self.xian = City.objects.create(country_name='China', city_name="Xi'an")
+        self.wall = create_site('City Wall', city=self.xian, description='Ming dynasty fortifications')
+        self.noodles = create_site('Biangbiang', 'Restaurant', city=self.xian,
+                                   description='Hand pulled noodles by the city wall')
+        self.palace = create_site('Forbidden City', description='Imperial palace')
+        self.itinerary = create_itinerary(self.user, [[self.wall]], title='Noodle tour',
+                                          description='Along the wall')
+        self.private = create_itinerary(self.user, title='Private walls', is_public=False)
+        for site in (self.wall, self.noodles, self.palace):
+            index_site(site)
+        for itinerary in (self.itinerary, self.private):
+            index_itinerary(itinerary)
+
+    def search(self, q, **params):
+        response = self.client.get('/api/search/', dict(params, q=q))
+        self.assertEqual(response.status_code, 200)
+        return [(result['type'], result['id']) for result in response.data]
+
+    def test_ranks_title_matches_first(self):
+        self.assertEqual(self.search('wall'), [('site', self.wall.pk), ('itinerary', self.itinerary.pk),
+                                               ('site', self.noodles.pk)])
+
+    def test_every_word_as_prefix(self):
+        self.assertEqual(self.search('nood WALL'), [('itinerary', self.itinerary.pk), ('site', self.noodles.pk)])
+        self.assertEqual(self.search('imperial palace'), [('site', self.palace.pk)])
+        self.assertEqual(self.search('palace noodles'), [])
+        self.assertEqual(self.search('  '), [])
+
+    def test_filters(self):
+        self.assertEqual(self.search('wall', type='itinerary'), [('itinerary', self.itinerary.pk)])
+        self.assertEqual(self.search('wall', category='Restaurant'), [('site', self.noodles.pk)])
+        self.assertEqual(self.search('city', city=self.xian.pk),
+                         [('site', self.wall.pk), ('site', self.noodles.pk)])
+        # Itineraries match a city they visit
+        self.assertEqual(self.search('noodle', city=self.xian.pk),
+                         [('itinerary', self.itinerary.pk), ('site', self.noodles.pk)])
+
+    def test_pagination(self):
+        response = self.client.get('/api/search/', {'q': 'wall', 'limit': 2})
+        self.assertEqual(len(response.data), 2)
+        self.assertIn('offset=2', response['Link'])
+        response = self.client.get('/api/search/', {'q': 'wall', 'limit': 2, 'offset': 2})
+        self.assertEqual([result['id'] for result in response.data], [self.noodles.pk])
+        self.assertNotIn('Link', response)
+
+    def test_deletes_remove_documents(self):
+        Attraction.objects.get(pk=self.wall.pk).delete()
+        self.itinerary.delete()
+        self.assertEqual(self.search('wall'), [('site', self.noodles.pk)])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/search/', {'q': 'wall', 'type': 'city'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/search/', {'q': 'wall', 'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get('/api/search/', {'q': 'wall', 'city': 'here'}).status_code, 400)
+
+
+class PythonSearchTestCase(SearchTestCase):
+    """
+    The same searches without a full-text index
+    """
+
+    def setUp(self):
+        super(PythonSearchTestCase, self).setUp()
+        patcher = mock.patch('api.search.get_backend', return_value='python')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class AutocompleteTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(AutocompleteTestCase, self).setUp()
+        self.xian = City.objects.create(country_name='China', city_name="Xi'an")
+        self.xiamen = City.objects.create(country_name='China', city_name='Xiamen')
+        self.tower = create_site('Bell Tower', city=self.xian)
+        self.drum = create_site('Drum Tower', city=self.xian)
+        self.cafe = create_site('Café Xian', 'Restaurant', city=self.xiamen)
+        # The Bell Tower is in more day trips
+        create_itinerary(self.user, [[self.tower], [self.tower, self.drum]])
+        self.index = AutocompleteIndex()
+
+    def lookup(self, prefix, kind=None):
+        return [(item_kind, pk) for item_kind, pk, name in self.index.lookup(prefix, kind)]
+
+    def test_popular_first(self):
+        self.assertEqual(self.lookup('tow'), [(SITE, self.tower.pk), (SITE, self.drum.pk)])
+        self.assertEqual(self.lookup('xi'), [(CITY, self.xian.pk), (CITY, self.xiamen.pk), (SITE, self.cafe.pk)])
+        self.assertEqual(self.lookup('xi', CITY), [(CITY, self.xian.pk), (CITY, self.xiamen.pk)])
+
+    def test_normalized_word_prefixes(self):
+        self.assertEqual(self.lookup('CAFE'), [(SITE, self.cafe.pk)])
+        self.assertEqual(self.lookup('bell t'), [(SITE, self.tower.pk)])
+        self.assertEqual(self.lookup('ower'), [])
+        self.assertEqual(self.lookup(' '), [])
+
+    def test_changes(self):
+        self.lookup('tow')
+        self.index.update(SITE, self.drum.pk, 'Drum Tower of Xian')
+        self.index.remove(SITE, self.tower.pk)
+        self.index.update(CITY, 99, 'Towerville')
+        self.assertEqual(self.lookup('tow'), [(SITE, self.drum.pk), (CITY, 99)])
+        self.assertEqual(self.lookup('of x'), [(SITE, self.drum.pk)])
+
+    def test_reloads_when_stale(self):
+        index = AutocompleteIndex(max_age=0)
+        self.assertEqual(len(index.lookup('tow')), 2)
+        create_site('Tower Bridge')
+        self.assertEqual(len(index.lookup('tow')), 3)
+        self.assertEqual(len(self.index.lookup('tow')), 3)
+        create_site('Tower Hill')
+        # Reloaded only once older than max_age
+        self.assertEqual(len(self.index.lookup('tow')), 3)
+
+    def test_endpoint(self):
+        with mock.patch('api.views.search.autocomplete_index', self.index):
+            response = self.client.get('/api/autocomplete/', {'q': 'tow', 'limit': 1})
+            self.assertEqual(response.data, [{'type': SITE, 'id': self.tower.pk, 'name': 'Bell Tower'}])
+            response = self.client.get('/api/autocomplete/', {'q': 'xi', 'type': 'city'})
+            self.assertEqual([result['id'] for result in response.data], [self.xian.pk, self.xiamen.pk])
+            self.assertEqual(self.client.get('/api/autocomplete/', {'q': 'xi', 'type': 'hotel'}).status_code, 400)
+            self.assertEqual(self.client.get('/api/autocomplete/', {'q': 'xi', 'limit': 'all'}).status_code, 400)
+
+
+class PoiListTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(PoiListTestCase, self).setUp()
+        self.xian = City.objects.create(country_name='China', city_name="Xi'an")
+        self.beijing = City.objects.create(country_name='China', city_name='Beijing')
+
+    def ids(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return [row['site']['id'] for row in response.data]
+
+    def test_attractions_paginated_and_filtered(self):
+        sites = [create_site('attraction%d' % i, city=self.xian if i % 2 else self.beijing) for i in range(5)]
+        Attraction.objects.filter(pk=sites[4].pk).update(category='park')
+        response = self.client.get('/api/attraction/', {'limit': 2})
+        self.assertEqual([row['site']['id'] for row in response.data], [sites[0].pk, sites[1].pk])
+        response = self.client.get('/api/attraction/', {'limit': 2, 'cursor': response['X-Next-Cursor']})
+        self.assertEqual([row['site']['id'] for row in response.data], [sites[2].pk, sites[3].pk])
+        self.assertEqual(self.ids('/api/attraction/', city=self.xian.pk), [sites[1].pk, sites[3].pk])
+        self.assertEqual(self.ids('/api/attraction/', category='park'), [sites[4].pk])
+        self.assertEqual(self.ids('/api/attraction/', city=self.xian.pk, category='park'), [])
+
+    def test_ranges(self):
+        hotels = [create_site('hotel%d' % i, 'Hotel') for i in range(3)]
+        for hotel, star_rate in zip(hotels, ['2.5', '4.0', '5.0']):
+            Hotel.objects.filter(pk=hotel.pk).update(star_rate=star_rate)
+        self.assertEqual(self.ids('/api/hotel/', star_rate_min='3'), [hotels[1].pk, hotels[2].pk])
+        self.assertEqual(self.ids('/api/hotel/', star_rate_min='2.5', star_rate_max='4.5'),
+                         [hotels[0].pk, hotels[1].pk])
+        self.assertEqual(self.client.get('/api/hotel/', {'star_rate_max': 'five'}).status_code, 400)
+        restaurants = [create_site('restaurant%d' % i, 'Restaurant') for i in range(3)]
+        for restaurant, open_at in zip(restaurants, [100, 200, 300]):
+            Restaurant.objects.filter(pk=restaurant.pk).update(open_at=open_at)
+        self.assertEqual(self.ids('/api/restaurant/', open_at_max=200), [restaurants[0].pk, restaurants[1].pk])
+
+    def test_query_count_independent_of_rows(self):
+        create_site('first', city=self.xian)
+        response, few = self.count_queries(self.client.get, '/api/attraction/')
+        for i in range(5):
+            create_site('more%d' % i, city=self.beijing)
+        response, many = self.count_queries(self.client.get, '/api/attraction/')
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(response.data[1]['site']['city']['city_name'], 'Beijing')
+        self.assertEqual(few, many)
+
+
+class SiteListTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(SiteListTestCase, self).setUp()
+        self.xian = City.objects.create(country_name='China', city_name="Xi'an")
+        self.museum = create_site('museum', city=self.xian)
+        self.park = create_site('park')
+        Attraction.objects.filter(pk=self.park.pk).update(category='park')
+        self.noodles = create_site('noodles', 'Restaurant', city=self.xian)
+        self.inn = create_site('inn', 'Hotel', city=self.xian)
+        self.resort = create_site('resort', 'Hotel')
+        Hotel.objects.filter(pk=self.resort.pk).update(category='resort', star_rate='4.5')
+        # Its attraction was deleted
+        self.orphan = create_site('orphan', city=self.xian)
+        Attraction.objects.filter(pk=self.orphan.pk).delete()
+
+    def test_lists_subtypes(self):
+        response = self.client.get('/api/site/')
+        self.assertEqual([site['id'] for site in response.data],
+                         [self.museum.pk, self.park.pk, self.noodles.pk, self.inn.pk, self.resort.pk])
+        self.assertEqual(response.data[0]['details']['category'], 'museum')
+        self.assertEqual(response.data[2]['details']['open_at'], 0)
+        self.assertEqual(response.data[4]['details']['star_rate'], '4.5')
+
+    def test_filters(self):
+        response = self.client.get('/api/site/', {'city': self.xian.pk, 'category': 'Hotel'})
+        self.assertEqual([site['id'] for site in response.data], [self.inn.pk])
+        response = self.client.get('/api/site/', {'subcategory': 'park'})
+        self.assertEqual([site['id'] for site in response.data], [self.park.pk])
+        response = self.client.get('/api/site/', {'star_rate_min': '4.2'})
+        self.assertEqual([site['id'] for site in response.data], [self.resort.pk])
+
+    def test_facets(self):
+        response, queries = self.count_queries(self.client.get, '/api/site/facets/')
+        self.assertEqual(queries, 1)
+        self.assertEqual(response.data, {
+            'site_category': {'Attraction': 2, 'Restaurant': 1, 'Hotel': 2},
+            'category': {'museum': 1, 'park': 1, 'noodles': 1, 'inn': 1, 'resort': 1},
+            'star_rate': {4: 2},
+            'city': {self.xian.pk: 3},
+        })
+        response = self.client.get('/api/site/facets/', {'city': self.xian.pk})
+        self.assertEqual(response.data['site_category'], {'Attraction': 1, 'Restaurant': 1, 'Hotel': 1})
+
+
+class ImportSitesTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ImportSitesTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write(content)
+        return path
+
+    def write_ndjson(self, name, records):
+        return self.write(name, '\n'.join(record if isinstance(record, str) else json.dumps(record)
+                                          for record in records) + '\n')
+
+    def import_sites(self, *args, **options):
+        out, err = StringIO(), StringIO()
+        call_command('import_sites', *args, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def record(self, name, **fields):
+        return dict({'name': name, 'site_category': 'Attraction', 'url': 'https://example.com/' + name,
+                     'city': "Xi'an", 'country': 'China', 'category': 'landmark'}, **fields)
+
+    def test_imports_ndjson(self):
+        path = self.write_ndjson('sites.ndjson', [
+            self.record('Bell Tower', latitude=34.2612, longitude=108.9423, description='Ming dynasty'),
+            self.record('Biangbiang', site_category='Restaurant', open_at=3600, city='Beijing'),
+            self.record('Inn', site_category='Hotel', star_rate='4.5'),
+        ])
+        out, err = self.import_sites(path, batch_size=2)
+        self.assertIn('created 3 sites, updated 0, skipped 0 invalid records, created 2 cities', out)
+        tower = Site.objects.get(name='Bell Tower')
+        self.assertEqual(tower.city.city_name, "Xi'an")
+        self.assertEqual(tower.geohash, geohash_encode(34.2612, 108.9423))
+        self.assertEqual(Attraction.objects.get(pk=tower.pk).category, 'landmark')
+        self.assertEqual(Restaurant.objects.get(site__name='Biangbiang').open_at, 3600)
+        self.assertEqual(str(Hotel.objects.get(site__name='Inn').star_rate), '4.5')
+        self.assertTrue(SearchDocument.objects.filter(kind=SearchDocument.SITE, object_id=tower.pk,
+                                                      body__contains='Ming').exists())
+
+    def test_updates_by_url(self):
+        site = create_site('Bell Tower', description='old')
+        path = self.write('sites.csv', 'name,site_category,url,city,country,description,star_rate\n'
+                                       'Bell Tower,Hotel,https://example.com/Bell Tower,Xi\'an,China,new,3\n'
+                                       'Drum Tower,Attraction,https://example.com/Drum Tower,Xi\'an,China,,\n')
+        out, err = self.import_sites(path)
+        self.assertIn('created 1 sites, updated 1', out)
+        site.refresh_from_db()
+        self.assertEqual(site.description, 'new')
+        # It changed category
+        self.assertFalse(Attraction.objects.filter(pk=site.pk).exists())
+        self.assertEqual(str(Hotel.objects.get(pk=site.pk).star_rate), '3.0')
+        self.assertEqual(Site.objects.count(), 2)
+
+    def test_reports_invalid_records(self):
+        path = self.write_ndjson('sites.ndjson', [
+            self.record('Valid'),
+            self.record('Nowhere', latitude='NaN', longitude=0),
+            self.record('Far', latitude=91, longitude=0),
+            self.record('Bar', site_category='Bar'),
+            '{"name": ',
+            self.record('Hotel', site_category='Hotel', star_rate=6),
+        ])
+        out, err = self.import_sites(path)
+        self.assertIn('created 1 sites, updated 0, skipped 5 invalid records', out)
+        self.assertIn('sites.ndjson:2: Invalid latitude: NaN', err)
+        self.assertIn('sites.ndjson:3: latitude out of range: 91', err)
+        self.assertIn('sites.ndjson:4: Invalid site_category: Bar', err)
+        self.assertIn('sites.ndjson:5: Invalid JSON', err)
+        self.assertIn('sites.ndjson:6: star_rate out of range: 6', err)
+        self.assertEqual(list(Site.objects.values_list('name', flat=True)), ['Valid'])
+
+    def test_rebuilds_cached_distances(self):
+        xian = City.objects.create(country_name='China', city_name="Xi'an")
+        beijing = City.objects.create(country_name='China', city_name='Beijing')
+        create_site('Drum Tower', city=xian, latitude='34.263400', longitude='108.939600')
+        cache = DistanceCache(self.directory)
+        cache.rebuild(xian.pk)
+        path = self.write_ndjson('sites.ndjson', [
+            self.record('Bell Tower', latitude=34.2612, longitude=108.9423),
+            self.record('Palace', city='Beijing', latitude=39.9163, longitude=116.3972),
+        ])
+        with mock.patch.object(distance_cache, 'directory', self.directory):
+            out, err = self.import_sites(path)
+        self.assertIn('Rebuilt the distances of 1 cities', out)
+        self.assertEqual(len(cache.load(xian.pk).ids), 2)
+        self.assertIsNone(cache.load(beijing.pk))
+
+    def test_missing_file(self):
+        with self.assertRaises(CommandError):
+            self.import_sites(os.path.join(self.directory, 'missing.ndjson'))
+
+
+class ExportTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        self.xian = City.objects.create(country_name='China', city_name="Xi'an")
+        self.tower = create_site('Bell Tower', city=self.xian, latitude='34.261200', longitude='108.942300')
+        self.noodles = create_site('Biangbiang', 'Restaurant', city=self.xian)
+        self.inn = create_site('Inn', 'Hotel')
+        orphan = create_site('orphan')
+        Attraction.objects.filter(pk=orphan.pk).delete()
+        self.itinerary = create_itinerary(self.user, [[self.tower, self.noodles], [self.inn]], title='Shaanxi')
+        self.empty = create_itinerary(self.user, title='Someday')
+        create_itinerary(self.user, [[self.tower]], is_public=False)
+        self.client.force_authenticate(create_user('admin', is_staff=True))
+
+    def export(self, kind, **params):
+        response = self.client.get('/api/export/%s/' % kind, params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def export_ndjson(self, kind, **params):
+        return [json.loads(line) for line in self.export(kind, **params).splitlines()]
+
+    def export_csv(self, kind, **params):
+        return list(csv.DictReader(self.export(kind, output='csv', **params).splitlines()))
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_sites(self):
+        rows = self.export_ndjson('site')
+        self.assertEqual([row['id'] for row in rows], [self.tower.pk, self.noodles.pk, self.inn.pk])
+        self.assertEqual(rows[0]['city'], "Xi'an")
+        self.assertEqual(rows[0]['category'], 'museum')
+        self.assertEqual(rows[0]['latitude'], '34.261200')
+        self.assertEqual(rows[1]['open_at'], 0)
+        self.assertEqual(rows[2]['star_rate'], '4.0')
+        self.assertEqual([row['id'] for row in self.export_ndjson('site', city=self.xian.pk, category='Restaurant')],
+                         [self.noodles.pk])
+
+    def test_sites_csv(self):
+        rows = self.export_csv('site')
+        self.assertEqual([row['name'] for row in rows], ['Bell Tower', 'Biangbiang', 'Inn'])
+        self.assertEqual(rows[2]['star_rate'], '4.0')
+        self.assertEqual(rows[2]['city'], '')
+
+    def test_sites_can_be_imported(self):
+        for row in self.export_ndjson('site', city=self.xian.pk):
+            site, subtype, city = parse_record(row)
+            self.assertEqual(site['url'], 'https://example.com/' + row['name'])
+            self.assertEqual(city, ('China', "Xi'an"))
+
+    @override_settings(EXPORT_CHUNK_SIZE=1)
+    def test_itineraries(self):
+        rows = self.export_ndjson('itinerary')
+        self.assertEqual([row['title'] for row in rows], ['Shaanxi', 'Someday'])
+        self.assertEqual(rows[0]['owner'], 'owner')
+        self.assertEqual(rows[0]['days'], [
+            {'day': 0, 'sites': [{'id': self.tower.pk, 'name': 'Bell Tower'},
+                                 {'id': self.noodles.pk, 'name': 'Biangbiang'}]},
+            {'day': 1, 'sites': [{'id': self.inn.pk, 'name': 'Inn'}]},
+        ])
+        self.assertEqual(rows[1]['days'], [])
+
+    def test_itineraries_csv(self):
+        rows = self.export_csv('itinerary')
+        self.assertEqual([(row['title'], row['day'], row['position'], row['site_name']) for row in rows], [
+            ('Shaanxi', '0', '0', 'Bell Tower'),
+            ('Shaanxi', '0', '1', 'Biangbiang'),
+            ('Shaanxi', '1', '0', 'Inn'),
+            ('Someday', '', '', ''),
+        ])
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get('/api/export/site/', {'output': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/export/site/', {'category': 'Bar'}).status_code, 400)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/export/site/').status_code, 403)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/export/itinerary/').status_code, 401)
+
+
+def image_file(size, mode='RGB', image_format='JPEG'):
+    output = BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)).save(output, image_format)
+    return ContentFile(output.getvalue())
+
+
+class ImageVariantsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.storage = FileSystemStorage(os.path.join(directory, 'media'), '/media/')
+        self.processor = ImageProcessor(self.storage, FileSystemStorage(os.path.join(directory, 'media'), '/media/'),
+                                        workers=1)
+
+    def test_render_variants(self):
+        variants = {(variant, extension): Image.open(BytesIO(content))
+                    for variant, extension, content in render_variants(Image.new('RGB', (2000, 1000)))}
+        self.assertEqual(variants['thumb', 'webp'].size, (320, 160))
+        self.assertEqual(variants['card', 'jpeg'].size, (800, 400))
+        self.assertEqual(variants['full', 'webp'].format, 'WEBP')
+        self.assertEqual(variants['full', 'jpeg'].size, (1920, 960))
+        # Small images are not enlarged, transparent ones are flattened in JPEG
+        variants = {(variant, extension): Image.open(BytesIO(content))
+                    for variant, extension, content in render_variants(Image.new('RGBA', (100, 50)))}
+        self.assertEqual(variants['full', 'jpeg'].size, (100, 50))
+        self.assertEqual(variants['full', 'jpeg'].mode, 'RGB')
+        self.assertEqual(variants['full', 'webp'].mode, 'RGBA')
+
+    def test_urls_point_to_original_until_processed(self):
+        name = self.storage.save('itinerary/a.jpg', image_file((1000, 1000)))
+        with mock.patch.object(self.processor, 'schedule') as schedule:
+            urls = self.processor.urls(name)
+        schedule.assert_called_once_with(name)
+        self.assertEqual(urls['original'], '/media/itinerary/a.jpg')
+        self.assertEqual(urls['thumb'], {'webp': '/media/itinerary/a.jpg', 'jpeg': '/media/itinerary/a.jpg'})
+
+        self.processor.schedule(name).result()
+        self.assertTrue(self.storage.exists(variant_name(name, 'thumb', 'webp')))
+        urls = self.processor.urls(name)
+        self.assertEqual(urls['thumb']['webp'], '/media/variants/itinerary/a.thumb.webp')
+        self.assertEqual(urls['card']['jpeg'], '/media/variants/itinerary/a.card.jpeg')
+        self.processor.delete_variants(name)
+        self.assertFalse(self.storage.exists(variant_name(name, 'full', 'jpeg')))
+
+    def test_failures_are_retried_later(self):
+        self.processor.schedule('itinerary/missing.jpg').result()
+        self.assertIsNone(self.processor.schedule('itinerary/missing.jpg'))
+        self.storage.save('itinerary/missing.jpg', image_file((10, 10)))
+        with mock.patch('api.images.time.monotonic', return_value=time.monotonic() + 60):
+            self.processor.schedule('itinerary/missing.jpg').result()
+        self.assertTrue(self.storage.exists(variant_name('itinerary/missing.jpg', 'full', 'webp')))
+
+    def test_serializer_field(self):
+        name = self.storage.save('site/b.png', image_file((10, 10), image_format='PNG'))
+        self.processor.process(name)
+        with mock.patch('api.images.image_processor', self.processor):
+            data = SiteReadSerializer(Site(name='b', photo=name)).data
+        self.assertEqual(data['photo']['thumb']['jpeg'], '/media/variants/site/b.thumb.jpeg')
+        self.assertEqual(data['photo']['original'], '/media/site/b.png')
+
+
+class ContentAddressedStorageTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.storage = ContentAddressedStorage(directory)
+
+    def test_same_content_stored_once(self):
+        name = self.storage.save('itinerary/a.JPG', ContentFile(b'photo'))
+        digest = hashlib.sha256(b'photo').hexdigest()
+        self.assertEqual(name, 'blobs/%s/%s/%s.jpg' % (digest[:2], digest[2:4], digest))
+        self.assertEqual(self.storage.save('profile/b.jpg', ContentFile(b'photo')), name)
+        self.assertNotEqual(self.storage.save('itinerary/a.jpg', ContentFile(b'other')), name)
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), b'photo')
+        self.assertFalse([file_name for file_name in os.listdir(self.storage.path('blobs'))
+                          if file_name.startswith('.upload-')])
+
+    def test_blobs_are_only_deleted_explicitly(self):
+        name = self.storage.save('a.jpg', ContentFile(b'photo'))
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete_blob(name)
+        self.assertFalse(self.storage.exists(name))
+
+
+class MediaReferencesTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(MediaReferencesTestCase, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(MEDIA_ROOT=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(image_processor, 'schedule')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_itinerary(self, content):
+        itinerary = Itinerary(owner=self.user, title='Trip', description='')
+        itinerary.image.save('a.jpg', ContentFile(content), save=False)
+        itinerary.save()
+        return itinerary
+
+    def refcounts(self):
+        return dict(MediaBlob.objects.values_list('name', 'refcount'))
+
+    def test_counts_references(self):
+        first = self.create_itinerary(b'photo')
+        fork = self.create_itinerary(b'photo')
+        name = first.image.name
+        self.assertEqual(fork.image.name, name)
+        self.assertEqual(self.refcounts(), {name: 2})
+        city = City.objects.create(country_name='China', city_name="Xi'an", photo=name)
+        self.assertEqual(self.refcounts(), {name: 3})
+
+        fork.image.save('b.jpg', ContentFile(b'other'))
+        self.assertEqual(self.refcounts(), {name: 2, fork.image.name: 1})
+        first.delete()
+        city.delete()
+        self.assertEqual(self.refcounts(), {fork.image.name: 1})
+        # Unreferenced files are deleted once the transaction commits, unless uploaded again lately
+        self.assertFalse(media.delete_blob(name))
+        with mock.patch.object(media, 'RECENT_FILE_AGE', -60):
+            self.assertFalse(media.delete_blob(fork.image.name))
+            self.assertTrue(media.delete_blob(name))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, name)))
+
+    def test_reconcile(self):
+        itinerary = self.create_itinerary(b'photo')
+        name = itinerary.image.name
+        orphan = self.create_itinerary(b'orphan').image.name
+        # Updates skip signals
+        Itinerary.objects.update(image=name)
+        with mock.patch.object(media, 'RECENT_FILE_AGE', -60):
+            self.assertEqual(media.reconcile(), (1, 1))
+        self.assertEqual(self.refcounts(), {name: 2})
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, orphan)))
+
+    def test_blobs_cached_forever(self):
+        name = self.create_itinerary(b'photo').image.name
+        response = self.client.get('/media/' + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content) if response.streaming else response.content,
+                         b'photo')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn(name.rsplit('/', 1)[1][:-4], response['ETag'])
+
+
+class MediaRequestTestCase(SimpleTestCase):
+    etag = '"3a7f.jpg"'
+    last_modified = 1600000000
+
+    def get_range(self, size, header, **extra):
+        request = RequestFactory().get('/', HTTP_RANGE=header, **extra)
+        return get_range(request, self.etag, self.last_modified, size)
+
+    def test_ranges(self):
+        self.assertEqual(self.get_range(10, 'bytes=0-4'), (0, 4))
+        self.assertEqual(self.get_range(10, 'bytes=5-'), (5, 9))
+        self.assertEqual(self.get_range(10, 'bytes=5-100'), (5, 9))
+        self.assertEqual(self.get_range(10, 'bytes=-3'), (7, 9))
+        self.assertEqual(self.get_range(10, 'bytes=-30'), (0, 9))
+
+    def test_unsatisfiable_ranges(self):
+        self.assertIs(self.get_range(10, 'bytes=10-'), False)
+        self.assertIs(self.get_range(10, 'bytes=4-2'), False)
+        self.assertIs(self.get_range(10, 'bytes=-0'), False)
+        self.assertIs(self.get_range(0, 'bytes=-5'), False)
+        self.assertIs(self.get_range(0, 'bytes=0-'), False)
+
+    def test_whole_file(self):
+        self.assertIsNone(get_range(RequestFactory().get('/'), self.etag, self.last_modified, 10))
+        self.assertIsNone(self.get_range(10, 'bytes=-'))
+        self.assertIsNone(self.get_range(10, 'bytes=0-1,4-5'))
+        self.assertIsNone(self.get_range(10, 'items=0-1'))
+
+    def test_if_range(self):
+        self.assertEqual(self.get_range(10, 'bytes=0-1', HTTP_IF_RANGE=self.etag), (0, 1))
+        self.assertEqual(self.get_range(10, 'bytes=0-1', HTTP_IF_RANGE=http_date(self.last_modified)), (0, 1))
+        self.assertIsNone(self.get_range(10, 'bytes=0-1', HTTP_IF_RANGE='"other"'))
+        self.assertIsNone(self.get_range(10, 'bytes=0-1', HTTP_IF_RANGE=http_date(self.last_modified + 1)))
+
+    def is_not_modified(self, **headers):
+        return is_not_modified(RequestFactory().get('/', **headers), self.etag, self.last_modified)
+
+    def test_conditional(self):
+        self.assertFalse(self.is_not_modified())
+        self.assertTrue(self.is_not_modified(HTTP_IF_NONE_MATCH=self.etag))
+        self.assertTrue(self.is_not_modified(HTTP_IF_NONE_MATCH='"other", W/' + self.etag))
+        self.assertTrue(self.is_not_modified(HTTP_IF_NONE_MATCH='*'))
+        self.assertFalse(self.is_not_modified(HTTP_IF_NONE_MATCH='"other"'))
+        self.assertTrue(self.is_not_modified(HTTP_IF_MODIFIED_SINCE=http_date(self.last_modified)))
+        self.assertFalse(self.is_not_modified(HTTP_IF_MODIFIED_SINCE=http_date(self.last_modified - 1)))
+        # If-None-Match takes precedence over If-Modified-Since
+        self.assertFalse(self.is_not_modified(HTTP_IF_NONE_MATCH='"other"',
+                                              HTTP_IF_MODIFIED_SINCE=http_date(self.last_modified)))
+
+
+class ServeMediaTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(MEDIA_ROOT=directory, MEDIA_MAX_AGE=60)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(directory, 'itinerary'))
+        with open(os.path.join(directory, 'itinerary', 'a.txt'), 'wb') as stream:
+            stream.write(b'0123456789')
+
+    def get(self, path='/media/itinerary/a.txt', **headers):
+        return self.client.get(path, **headers)
+
+    def body(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b'0123456789')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        response = self.get(HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_missing_files(self):
+        self.assertEqual(self.get('/media/itinerary/b.txt').status_code, 404)
+        self.assertEqual(self.get('/media/itinerary').status_code, 404)
+        self.assertEqual(self.get('/media/../settings.py').status_code, 404)
+        self.assertEqual(self.client.post('/media/itinerary/a.txt').status_code, 405)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT='nginx')
+    def test_accel_redirect(self):
+        response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/itinerary/a.txt')
+        self.assertEqual(response.content, b'')
@@ -1,14 +1,17 @@
 from rest_framework.routers import SimpleRouter
 from rest_framework_nested import routers
 
-from api.views.itinerary import DayTripViewSet, DayTripSiteViewSet, ItineraryViewSet, HighlightViewSet, FeaturedViewSet, \
-    LikeViewSet, CommentViewSet
-from api.views.poi import CityViewSet, AttractionViewSet, RestaurantViewSet, HotelViewSet
+from api.views.export import ExportViewSet
+from api.views.itinerary import DayTripViewSet, DayTripSiteViewSet, ItineraryViewSet, HighlightViewSet, \
+    FeaturedViewSet, LikeViewSet, CommentViewSet
+from api.views.poi import CityViewSet, SiteViewSet, AttractionViewSet, RestaurantViewSet, HotelViewSet
+from api.views.search import SearchViewSet, AutocompleteViewSet
 from api.views.user import UserView, GroupViewSet
 
 router = SimpleRouter()
 # POI
 router.register(r'city', CityViewSet, basename='city')
+router.register(r'site', SiteViewSet, basename='site')
 router.register(r'attraction', AttractionViewSet, basename='attraction')
 router.register(r'restaurant', RestaurantViewSet, basename='restaurant')
 router.register(r'hotel', HotelViewSet, basename='hotel')
@@ -22,6 +25,13 @@ router.register(r'featured', FeaturedViewSet, basename='featured')
 router.register(r'like', LikeViewSet, basename='like')
 router.register(r'comment', CommentViewSet, basename='comment')
 
+# Search
+router.register(r'search', SearchViewSet, basename='search')
+router.register(r'autocomplete', AutocompleteViewSet, basename='autocomplete')
+
+# Export
+router.register(r'export', ExportViewSet, basename='export')
+
 # User
 router.register(r'user', UserView, basename='user')
 router.register(r'group', GroupViewSet, basename='group')
@@ -0,0 +1,52 @@
+from django.http import StreamingHttpResponse
+from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from api.export import export_lines, FORMATS, NDJSON, CONTENT_TYPES
+from api.models import Site
+
+
+class ExportViewSet(viewsets.ViewSet):
+    """
+    API endpoint that streams every attraction, restaurant and hotel, or every public itinerary, as NDJSON or CSV.
+    Staff only.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        return super(ExportViewSet, self).dispatch(request, *args, **kwargs)
+
+    def stream(self, kind, file_format, **filters):
+        response = StreamingHttpResponse(export_lines(kind, file_format, **filters),
+                                         content_type=CONTENT_TYPES[file_format])
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(kind, file_format)
+        return response
+
+    @action(detail=False)
+    def site(self, request):
+        # `format` is taken by DRF to pick a renderer
+        file_format = request.query_params.get('output', NDJSON)
+        city = request.query_params.get('city', None)
+        category = request.query_params.get('category', None)
+        if file_format not in FORMATS or (category is not None and category not in dict(Site.CATEGORY_CHOICES)):
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            city = int(city) if city is not None else None
+        except ValueError:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        return self.stream('site', file_format, city=city, category=category)
+
+    @action(detail=False)
+    def itinerary(self, request):
+        file_format = request.query_params.get('output', NDJSON)
+        if file_format not in FORMATS:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        return self.stream('itinerary', file_format)
+
+    def get_permissions(self):
+        """
+        Instantiates and returns the list of permissions that this view requires.
+        """
+        permission_classes = [IsAdminUser]
+        return [permission() for permission in permission_classes]
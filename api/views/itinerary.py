@@ -1,17 +1,25 @@
 import logging
 
-from django.db import IntegrityError
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Prefetch, Count
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.response import Response
 
+from api.counters import view_counter, like_counter
 from api.group_permissions import IsOwnerOrReadOnly
 from api.models import DayTrip, Itinerary, DayTripSite, Highlight, Featured, Comment, Like, User
+from api.ordering import insert_orders, move_site, move_to_day_trip, remove_site, reorder_sites
+from api.pagination import KeysetPagination
+from api.routing import optimize_day_trip
+from api.search import index_itinerary
 from api.serializers.itinerary import DayTripSerializer, DayTripSiteReadSerializer, DayTripSiteWriteSerializer, \
-    ItinerarySerializer, ItineraryDetailSerializer, HighlightSerializer, FeaturedSerializer, FeaturedReadSerializer, \
-    CommentSerializer, LikeDetailSerializer, LikeSerializer
+    DayTripSiteBulkSerializer, ItinerarySerializer, ItineraryDetailSerializer, ItineraryFullSerializer, \
+    HighlightSerializer, FeaturedSerializer, FeaturedReadSerializer, CommentSerializer, LikeDetailSerializer, \
+    LikeCardSerializer, LikeSerializer, COMMENT_ORDERING
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +38,10 @@ class DayTripViewSet(viewsets.ViewSet):
         """
         Optionally restricts the day trips under a particular itinerary
         """
-        queryset = DayTrip.objects.all()
+        queryset = DayTrip.objects.prefetch_related(
+            Prefetch('daytripsite_set',
+                     queryset=DayTripSite.objects.with_position().select_related('site__city').order_by('order')),
+        )
         itinerary = self.request.query_params.get('itinerary', None)
         if itinerary is not None:
             iti_obj = get_object_or_404(Itinerary, pk=itinerary)
@@ -41,7 +52,8 @@ class DayTripViewSet(viewsets.ViewSet):
         return queryset
 
     def list(self, request):
-        serializer = self.serializer_class(self.get_queryset().all().order_by('day'), many=True)
+        serializer = self.serializer_class(self.get_queryset().all().order_by('day'), many=True,
+                                           context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def create(self, request):
@@ -54,7 +66,7 @@ class DayTripViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         day_trip = get_object_or_404(self.get_queryset().all(), pk=pk)
-        serializer = self.serializer_class(day_trip)
+        serializer = self.serializer_class(day_trip, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
@@ -108,6 +120,57 @@ class DayTripViewSet(viewsets.ViewSet):
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True, methods=['post'])
+    def reorder(self, request, pk=None):
+        """
+        Applies a full new order of the sites of the day trip, given as `sites`: the list of all its
+        day trip site ids in the desired order.
+        """
+        day_trip = get_object_or_404(self.get_queryset().all(), pk=pk)
+        self.check_object_permissions(request, day_trip)
+        site_ids = request.data.get('sites', None)
+        if not isinstance(site_ids, list) or not all(isinstance(site_id, int) for site_id in site_ids):
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            reorder_sites(day_trip, site_ids)
+        except ValueError as e:
+            return Response({"status": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = DayTripSiteReadSerializer(
+            DayTripSite.objects.filter(day_trip=day_trip).with_position().select_related('site__city')
+            .order_by("order"), many=True)
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['post'])
+    def optimize(self, request, pk=None):
+        """
+        Suggests the visiting order of the sites of the day trip that travels the least, optionally from the
+        day trip site `start`, and applies it when `apply` is true.
+        """
+        day_trip = get_object_or_404(self.get_queryset().all(), pk=pk)
+        self.check_object_permissions(request, day_trip)
+        start = request.data.get('start', None)
+        apply = request.data.get('apply', False)
+        if (start is not None and not isinstance(start, int)) or not isinstance(apply, bool):
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            site_ids, distance, current_distance = optimize_day_trip(day_trip.pk, start)
+        except ValueError as e:
+            return Response({"status": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if apply:
+            try:
+                reorder_sites(day_trip, site_ids)
+            except ValueError as e:
+                # The day trip changed since its sites were read
+                return Response({"status": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response({
+            "sites": site_ids,
+            "distance": round(distance, 3),
+            "current_distance": round(current_distance, 3),
+            "applied": apply,
+        })
+
     def get_permissions(self):
         """
         Instantiates and returns the list of permissions that this view requires.
@@ -149,27 +212,43 @@ class DayTripSiteViewSet(viewsets.ViewSet):
         return queryset
 
     def list(self, request):
-        serializer = self.read_serializer_class(self.get_queryset().order_by('order'), many=True)
+        serializer = self.read_serializer_class(self.get_queryset().with_position().order_by('order'), many=True,
+                                                context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
-            site = serializer.save(owner=request.user)
+            with transaction.atomic():
+                day_trip = serializer.validated_data['day_trip']
+                order, = insert_orders(day_trip.pk, serializer.validated_data['order'])
+                site = serializer.save(owner=request.user, order=order)
+            site = self.queryset.with_position().get(pk=site.pk)
             return Response(self.read_serializer_class(site).data, status=status.HTTP_201_CREATED)
         else:
             logger.error(serializer.errors)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def retrieve(self, request, pk=None):
-        day_trip = get_object_or_404(self.queryset.all(), pk=pk)
-        serializer = self.read_serializer_class(day_trip)
+        day_trip = get_object_or_404(self.queryset.with_position(), pk=pk)
+        serializer = self.read_serializer_class(day_trip, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
-        serializer = self.serializer_class(self.queryset.get(id=pk), data=request.data)
+        day_trip_site = self.queryset.get(id=pk)
+        serializer = self.serializer_class(day_trip_site, data=request.data)
         if serializer.is_valid(raise_exception=True):
-            serializer.save(owner=request.user)
+            # `order` is a dense index, translated into a stored order by moving the site
+            with transaction.atomic():
+                day_trip = serializer.validated_data['day_trip']
+                if day_trip.pk != day_trip_site.day_trip_id:
+                    move_to_day_trip(day_trip_site, day_trip.pk, serializer.validated_data['order'])
+                    serializer.save(owner=request.user, order=day_trip_site.order)
+                else:
+                    serializer.save(owner=request.user, order=day_trip_site.order)
+                    move_site(serializer.instance, serializer.validated_data['order'])
+            position = self.queryset.with_position().values_list('position', flat=True).get(pk=pk)
+            return Response(dict(serializer.data, order=position))
         else:
             logger.error(serializer.errors)
 
@@ -185,45 +264,41 @@ class DayTripSiteViewSet(viewsets.ViewSet):
             return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
 
         day_trip_site = get_object_or_404(self.queryset.all(), pk=pk)
-        original_index = day_trip_site.order
-        if new_index == day_trip_site.order:
-            pass
-        elif new_index > day_trip_site.order:
-            day_trip_site.order = -1
-            day_trip_site.save()
-            day_trip_sites = self.queryset.filter(day_trip=day_trip_site.day_trip).order_by("order")
-            for site in day_trip_sites:
-                if original_index < site.order <= new_index:
-                    site.order -= 1
-                    site.save()
-            day_trip_site.order = new_index
-            day_trip_site.save()
-        else:
-            day_trip_site.order = -1
-            day_trip_site.save()
-            day_trip_sites = self.queryset.filter(day_trip=day_trip_site.day_trip).order_by("-order")
-            for site in day_trip_sites:
-                if new_index <= site.order < original_index:
-                    site.order += 1
-                    site.save()
-            day_trip_site.order = new_index
-            day_trip_site.save()
+        move_site(day_trip_site, new_index)
         serializer = self.read_serializer_class(
-            DayTripSite.objects.filter(day_trip=day_trip_site.day_trip).order_by("order"), many=True)
+            DayTripSite.objects.filter(day_trip=day_trip_site.day_trip_id).with_position()
+            .select_related('site__city').order_by("order"), many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Adds several sites to a day trip in one request, and returns all the sites of the day trip
+        """
+        serializer = DayTripSiteBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        day_trip = serializer.validated_data['day_trip']
+        self.check_object_permissions(request, day_trip)
+        site_ids = serializer.validated_data['sites']
+
+        with transaction.atomic():
+            index = serializer.validated_data.get('order', None)
+            if index is None:
+                index = DayTripSite.objects.filter(day_trip=day_trip).count()
+            orders = insert_orders(day_trip.pk, index, len(site_ids))
+            DayTripSite.objects.bulk_create([
+                DayTripSite(owner=request.user, day_trip=day_trip, site_id=site_id, order=order)
+                for site_id, order in zip(site_ids, orders)
+            ])
+
+        serializer = self.read_serializer_class(
+            DayTripSite.objects.filter(day_trip=day_trip).with_position().select_related('site__city')
+            .order_by("order"), many=True)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     def destroy(self, request, pk=None):
         day_trip_site = get_object_or_404(self.queryset.all(), pk=pk)
-        delete_order = day_trip_site.order
-        day_trip_site.order = -1
-        day_trip_site.save()
-
-        day_trip_sites = self.queryset.filter(day_trip=day_trip_site.day_trip).order_by("order")
-        for site in day_trip_sites:
-            if site.order > delete_order:
-                site.order -= 1
-                site.save()
-        day_trip_site.delete()
+        remove_site(day_trip_site)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -244,6 +319,8 @@ class ItineraryViewSet(viewsets.ViewSet):
     """
     serializer_class = ItinerarySerializer
     serializer_detail_class = ItineraryDetailSerializer
+    serializer_full_class = ItineraryFullSerializer
+    sort_fields = ('view', 'like', 'posted_on')
 
     def dispatch(self, request, *args, **kwargs):
         return super(ItineraryViewSet, self).dispatch(request, *args, **kwargs)
@@ -253,7 +330,6 @@ class ItineraryViewSet(viewsets.ViewSet):
         Optionally restricts the itinerary if an admin user want to retrieve all itinerary
         """
         list_all = self.request.query_params.get('allPublic', None)
-        sort_by = self.request.query_params.get('sortBy', None)
         owner = self.request.query_params.get('owner', None)
         queryset = Itinerary.objects.all()
         if list_all is not None and list_all.lower() == 'true':
@@ -269,15 +345,24 @@ class ItineraryViewSet(viewsets.ViewSet):
             else:
                 # Q(is_public=True) | Q(owner=self.request.user) or condition
                 queryset = queryset.filter(Q(is_public=True) | Q(owner=self.request.user))
-        if sort_by is not None:
-            queryset = queryset.order_by('-' + sort_by)
         return queryset
 
+    def get_paginator(self):
+        """
+        Pages are keyed on (sortBy, id), most viewed / liked / recent first, or on id when no sort is given
+        """
+        sort_by = self.request.query_params.get('sortBy', None)
+        if sort_by is None:
+            return KeysetPagination(('id',))
+        if sort_by not in self.sort_fields:
+            raise ValidationError({'sortBy': 'Must be one of: ' + ', '.join(self.sort_fields) + '.'})
+        return KeysetPagination(('-' + sort_by, '-id'))
+
     def list(self, request):
-        limit = int(self.request.query_params.get('limit', 20))
-        serializer = self.serializer_class(self.get_queryset()[:limit], many=True,
-                                           context={"request": request})
-        return Response(serializer.data)
+        paginator = self.get_paginator()
+        page = paginator.paginate_queryset(self.get_queryset(), request)
+        serializer = self.serializer_class(page, many=True, context={"request": request})
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data, context={"request": request})
@@ -289,12 +374,57 @@ class ItineraryViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         itinerary = get_object_or_404(self.get_queryset(), pk=pk)
-        if itinerary.owner != self.request.user:
-            itinerary.view = itinerary.view + 1
-            itinerary.save()
+        if itinerary.owner_id != self.request.user.pk:
+            itinerary.view += view_counter.increment(itinerary.pk)
         serializer = self.serializer_detail_class(itinerary, context={"request": request})
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def full(self, request, pk=None):
+        """
+        Itinerary with its ordered day trips, their ordered sites and cities, in a fixed number of queries
+        """
+        queryset = self.get_queryset().prefetch_related(
+            Prefetch('daytrip_set', queryset=DayTrip.objects.order_by('day')),
+            Prefetch('daytrip_set__daytripsite_set',
+                     queryset=DayTripSite.objects.with_position().select_related('site__city').order_by('order')),
+        )
+        itinerary = get_object_or_404(queryset, pk=pk)
+        if itinerary.owner_id != self.request.user.pk:
+            itinerary.view += view_counter.increment(itinerary.pk)
+        serializer = self.serializer_full_class(itinerary, context={"request": request})
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['post'])
+    def fork(self, request, pk=None):
+        """
+        Copies an itinerary with its day trips and their sites into a new private itinerary of the user.
+        The image file is shared with the original rather than processed again.
+        """
+        source = get_object_or_404(self.get_queryset(), pk=pk)
+        with transaction.atomic():
+            itinerary = Itinerary.objects.create(
+                owner=request.user,
+                title=source.title,
+                image=source.image.name if source.image else None,
+                description=source.description,
+            )
+            DayTrip.objects.bulk_create([
+                DayTrip(owner=request.user, itinerary=itinerary, day=day)
+                for day in DayTrip.objects.filter(itinerary=source).values_list('day', flat=True)
+            ])
+            # bulk_create does not return ids on every database, day trips are unique per day
+            day_trip_ids = dict(DayTrip.objects.filter(itinerary=itinerary).values_list('day', 'id'))
+            DayTripSite.objects.bulk_create([
+                DayTripSite(owner=request.user, day_trip_id=day_trip_ids[day], site_id=site_id, order=order)
+                for day, site_id, order in DayTripSite.objects.filter(day_trip__itinerary=source)
+                .values_list('day_trip__day', 'site_id', 'order')
+            ])
+            index_itinerary(itinerary)
+
+        serializer = self.serializer_class(itinerary, context={"request": request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     def update(self, request, pk=None):
         serializer = self.serializer_class(self.get_queryset().get(id=pk), data=request.data,
                                            context={"request": request})
@@ -315,7 +445,7 @@ class ItineraryViewSet(viewsets.ViewSet):
         """
         Instantiates and returns the list of permissions that this view requires.
         """
-        if self.action == 'list' or self.action == 'retrieve':
+        if self.action == 'list' or self.action == 'retrieve' or self.action == 'full':
             permission_classes = [AllowAny]
         else:
             permission_classes = [IsAuthenticated, IsOwnerOrReadOnly]
@@ -352,7 +482,7 @@ class FeaturedViewSet(viewsets.ViewSet):
     def dispatch(self, request, *args, **kwargs):
         return super(FeaturedViewSet, self).dispatch(request, *args, **kwargs)
 
-    queryset = Featured.objects.all()
+    queryset = Featured.objects.select_related('itinerary')
     serializer_class = FeaturedSerializer
     serializer_read_class = FeaturedReadSerializer
 
@@ -372,7 +502,7 @@ class FeaturedViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         featured = get_object_or_404(self.queryset.all(), pk=pk)
-        serializer = self.serializer_read_class(featured)
+        serializer = self.serializer_read_class(featured, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def destroy(self, request, pk=None):
@@ -398,6 +528,7 @@ class LikeViewSet(viewsets.ViewSet):
     """
     serializer_class = LikeSerializer
     serializer_read_class = LikeDetailSerializer
+    serializer_card_class = LikeCardSerializer
     queryset = Like.objects.all()
 
     def dispatch(self, request, *args, **kwargs):
@@ -419,16 +550,25 @@ class LikeViewSet(viewsets.ViewSet):
         return queryset
 
     def list(self, request):
-        serializer = self.serializer_read_class(self.get_queryset(), many=True)
+        """
+        Lists likes with compact itinerary cards, or with the full itinerary detail if `detail=true`
+        """
+        detail = self.request.query_params.get('detail', None)
+        queryset = self.get_queryset().select_related('itinerary')
+        if detail is not None and detail.lower() == 'true':
+            serializer = self.serializer_read_class(queryset, many=True, context={"request": request})
+        else:
+            queryset = queryset.annotate(itinerary_comment_count=Count('itinerary__comments'))
+            serializer = self.serializer_card_class(queryset, many=True, context={"request": request})
         return Response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
             try:
-                like = serializer.save(owner=request.user)
-                like.itinerary.like += 1
-                like.itinerary.save()
+                with transaction.atomic():
+                    like = serializer.save(owner=request.user)
+                    like_counter.add(like.itinerary_id, 1)
             except IntegrityError:
                 return Response({"Status": "Already liked."}, status=status.HTTP_400_BAD_REQUEST)
         else:
@@ -437,16 +577,15 @@ class LikeViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         likes = self.queryset.filter(itinerary_id=pk)
-        serializer = self.serializer_class(likes, many=True)
+        serializer = self.serializer_class(likes, many=True,
+                                           context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def destroy(self, request, pk=None):
-        likes = self.queryset.filter(itinerary_id=pk, owner=request.user)
-        if len(likes) > 0:
-            for like in likes:
-                like.itinerary.like -= 1
-                like.itinerary.save()
-                like.delete()
+        with transaction.atomic():
+            deleted, _ = self.queryset.filter(itinerary_id=pk, owner=request.user).delete()
+            if deleted > 0:
+                like_counter.add(pk, -deleted)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -477,12 +616,15 @@ class CommentViewSet(viewsets.ViewSet):
         queryset = Comment.objects.all()
         itinerary = self.request.query_params.get('itinerary', None)
         if itinerary is not None:
-            queryset.filter(itinerary_id=itinerary)
+            queryset = queryset.filter(itinerary_id=itinerary)
         return queryset
 
     def list(self, request):
-        serializer = self.serializer_class(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination(COMMENT_ORDERING)
+        page = paginator.paginate_queryset(self.get_queryset(), request)
+        serializer = self.serializer_class(page, many=True,
+                                           context={"query_params": request.query_params})
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
@@ -494,7 +636,7 @@ class CommentViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         user = get_object_or_404(self.get_queryset().all(), pk=pk)
-        serializer = self.serializer_class(user)
+        serializer = self.serializer_class(user, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
@@ -0,0 +1,158 @@
+"""
+Serves uploaded media with caching headers, conditional requests and byte ranges.
+
+Files of the content-addressed storage (see api.storage) and their variants never change, so they are
+cached for a year as immutable, with their hash as ETag. Other files are cached for `MEDIA_MAX_AGE`
+seconds, with an ETag made of their modification time and size.
+
+With `MEDIA_ACCEL_REDIRECT` set, the body is left to the front server: `nginx` answers with an
+`X-Accel-Redirect` to `MEDIA_ACCEL_PREFIX` followed by the path (an `internal` location aliased to
+MEDIA_ROOT), `sendfile` with an `X-Sendfile` header holding the absolute path (Apache mod_xsendfile,
+lighttpd). Conditional requests are still answered here, without touching the file.
+"""
+import mimetypes
+import os
+import re
+import stat
+
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from django.views.decorators.http import require_safe
+
+from api.storage import is_blob
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+VARIANT_DIRECTORY = 'variants/'
+
+
+def is_immutable(path):
+    if path.startswith(VARIANT_DIRECTORY):
+        path = path[len(VARIANT_DIRECTORY):]
+    return is_blob(path)
+
+
+def get_etag(path, stats):
+    if is_immutable(path):
+        # The hash in the name, followed by the variant and format for variants
+        return quote_etag(os.path.basename(path))
+    return quote_etag('{:x}-{:x}'.format(stats.st_mtime_ns, stats.st_size))
+
+
+def strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        # Weak comparison
+        return '*' in etags or etag in [strip_weak(tag) for tag in etags]
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def get_range(request, etag, last_modified, size):
+    """
+    Returns the (start, end) inclusive byte range requested, None for the whole file, or False if it
+    cannot be satisfied. Several ranges are answered with the whole file.
+    """
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').replace(' ', ''))
+    if match is None:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        # Changed since the client got its part
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if size == 0:
+        # An empty file has no byte to send
+        return False
+    if not first:
+        # The last bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def read_file(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stats = os.stat(full_path)
+    except (SuspiciousFileOperation, ValueError, OSError):
+        raise Http404('No such file')
+    if not stat.S_ISREG(stats.st_mode):
+        raise Http404('No such file')
+
+    path = path.replace(os.sep, '/')
+    last_modified = int(stats.st_mtime)
+    etag = get_etag(path, stats)
+    max_age = IMMUTABLE_MAX_AGE if is_immutable(path) else getattr(settings, 'MEDIA_MAX_AGE', 3600)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': 'public, max-age={}{}'.format(max_age, ', immutable' if is_immutable(path) else ''),
+        'Accept-Ranges': 'bytes',
+    }
+
+    if is_not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+        for header in ('ETag', 'Last-Modified', 'Cache-Control'):
+            response[header] = headers[header]
+        return response
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    accel = getattr(settings, 'MEDIA_ACCEL_REDIRECT', None)
+    if accel is not None:
+        # The front server sends the body and answers ranges itself
+        response = HttpResponse(content_type=content_type)
+        if accel == 'nginx':
+            response['X-Accel-Redirect'] = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/') + quote(path)
+        else:
+            response['X-Sendfile'] = os.path.abspath(full_path)
+    else:
+        byte_range = get_range(request, etag, last_modified, stats.st_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(stats.st_size)
+            return response
+        start, end = byte_range or (0, stats.st_size - 1)
+        response = StreamingHttpResponse(read_file(full_path, start, end - start + 1), content_type=content_type,
+                                         status=206 if byte_range else 200)
+        response['Content-Length'] = str(end - start + 1)
+        if byte_range:
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, stats.st_size)
+
+    if encoding:
+        response['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response[header] = value
+    return response
@@ -1,13 +1,25 @@
 import logging
+from functools import reduce
+from operator import or_
 
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q, Count, Avg, Min, Max
+from django.db.models.functions import Substr, Coalesce, Floor
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 
-from api.models import City, Restaurant
-from api.serializers.poi import CitySerializer, AttractionSerializer, AttractionReadSerializer, RestaurantSerializer, \
-    RestaurantReadSerializer, HotelSerializer, HotelReadSerializer
+from api.autocomplete import autocomplete_index, CITY, SITE
+from api.distance_cache import distance_cache
+from api.geo import bounding_box, geohash_cover, geohash_cell_count, geohash_precision_for_zoom, haversine
+from api.models import City, Site, Attraction, Restaurant, Hotel
+from api.pagination import KeysetPagination
+from api.serializers.poi import CitySerializer, SiteReadSerializer, SiteDetailReadSerializer, AttractionSerializer, \
+    AttractionReadSerializer, RestaurantSerializer, RestaurantReadSerializer, HotelSerializer, HotelReadSerializer
 
 logger = logging.getLogger(__name__)
 
@@ -20,26 +32,29 @@ class CityViewSet(viewsets.ViewSet):
         return super(CityViewSet, self).dispatch(request, *args, **kwargs)
 
     def list(self, request):
-        serializer = self.serializer_class(self.queryset.all(), many=True)
+        serializer = self.serializer_class(self.queryset.all(), many=True,
+                                           context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            autocomplete_index.update(CITY, serializer.instance.pk, serializer.instance.city_name)
         else:
             logger.error(serializer.errors)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def retrieve(self, request, pk=None):
         city = get_object_or_404(self.queryset.all(), pk=pk)
-        serializer = self.serializer_class(city)
+        serializer = self.serializer_class(city, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
         serializer = self.serializer_class(self.queryset.get(id=pk), data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            autocomplete_index.update(CITY, serializer.instance.pk, serializer.instance.city_name)
         else:
             logger.error(serializer.errors)
 
@@ -47,6 +62,7 @@ class CityViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         city = get_object_or_404(self.queryset.all(), pk=pk)
+        autocomplete_index.remove(CITY, city.pk)
         city.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -61,6 +77,256 @@ class CityViewSet(viewsets.ViewSet):
         return [permission() for permission in permission_classes]
 
 
+def get_location(site):
+    return site.city_id, site.latitude, site.longitude
+
+
+def update_distance_cache(site, previous_location=None):
+    """
+    Updates the row of a created site, or of an updated site whose `previous_location` changed
+    """
+    if previous_location is not None and get_location(site) == previous_location:
+        return
+    try:
+        distance_cache.update_site(site, None if previous_location is None else previous_location[0])
+    except OSError:
+        logger.exception('Failed to update the distance cache of site %s', site.pk)
+
+
+def remove_from_distance_cache(site):
+    try:
+        distance_cache.remove_site(site.pk, site.city_id)
+    except OSError:
+        logger.exception('Failed to update the distance cache of site %s', site.pk)
+
+
+def get_poi_queryset(model, query_params, range_fields=()):
+    """
+    Optionally restricts points of interest based on city, category, and for each of `range_fields`
+    on `<field>_min` and `<field>_max`
+    """
+    queryset = model.objects.select_related('site__city')
+    city = query_params.get('city', None)
+    if city is not None:
+        queryset = queryset.filter(site__city_id=city)
+    category = query_params.get('category', None)
+    if category is not None:
+        queryset = queryset.filter(category=category)
+    for field in range_fields:
+        for suffix, lookup in (('_min', '__gte'), ('_max', '__lte')):
+            value = query_params.get(field + suffix, None)
+            if value is None:
+                continue
+            try:
+                value = model._meta.get_field(field).to_python(value)
+            except DjangoValidationError as e:
+                raise ValidationError({field + suffix: e.messages})
+            queryset = queryset.filter(**{field + lookup: value})
+    return queryset
+
+
+def get_float_params(query_params, bounds):
+    """
+    Reads float query parameters, `bounds` mapping each name to its (min, max, default).
+    Returns None if one is missing, not a number or out of bounds.
+    """
+    values = {}
+    for name, (minimum, maximum, default) in bounds.items():
+        try:
+            value = float(query_params.get(name, default))
+        except (TypeError, ValueError):
+            return None
+        if not minimum <= value <= maximum:
+            return None
+        values[name] = value
+    return values
+
+
+def within_box(queryset, min_lat, min_lng, max_lat, max_lng):
+    """
+    Restricts sites to a bounding box. The geohash prefixes of the cells covering the box narrow the rows
+    through the geohash index, and the coordinate ranges trim them to the box.
+    """
+    cells = reduce(or_, [Q(geohash__startswith=cell) for cell in geohash_cover(min_lat, min_lng, max_lat, max_lng)])
+    return queryset.filter(cells, latitude__range=(min_lat, max_lat), longitude__range=(min_lng, max_lng))
+
+
+def get_site_facets(queryset):
+    """
+    Counts sites by site category, subtype category, star rate (rounded down) and city, from a single
+    aggregate grouped by all of them
+    """
+    rows = queryset.order_by().values(
+        'site_category', 'city_id',
+        subcategory=Coalesce('attraction__category', 'restaurant__category', 'hotel__category'),
+        star_rate=Floor('hotel__star_rate'),
+    ).annotate(count=Count('id'))
+
+    facets = {'site_category': {}, 'category': {}, 'star_rate': {}, 'city': {}}
+    for row in rows:
+        for facet, value in (('site_category', row['site_category']), ('category', row['subcategory']),
+                             ('star_rate', row['star_rate']), ('city', row['city_id'])):
+            if value is None:
+                continue
+            if facet == 'star_rate':
+                value = int(value)
+            facets[facet][value] = facets[facet].get(value, 0) + row['count']
+    return facets
+
+
+class SiteViewSet(viewsets.ViewSet):
+    """
+    API endpoint that lists attractions, restaurants and hotels together, and allows sites of every
+    category to be searched by location.
+    """
+    serializer_class_read = SiteReadSerializer
+    serializer_detail_class = SiteDetailReadSerializer
+
+    def dispatch(self, request, *args, **kwargs):
+        return super(SiteViewSet, self).dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        """
+        Optionally restricts the sites based on category, city, subtype category and star rate
+        """
+        queryset = Site.objects.select_related('city')
+        query_params = self.request.query_params
+        category = query_params.get('category', None)
+        if category is not None:
+            queryset = queryset.filter(site_category=category)
+        city = query_params.get('city', None)
+        if city is not None:
+            queryset = queryset.filter(city_id=city)
+        subcategory = query_params.get('subcategory', None)
+        if subcategory is not None:
+            queryset = queryset.filter(Q(attraction__category=subcategory) | Q(restaurant__category=subcategory) |
+                                       Q(hotel__category=subcategory))
+        for suffix, lookup in (('_min', '__gte'), ('_max', '__lte')):
+            value = query_params.get('star_rate' + suffix, None)
+            if value is None:
+                continue
+            try:
+                value = Hotel._meta.get_field('star_rate').to_python(value)
+            except DjangoValidationError as e:
+                raise ValidationError({'star_rate' + suffix: e.messages})
+            queryset = queryset.filter(**{'hotel__star_rate' + lookup: value})
+        return queryset
+
+    def get_poi_queryset(self):
+        """
+        The sites that are an attraction, a restaurant or a hotel
+        """
+        return self.get_queryset().filter(Q(attraction__isnull=False) | Q(restaurant__isnull=False) |
+                                          Q(hotel__isnull=False))
+
+    def list(self, request):
+        paginator = KeysetPagination(('id',))
+        queryset = self.get_poi_queryset().select_related('attraction', 'restaurant', 'hotel')
+        page = paginator.paginate_queryset(queryset, request)
+        serializer = self.serializer_detail_class(page, many=True, context={"query_params": request.query_params})
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False)
+    def facets(self, request):
+        """
+        Counts of the listed sites by `site_category`, subtype `category`, `star_rate` and `city`
+        """
+        return Response(get_site_facets(self.get_poi_queryset()))
+
+    @action(detail=False)
+    def nearby(self, request):
+        """
+        Sites within `radius` km (5 by default) of `lat`, `lng`, nearest first, with their `distance` in km
+        """
+        max_radius = getattr(settings, 'SITE_NEARBY_MAX_RADIUS', 50)
+        params = get_float_params(request.query_params, {
+            'lat': (-90, 90, None),
+            'lng': (-180, 180, None),
+            'radius': (0, max_radius, 5),
+            'limit': (1, 100, 20),
+        })
+        if params is None:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        lat, lng, radius = params['lat'], params['lng'], params['radius']
+
+        sites = []
+        for site in within_box(self.get_poi_queryset(), *bounding_box(lat, lng, radius)):
+            distance = haversine(lat, lng, float(site.latitude), float(site.longitude))
+            if distance <= radius:
+                sites.append((distance, site.pk, site))
+        sites.sort(key=lambda item: item[:2])
+        sites = sites[:int(params['limit'])]
+
+        serializer = self.serializer_class_read([site for _, _, site in sites], many=True,
+                                                context={"query_params": request.query_params})
+        return Response([dict(data, distance=round(distance, 3))
+                         for (distance, _, _), data in zip(sites, serializer.data)])
+
+    @action(detail=False)
+    def bbox(self, request):
+        """
+        Sites inside the box from `min_lat`, `min_lng` to `max_lat`, `max_lng`, paginated by id
+        """
+        params = get_float_params(request.query_params, {
+            'min_lat': (-90, 90, None),
+            'min_lng': (-180, 180, None),
+            'max_lat': (-90, 90, None),
+            'max_lng': (-180, 180, None),
+        })
+        if params is None or params['min_lat'] > params['max_lat'] or params['min_lng'] > params['max_lng']:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = KeysetPagination(('id',))
+        queryset = within_box(self.get_poi_queryset(), params['min_lat'], params['min_lng'],
+                              params['max_lat'], params['max_lng'])
+        page = paginator.paginate_queryset(queryset, request)
+        serializer = self.serializer_class_read(page, many=True, context={"query_params": request.query_params})
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False)
+    def clusters(self, request):
+        """
+        Sites inside a bounding box grouped by geohash cell for a map `zoom` level, each cluster with its
+        site count, centroid and lowest and highest site ids
+        """
+        params = get_float_params(request.query_params, {
+            'min_lat': (-90, 90, None),
+            'min_lng': (-180, 180, None),
+            'max_lat': (-90, 90, None),
+            'max_lng': (-180, 180, None),
+            'zoom': (0, 22, None),
+        })
+        if params is None or params['min_lat'] > params['max_lat'] or params['min_lng'] > params['max_lng']:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        box = params['min_lat'], params['min_lng'], params['max_lat'], params['max_lng']
+
+        # Coarser cells than the zoom asks for when the box would hold too many of them
+        max_clusters = getattr(settings, 'SITE_CLUSTERS_MAX', 256)
+        precision = geohash_precision_for_zoom(int(params['zoom']))
+        while precision > 1 and geohash_cell_count(*box, precision) > max_clusters:
+            precision -= 1
+
+        clusters = within_box(self.get_poi_queryset(), *box) \
+            .annotate(cell=Substr('geohash', 1, precision)).order_by().values('cell') \
+            .annotate(count=Count('id'), latitude=Avg('latitude'), longitude=Avg('longitude'),
+                      first_site=Min('id'), last_site=Max('id')) \
+            .order_by('cell')
+        return Response([{
+            'geohash': cluster['cell'],
+            'count': cluster['count'],
+            'latitude': round(float(cluster['latitude']), 6),
+            'longitude': round(float(cluster['longitude']), 6),
+            'sites': sorted({cluster['first_site'], cluster['last_site']}),
+        } for cluster in clusters])
+
+    def get_permissions(self):
+        """
+        Instantiates and returns the list of permissions that this view requires.
+        """
+        permission_classes = [AllowAny]
+        return [permission() for permission in permission_classes]
+
+
 class AttractionViewSet(viewsets.ViewSet):
     """
     API endpoint that allows attractions to be viewed or edited.
@@ -74,22 +340,22 @@ class AttractionViewSet(viewsets.ViewSet):
 
     def get_queryset(self):
         """
-        Optionally restricts the attraction based on city
+        Optionally restricts the attraction based on city and category
         """
-        queryset = Attraction.objects.all()
-        city = self.request.query_params.get('city', None)
-        if city is not None:
-            queryset = Attraction.objects.filter(site__city_id=city)
-        return queryset
+        return get_poi_queryset(Attraction, self.request.query_params)
 
     def list(self, request):
-        serializer = self.serializer_class_read(self.get_queryset().all(), many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination(('site_id',))
+        page = paginator.paginate_queryset(self.get_queryset(), request)
+        serializer = self.serializer_class_read(page, many=True, context={"query_params": request.query_params})
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            update_distance_cache(serializer.instance.site)
+            autocomplete_index.update(SITE, serializer.instance.site.pk, serializer.instance.site.name)
             attraction = self.serializer_class_read(serializer.instance)
             return Response(attraction.data, status=status.HTTP_201_CREATED)
         else:
@@ -97,13 +363,17 @@ class AttractionViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         attraction = get_object_or_404(self.get_queryset().all(), pk=pk)
-        serializer = self.serializer_class_read(attraction)
+        serializer = self.serializer_class_read(attraction, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
-        serializer = self.serializer_class(self.get_queryset().get(site_id=pk), data=request.data)
+        attraction = self.get_queryset().get(site_id=pk)
+        previous_location = get_location(attraction.site)
+        serializer = self.serializer_class(attraction, data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            update_distance_cache(serializer.instance.site, previous_location)
+            autocomplete_index.update(SITE, serializer.instance.site.pk, serializer.instance.site.name)
             attraction = self.serializer_class_read(serializer.instance)
             return Response(attraction.data)
         else:
@@ -112,7 +382,10 @@ class AttractionViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         attraction = get_object_or_404(self.get_queryset().all(), pk=pk)
+        site = attraction.site
         attraction.delete()
+        remove_from_distance_cache(site)
+        autocomplete_index.remove(SITE, site.pk)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -139,13 +412,9 @@ class RestaurantViewSet(viewsets.ViewSet):
 
     def get_queryset(self):
         """
-        Optionally restricts the restaurant based on city
+        Optionally restricts the restaurant based on city, category and opening time
         """
-        queryset = Restaurant.objects.all()
-        city = self.request.query_params.get('city', None)
-        if city is not None:
-            queryset = Restaurant.objects.filter(site__city_id=city)
-        return queryset
+        return get_poi_queryset(Restaurant, self.request.query_params, ('open_at',))
 
     def get_permissions(self):
         """
@@ -158,13 +427,17 @@ class RestaurantViewSet(viewsets.ViewSet):
         return [permission() for permission in permission_classes]
 
     def list(self, request):
-        serializer = self.serializer_class_read(self.get_queryset().all(), many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination(('site_id',))
+        page = paginator.paginate_queryset(self.get_queryset(), request)
+        serializer = self.serializer_class_read(page, many=True, context={"query_params": request.query_params})
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            update_distance_cache(serializer.instance.site)
+            autocomplete_index.update(SITE, serializer.instance.site.pk, serializer.instance.site.name)
             restaurant = self.serializer_class_read(serializer.instance)
             return Response(restaurant.data, status=status.HTTP_201_CREATED)
         else:
@@ -172,13 +445,17 @@ class RestaurantViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         restaurant = get_object_or_404(self.get_queryset().all(), pk=pk)
-        serializer = self.serializer_class_read(restaurant)
+        serializer = self.serializer_class_read(restaurant, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
-        serializer = self.serializer_class(self.get_queryset().get(site_id=pk), data=request.data)
+        restaurant = self.get_queryset().get(site_id=pk)
+        previous_location = get_location(restaurant.site)
+        serializer = self.serializer_class(restaurant, data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            update_distance_cache(serializer.instance.site, previous_location)
+            autocomplete_index.update(SITE, serializer.instance.site.pk, serializer.instance.site.name)
             restaurant = self.serializer_class_read(serializer.instance)
             return Response(restaurant.data)
         else:
@@ -187,7 +464,10 @@ class RestaurantViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         attraction = get_object_or_404(self.get_queryset().all(), pk=pk)
+        site = attraction.site
         attraction.delete()
+        remove_from_distance_cache(site)
+        autocomplete_index.remove(SITE, site.pk)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -205,13 +485,9 @@ class HotelViewSet(viewsets.ViewSet):
 
     def get_queryset(self):
         """
-        Optionally restricts the hotel based on city
+        Optionally restricts the hotel based on city, category and star rate
         """
-        queryset = Hotel.objects.all()
-        city = self.request.query_params.get('city', None)
-        if city is not None:
-            queryset = Hotel.objects.filter(site__city_id=city)
-        return queryset
+        return get_poi_queryset(Hotel, self.request.query_params, ('star_rate',))
 
     def get_permissions(self):
         """
@@ -224,13 +500,17 @@ class HotelViewSet(viewsets.ViewSet):
         return [permission() for permission in permission_classes]
 
     def list(self, request):
-        serializer = self.serializer_class_read(self.get_queryset().all(), many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination(('site_id',))
+        page = paginator.paginate_queryset(self.get_queryset(), request)
+        serializer = self.serializer_class_read(page, many=True, context={"query_params": request.query_params})
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            update_distance_cache(serializer.instance.site)
+            autocomplete_index.update(SITE, serializer.instance.site.pk, serializer.instance.site.name)
             hotel = self.serializer_class_read(serializer.instance)
             return Response(hotel.data, status=status.HTTP_201_CREATED)
         else:
@@ -238,13 +518,17 @@ class HotelViewSet(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         hotel = get_object_or_404(self.get_queryset().all(), pk=pk)
-        serializer = self.serializer_class_read(hotel)
+        serializer = self.serializer_class_read(hotel, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
-        serializer = self.serializer_class(self.get_queryset().get(site_id=pk), data=request.data)
+        hotel = self.get_queryset().get(site_id=pk)
+        previous_location = get_location(hotel.site)
+        serializer = self.serializer_class(hotel, data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            update_distance_cache(serializer.instance.site, previous_location)
+            autocomplete_index.update(SITE, serializer.instance.site.pk, serializer.instance.site.name)
             hotel = self.serializer_class_read(serializer.instance)
             return Response(hotel.data)
         else:
@@ -253,6 +537,9 @@ class HotelViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         attraction = get_object_or_404(self.get_queryset().all(), pk=pk)
+        site = attraction.site
         attraction.delete()
+        remove_from_distance_cache(site)
+        autocomplete_index.remove(SITE, site.pk)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
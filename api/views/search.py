@@ -0,0 +1,87 @@
+from rest_framework import viewsets, status
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from api.autocomplete import autocomplete_index, CITY, SITE
+from api.models import SearchDocument
+from api.search import search
+
+SEARCH_KINDS = (SearchDocument.SITE, SearchDocument.ITINERARY)
+
+
+class SearchViewSet(viewsets.ViewSet):
+    """
+    API endpoint that searches sites and public itineraries by text, best matches first.
+    """
+    default_limit = 20
+    max_limit = 100
+
+    def dispatch(self, request, *args, **kwargs):
+        return super(SearchViewSet, self).dispatch(request, *args, **kwargs)
+
+    def list(self, request):
+        query = request.query_params.get('q', '')
+        kind = request.query_params.get('type', None)
+        category = request.query_params.get('category', None)
+        city = request.query_params.get('city', None)
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+            offset = int(request.query_params.get('offset', 0))
+            city = int(city) if city is not None else None
+        except ValueError:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or offset < 0 or (kind is not None and kind not in SEARCH_KINDS):
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+
+        documents = search(query, kind, category, city, limit=limit + 1, offset=offset)
+        headers = {}
+        if len(documents) > limit:
+            documents = documents[:limit]
+            url = replace_query_param(request.build_absolute_uri(), 'offset', offset + limit)
+            headers['Link'] = '<{}>; rel="next"'.format(url)
+        return Response([{
+            'type': document.kind,
+            'id': document.object_id,
+            'title': document.title,
+            'category': document.category or None,
+            'city': document.city_id,
+            'score': round(document.score, 4),
+        } for document in documents], headers=headers)
+
+    def get_permissions(self):
+        """
+        Instantiates and returns the list of permissions that this view requires.
+        """
+        permission_classes = [AllowAny]
+        return [permission() for permission in permission_classes]
+
+
+class AutocompleteViewSet(viewsets.ViewSet):
+    """
+    API endpoint that completes city and site names, most popular first.
+    """
+    default_limit = 8
+    max_limit = 20
+
+    def dispatch(self, request, *args, **kwargs):
+        return super(AutocompleteViewSet, self).dispatch(request, *args, **kwargs)
+
+    def list(self, request):
+        kind = request.query_params.get('type', None)
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or (kind is not None and kind not in (CITY, SITE)):
+            return Response({"status": "invalid parameter"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = autocomplete_index.lookup(request.query_params.get('q', ''), kind, limit)
+        return Response([{'type': kind, 'id': pk, 'name': name} for kind, pk, name in results])
+
+    def get_permissions(self):
+        """
+        Instantiates and returns the list of permissions that this view requires.
+        """
+        permission_classes = [AllowAny]
+        return [permission() for permission in permission_classes]
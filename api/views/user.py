@@ -33,7 +33,8 @@ class UserView(viewsets.ViewSet):
         return super(UserView, self).dispatch(request, *args, **kwargs)
 
     def list(self, request):
-        serializer = self.serializer_class(self.queryset.all(), many=True)
+        serializer = self.serializer_class(self.queryset.all(), many=True,
+                                           context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def create(self, request):
@@ -46,7 +47,7 @@ class UserView(viewsets.ViewSet):
 
     def retrieve(self, request, pk=None):
         user = get_object_or_404(self.queryset.all(), pk=pk)
-        serializer = self.serializer_class(user)
+        serializer = self.serializer_class(user, context={"query_params": request.query_params})
         return Response(serializer.data)
 
     def update(self, request, pk=None):
@@ -56,6 +56,7 @@ MIDDLEWARE = [
 ROOT_URLCONF = 'xianlu_trips.urls'
 
 CORS_ORIGIN_ALLOW_ALL = True
+CORS_EXPOSE_HEADERS = ['X-Next-Cursor', 'Link']
 # CORS_ORIGIN_WHITELIST = (
 #     'localhost:3000/'
 # )
@@ -144,6 +145,41 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTH_USER_MODEL = "api.User"
 
+# Itinerary views are buffered in each worker and written every VIEW_COUNTER_FLUSH_INTERVAL seconds,
+# or once VIEW_COUNTER_MAX_PENDING itineraries have pending views. 0 writes every view immediately.
+VIEW_COUNTER_FLUSH_INTERVAL = 10
+VIEW_COUNTER_MAX_PENDING = 1000
+
+# Likes of itineraries with at least LIKE_COUNTER_HOT_THRESHOLD likes are counted into LIKE_COUNTER_SHARDS
+# rows, folded back into the itinerary by `manage.py reconcile_likes`. 0 disables sharding.
+LIKE_COUNTER_SHARDS = 0
+LIKE_COUNTER_HOT_THRESHOLD = 1000
+
+# Number of newest comments embedded in the itinerary detail (at least 1), the others are paged through /comment/
+ITINERARY_DETAIL_COMMENTS = 10
+
+# Gap between the stored orders of consecutive day trip sites. 1 keeps them dense, a larger gap (e.g. 1024)
+# lets a site be moved by writing its row only. Run `manage.py rebalance_day_trip_sites` after changing it.
+DAY_TRIP_SITE_ORDER_GAP = 1
+
+# Largest radius in km accepted by /site/nearby/
+SITE_NEARBY_MAX_RADIUS = 50
+
+# Most clusters returned by /site/clusters/, larger boxes are clustered with coarser cells
+SITE_CLUSTERS_MAX = 256
+
+# Where the per-city distance matrices between points of interest are kept, see api/distance_cache.py
+DISTANCE_CACHE_DIR = os.path.join(BASE_DIR, 'distance_cache')
+
+# Seconds after which a worker reloads its autocomplete index, to see changes made by other workers
+AUTOCOMPLETE_MAX_AGE = 300
+
+# Rows read from the database at a time by the streaming exports, see api.export
+EXPORT_CHUNK_SIZE = 2000
+
+# Threads of each process writing the resized variants of uploaded images, see api.images
+IMAGE_WORKERS = 2
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
@@ -162,6 +198,14 @@ USE_TZ = True
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = "media"
+# Uploads are stored once per content, see api.storage
+DEFAULT_FILE_STORAGE = 'api.storage.ContentAddressedStorage'
+# Seconds media outside the content-addressed storage may be cached, see api.views.media
+MEDIA_MAX_AGE = 3600
+# Lets the front server send media files: None, 'nginx' (X-Accel-Redirect) or 'sendfile' (X-Sendfile)
+MEDIA_ACCEL_REDIRECT = None
+# Internal nginx location aliased to MEDIA_ROOT, for X-Accel-Redirect
+MEDIA_ACCEL_PREFIX = '/protected-media/'
 
 STATIC_URL = '/static/'
 STATIC_ROOT = 'static'
@@ -13,12 +13,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.conf.urls.static import static
-from django.urls import path, include
+import re
+
+from django.urls import path, re_path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt import views as jwt_views
 
 import api.urls
+from api.views.media import serve_media
 from api.views.user import TokenObtainPairPatchedView
 from xianlu_trips import settings
 
@@ -32,4 +34,6 @@ urlpatterns = [
                   path('api/auth/', include('rest_framework.urls')),
                   path('api/token-auth/', TokenObtainPairPatchedView.as_view(), name='token_obtain_pair'),
                   path('api/token-auth/refresh/', jwt_views.TokenRefreshView.as_view(), name='token_refresh'),
-              ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+                  re_path(r'^{}(?P<path>.+)$'.format(re.escape(settings.MEDIA_URL.lstrip('/'))), serve_media,
+                          name='media'),
+              ]